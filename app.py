@@ -1,11 +1,18 @@
-from flask import Flask, render_template, jsonify, request 
+from flask import Flask, render_template, jsonify, request, Response, g
 import grafo_logic as erg # erg es tu modulo grafo_logic.py
+from trabajos_analisis import GestorTrabajos, ERROR
+import snapshot_compartido
+import metricas
 import logging
-from pyproj import CRS, Transformer
-from shapely.geometry import Point
-import networkx as nx 
-import random 
+import json
+import gzip
+import numpy as np
 import math 
+import threading
+import time
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -24,25 +31,687 @@ DB_CONFIG = {
     'port': '5432'
 }
 
-CRS_GEOGRAPHIC = "EPSG:4326" 
-CRS_PROJECTED = "EPSG:32718" 
+# Los transformadores de coordenadas son los de grafo_logic (erg.obtener_transformador), compartidos y creados en el primer uso
+CRS_GEOGRAPHIC = erg.CRS_GEOGRAPHIC
+CRS_PROJECTED = erg.CRS_PROJECTED
 
-transformer_geo_to_proj = Transformer.from_crs(CRS_GEOGRAPHIC, CRS_PROJECTED, always_xy=True)
-transformer_proj_to_geo = Transformer.from_crs(CRS_PROJECTED, CRS_GEOGRAPHIC, always_xy=True) 
 
+# Snapshot publicado (erg.SnapshotGrafo): grafo + resultados.
+# Se reemplaza con una sola asignación cuando termina un análisis; cada endpoint lee la
+# referencia UNA vez al inicio y trabaja con ese snapshot, así nunca ve un grafo a medio construir.
+# Los IDs string del frontend se resuelven con el índice espacial del grafo (ver indice_nodo_por_id).
+GLOBAL_SNAPSHOT = None
 
-GLOBAL_GRAPH = None
-# CAMBIO CLAVE: Este mapeo ahora mapeará el string ID a la TUPLA DE COORDENADAS REDONDEADAS
-# que se usarán como claves en un nuevo mapeo para los nodos del grafo real.
-GLOBAL_NODE_ID_STRING_TO_ROUNDED_PROJ_COORD = {} 
-GLOBAL_ROUNDED_PROJ_COORD_TO_ACTUAL_PROJ_COORD = {} # Nuevo mapeo: (redondeado) -> (real del grafo)
-GLOBAL_ACTUAL_PROJ_COORD_TO_GEO_COORD = {} # Mapeo de (real del grafo) a (lat_geo, lon_geo)
+
+def formatear_id_nodo(proj_coord_tuple):
+    """ID string usado por el frontend: coordenadas proyectadas redondeadas a 6 decimales."""
+    rounded = (round(proj_coord_tuple[0], 6), round(proj_coord_tuple[1], 6))
+    return f"{rounded[0]:.6f}_{rounded[1]:.6f}".replace('.', '_').replace('-', 'minus')
+
+
+def indice_nodo_por_id(snapshot, node_id_str):
+    """
+    Posición en el grafo del nodo con ese ID string del frontend (ver formatear_id_nodo), o None.
+    El ID son las coordenadas redondeadas: se buscan los nodos a menos de 1e-5 m en el índice espacial
+    y se toma el de ID igual (si varios redondean al mismo ID, el último, como el antiguo mapeo por diccionario).
+    """
+    node_id_str = str(node_id_str).strip()
+    partes = node_id_str.replace('minus', '-').split('_')
+    if len(partes) != 4:
+        return None
+    try:
+        punto = (float(f"{partes[0]}.{partes[1]}"), float(f"{partes[2]}.{partes[3]}"))
+    except ValueError:
+        return None
+    indice = snapshot.vista.graph.get('indice_espacial')
+    if indice is None:
+        return None
+    coincidencias = [idx for idx, _ in indice.dentro_de_radio(punto, 1e-5) if formatear_id_nodo(indice.nodo(idx)) == node_id_str]
+    return max(coincidencias) if coincidencias else None
+
+
+@app.before_request
+def iniciar_medicion_peticion():
+    g.inicio_peticion = time.perf_counter()
+    g.perfil = None
+    if metricas.perfilado_habilitado() and (request.args.get('perfil') == '1' or request.headers.get('X-Perfil') == '1'):
+        g.perfil = metricas.iniciar_perfil()
+
+
+@app.after_request
+def registrar_medicion_peticion(respuesta):
+    """Observa la latencia de la petición en /metrics y, si se pidió, guarda el perfil de cProfile."""
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'sin_ruta'
+    inicio = g.get('inicio_peticion')
+    if inicio is not None:
+        # En respuestas por streaming (ndjson, SSE) solo se mide hasta que empieza el envío
+        metricas.REGISTRO.observar('grafo_http_duracion_segundos', time.perf_counter() - inicio,
+                                   endpoint=endpoint, metodo=request.method, codigo=respuesta.status_code)
+    perfil = g.get('perfil')
+    if perfil is not None:
+        g.perfil = None
+        ruta = metricas.ruta_perfil(endpoint)
+        respuesta.headers['X-Perfil-Archivo'] = os.path.basename(ruta)
+        if respuesta.is_streamed:
+            # ndjson/SSE: el cuerpo se genera después de after_request; el perfil se cierra cuando
+            # el servidor termina de enviarlo (o el cliente corta la conexión)
+            respuesta.call_on_close(lambda: guardar_perfil_peticion(perfil, ruta))
+        else:
+            guardar_perfil_peticion(perfil, ruta)
+    return respuesta
+
+
+@app.teardown_request
+def cerrar_perfil_peticion(error=None):
+    """Si la petición falló antes de after_request, detiene y guarda igual su perfil para no dejarlo activo."""
+    perfil = g.pop('perfil', None)
+    if perfil is not None:
+        guardar_perfil_peticion(perfil, metricas.ruta_perfil(request.endpoint or 'error'))
+
+
+def guardar_perfil_peticion(perfil, ruta):
+    try:
+        metricas.guardar_perfil(perfil, ruta)
+    except OSError as e:
+        app.logger.warning(f"No se pudo guardar el perfil de la petición: {e}")
+
+
+@app.route('/metrics')
+def metricas_api():
+    """Histogramas de latencia de las etapas del análisis y de los endpoints, en formato Prometheus."""
+    return Response(metricas.REGISTRO.texto_prometheus(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+# Caché de snapshots del grafo: se construye una vez por versión de 'tramos_gas' y parámetros
+SNAPSHOT_CACHE = erg.CacheSnapshots()
+# Serializa la adjunción de snapshots publicados por otros workers
+LOCK_ADJUNTAR = threading.Lock()
+
+
+def construir_snapshot(version, parametros, logprint):
+    """
+    Ejecuta el pipeline completo (carga, proyección, grafo, algoritmos y gases)
+    y devuelve un erg.SnapshotGrafo listo para guardarse en la caché.
+    """
+    build_log = []
+    def logprint_snapshot(msg):
+        build_log.append(msg)
+        logprint(msg)
+
+    # Lote de la bitácora de cambios leído ANTES de cargar: un cambio concurrente se vuelve a aplicar
+    # en la siguiente actualización incremental (quitar y agregar un CODTRAMO es idempotente)
+    lote_cambios = erg.obtener_ultimo_lote_cambios(logprint_snapshot)
+
+    # La geometría proyectada llega en WKB binario desde 'geometry_proj'; si esa carga falla
+    # se usa la carga geográfica con read_postgis y se reproyecta en el cliente
+    with metricas.medir_etapa('carga_tramos', logprint_snapshot):
+        gdf_gas_proj = erg.cargar_tramos_gas_proyectados(logprint_snapshot, max_rows=parametros.get('max_rows'), **filtros_region(parametros))
+        if gdf_gas_proj is None:
+            gdf_gas = erg.cargar_tramos_gas(logprint_snapshot, max_rows=parametros.get('max_rows'), **filtros_region(parametros))
+    if gdf_gas_proj is None:
+        if gdf_gas.empty:
+            raise ValueError("No se cargaron tramos de gas válidos desde la base de datos.")
+        with metricas.medir_etapa('proyeccion', logprint_snapshot):
+            gdf_gas_proj = gdf_gas.to_crs(CRS_PROJECTED)
+        logprint_snapshot(f"   Geometrías proyectadas a {CRS_PROJECTED} para cálculos métricos precisos.")
+    elif gdf_gas_proj.empty:
+        raise ValueError("No se cargaron tramos de gas válidos desde la base de datos.")
+    logprint_snapshot("")
+
+    with metricas.medir_etapa('construir_grafo_red', logprint_snapshot):
+        G = erg.construir_grafo_red(None, gdf_gas_proj, logprint_snapshot)
+    if G.number_of_nodes() == 0:
+        raise ValueError("No se pudo construir un grafo con nodos válidos.")
+
+    snapshot = completar_snapshot(version, parametros, G, build_log, logprint_snapshot)
+    snapshot.lote_cambios = lote_cambios
+    return snapshot
+
+
+def actualizar_snapshot(base, version, parametros, logprint):
+    """
+    Construye el snapshot de la nueva versión aplicando sobre el grafo de 'base' solo los tramos
+    registrados en la bitácora de cambios desde base.lote_cambios. Devuelve None si no se puede
+    (tabla reemplazada por completo, bitácora ilegible o cambios sin registrar) y hay que reconstruir.
+    """
+    if base is None or base.lote_cambios is None or not erg.misma_tabla_tramos(base.version, version):
+        return None
+    build_log = []
+    def logprint_snapshot(msg):
+        build_log.append(msg)
+        logprint(msg)
+
+    with metricas.medir_etapa('carga_cambios_tramos', logprint_snapshot):
+        cambios = erg.cargar_cambios_tramos(base.lote_cambios, logprint_snapshot, **filtros_region(parametros))
+    if cambios is None:
+        return None
+    ultimo_lote, codtramos, gdf_actuales = cambios
+    if ultimo_lote == base.lote_cambios:
+        # La tabla cambió sin pasar por la importación incremental: no se sabe qué tramos tocar
+        logprint_snapshot("   La tabla cambió pero la bitácora no registra cambios nuevos. Se reconstruirá el grafo.")
+        return None
+
+    with metricas.medir_etapa('actualizar_grafo_red', logprint_snapshot):
+        G = erg.actualizar_grafo_red(base.grafo, codtramos, gdf_actuales.to_crs(CRS_PROJECTED), logprint_snapshot,
+                                     max_filas=parametros.get('max_rows'))
+    if G is None or G.number_of_nodes() == 0:
+        return None
+    snapshot = completar_snapshot(version, parametros, G, build_log, logprint_snapshot, conservar_niveles=True)
+    snapshot.lote_cambios = ultimo_lote
+    return snapshot
+
+
+def completar_snapshot(version, parametros, G, build_log, logprint_snapshot, conservar_niveles=False):
+    """
+    A partir del grafo ya construido calcula componentes, landmarks, nodo inicial, KMeans,
+    atributos de los nodos, y devuelve el erg.SnapshotGrafo.
+    """
+    with metricas.medir_etapa('componentes', logprint_snapshot):
+        componentes = erg.resumen_componentes(G)
+    logprint_snapshot(f"   Componente mayor: {componentes['mayor']} nodos; {componentes['nodos_fuera_del_mayor']} nodos fuera de ella.")
+
+    # Preprocesamiento de rutas (landmarks ALT): por snapshot solo si 'alt' es el algoritmo por defecto;
+    # si no, se preparan en la primera ruta que pida 'alt' (ver erg.calcular_ruta_optima)
+    if erg.ALGORITMO_RUTA_PREDETERMINADO == 'alt':
+        with metricas.medir_etapa('landmarks', logprint_snapshot):
+            landmarks = erg.obtener_grafo_csr(G).preparar_landmarks()
+        logprint_snapshot(f"   Landmarks para rutas A*/ALT preparados: {len(landmarks)}.")
+        logprint_snapshot("")
+
+    # 4. Definir y encontrar el nodo inicial más cercano (ej. centro de Lima)
+    center_lon_geo, center_lat_geo = -77.0428, -12.0464 
+    center_x_proj, center_y_proj = erg.obtener_transformador(CRS_GEOGRAPHIC, CRS_PROJECTED).transform(center_lon_geo, center_lat_geo)
+    center_point_proj = (center_x_proj, center_y_proj)
+
+    with metricas.medir_etapa('nodo_inicial', logprint_snapshot):
+        nodo_inicial = erg.encontrar_nodo_inicial(G, center_point_proj, logprint_snapshot)
+    if nodo_inicial is None:
+        logprint_snapshot("   Advertencia: No se encontró un nodo inicial cercano para los algoritmos. El grafo puede estar vacío o muy disperso.")
+
+    snapshot = erg.SnapshotGrafo(version, parametros, G, log=build_log)
+    snapshot.resultados['nodo_inicial'] = nodo_inicial
+    snapshot.resultados['componentes'] = componentes
+
+    # 5. KMeans se calcula siempre: los niveles de gases simulados dependen del cluster.
+    # El resto de algoritmos (Dijkstra, MST, Bellman-Ford) se calculan bajo demanda en api_analisis.
+    kmeans_labels = snapshot.analisis('kmeans', logprint_snapshot) if nodo_inicial is not None else []
+    
+    logprint_snapshot("")
+
+    # 6. Preparar propiedades adicionales para los nodos del frontend (gases, codtramo, longitud)
+    with metricas.medir_etapa('atributos_nodos', logprint_snapshot):
+        asignar_atributos_nodos(G, kmeans_labels, conservar_niveles=conservar_niveles)
+    return snapshot
+
+
+def asignar_atributos_nodos(G, kmeans_labels, niveles=None, conservar_niveles=False):
+    """
+    Asigna a cada nodo su cluster KMeans y sus niveles de gases, como arreglos por nodo
+    (ver erg.clusters_nodos y erg.niveles_gases). CODTRAMO y longitud salen de la atribución
+    de tramos del grafo (ver erg.tramos_de_nodo y erg.columnas_tramos).
+    niveles es un dict {gas_attr: arreglo por nodo}; si es None, los gases simulados
+    se generan al azar en base al cluster KMeans (si aplica). Con conservar_niveles, los nodos
+    que ya tienen niveles (grafo actualizado de forma incremental) los mantienen.
+    """
+    n = G.number_of_nodes()
+    etiquetas = np.full(n, -1, dtype=np.int32)
+    k = min(len(kmeans_labels), n)
+    etiquetas[:k] = np.asarray(kmeans_labels[:k], dtype=np.int32)
+    G.graph['kmeans_nodos'] = etiquetas
+
+    if niveles is not None:
+        # Copia: los arreglos de un snapshot compartido son de solo lectura (mmap)
+        G.graph['niveles_gases'] = {gas_attr: np.array(niveles[gas_attr], dtype=float) for gas_attr in erg.GAS_ATTRS}
+    else:
+        previos = G.graph.get('niveles_gases') if conservar_niveles else None
+        generar = np.ones(n, dtype=bool) if previos is None else np.isnan(previos['co2_level'])
+        # Base de cada gas según el cluster (sin cluster = mismo valor que el cluster 0)
+        base = np.maximum(etiquetas[generar], 0)
+        m = int(generar.sum())
+        nuevos = {
+            'co2_level': np.round(np.maximum(0, 50 + base * 10 + np.random.uniform(-10, 10, m)), 2),
+            'ch4_level': np.round(np.maximum(0, 10 + base * 2 + np.random.uniform(-3, 3, m)), 2),
+            'nox_level': np.round(np.maximum(0, 5 + base * 1 + np.random.uniform(-1, 1, m)), 2),
+        }
+        niveles_nodos = {}
+        for gas_attr in erg.GAS_ATTRS:
+            nivel = np.zeros(n) if previos is None else np.array(previos[gas_attr], dtype=float)
+            nivel[generar] = nuevos[gas_attr]
+            niveles_nodos[gas_attr] = nivel
+        G.graph['niveles_gases'] = niveles_nodos
+
+
+def adjuntar_snapshot_compartido(logprint, nombre=None):
+    """
+    Adjunta el snapshot publicado por otro worker (ver snapshot_compartido). Su grafo es una vista
+    sobre los arreglos mapeados: no se copia nada por nodo. Devuelve el erg.SnapshotGrafo o None.
+    """
+    snapshot, _ = snapshot_compartido.adjuntar_snapshot(logprint, nombre=nombre)
+    return snapshot
+
+
+def obtener_escenario(snapshot, scenario_id, crear=True):
+    """
+    OverlaySimulacion del escenario, al día con las simulaciones que guardaron los demás workers para el
+    mismo snapshot publicado (ver snapshot_compartido.sincronizar_escenario). Con crear=False devuelve
+    None si el escenario no tiene simulaciones en ningún worker.
+    """
+    nombre = snapshot.nombre_compartido
+    overlay = snapshot.escenarios.get(scenario_id)
+    if overlay is None and (crear or (nombre is not None and snapshot_compartido.existe_escenario(nombre, scenario_id))):
+        overlay = snapshot.escenario(scenario_id)
+    if overlay is not None and nombre is not None:
+        snapshot_compartido.sincronizar_escenario(nombre, scenario_id, overlay)
+    return overlay
+
+
+@contextmanager
+def simulacion_compartida(snapshot, scenario_id):
+    """
+    Entrega el overlay del escenario para simular sobre él: bajo el lock del escenario entre workers,
+    lo sincroniza antes y guarda el resultado después, así ninguna simulación concurrente se pierde.
+    Si el snapshot no se pudo publicar, el escenario queda solo en este worker.
+    """
+    nombre = snapshot.nombre_compartido
+    if nombre is None:
+        yield snapshot.escenario(scenario_id)
+        return
+    with snapshot_compartido.bloquear_escenario(nombre, scenario_id):
+        overlay = obtener_escenario(snapshot, scenario_id)
+        yield overlay
+        snapshot_compartido.guardar_escenario(nombre, scenario_id, overlay)
+
+
+def obtener_snapshot_publicado():
+    """
+    Devuelve el snapshot que deben usar los endpoints. Si otro worker publicó un snapshot
+    más reciente que el de este proceso (o este proceso todavía no tiene ninguno), lo toma de
+    SNAPSHOT_CACHE si ya está ahí o lo adjunta antes de devolverlo. Devuelve None si no hay ningún grafo cargado.
+    """
+    global GLOBAL_SNAPSHOT
+    snapshot = GLOBAL_SNAPSHOT # Leer la referencia una sola vez
+    nombre = snapshot_compartido.nombre_publicado()
+    if nombre is None or (snapshot is not None and snapshot.nombre_compartido == nombre):
+        return snapshot
+    with LOCK_ADJUNTAR:
+        if GLOBAL_SNAPSHOT is not None and GLOBAL_SNAPSHOT.nombre_compartido == nombre:
+            return GLOBAL_SNAPSHOT
+        # Si el snapshot publicado ya está en la caché de este proceso (p. ej. se volvió a marcar como
+        # actual uno anterior) se reutiliza con sus escenarios, sin volver a adjuntarlo
+        adjuntado = SNAPSHOT_CACHE.buscar_compartido(nombre)
+        if adjuntado is None:
+            adjuntado = adjuntar_snapshot_compartido(app.logger.info, nombre=nombre)
+            if adjuntado is not None:
+                adjuntado = SNAPSHOT_CACHE.agregar(adjuntado)
+        if adjuntado is not None:
+            GLOBAL_SNAPSHOT = adjuntado
+        return GLOBAL_SNAPSHOT
+
+
+FORMATOS_ANALISIS = ('completo', 'columnar', 'ndjson')
+COLUMNAS_NODOS = ("id", "lat", "lon", "x_proj", "y_proj", "kmeans", "dijkstra", "bellman",
+                  "codtramo", "codtramos", "longitud", "co2_level", "ch4_level", "nox_level", "componente")
+
+
+def preparar_columnas_grafo(G, dijkstra, bellman, overlay=None):
+    """
+    Devuelve (columnas_nodos, columnas_aristas) con una lista por atributo.
+    La posición i de las columnas de nodos es el nodo i de G.nodes(); las aristas referencian
+    esas posiciones en 'source' y 'target' en lugar de repetir IDs y coordenadas.
+    Si se pasa un overlay de simulación, sus niveles de gases reemplazan a los del grafo.
+    Todo sale de los arreglos del grafo (G.graph[...]), sin recorrer los nodos de NetworkX.
+    """
+    nodos_xy = G.graph['nodos_xy'] if 'nodos_xy' in G.graph else np.array(list(G.nodes()), dtype=float).reshape(-1, 2)
+    nodos = [tuple(xy) for xy in np.asarray(nodos_xy).tolist()] # Nodos REALES del grafo (coordenadas sin redondear)
+    latlon = np.asarray(erg.coordenadas_geograficas(G))
+
+    columnas_nodos = {columna: [] for columna in COLUMNAS_NODOS}
+    # El ID del nodo para el frontend sigue siendo el string de las coordenadas proyectadas redondeadas
+    columnas_nodos["id"] = [formatear_id_nodo(n) for n in nodos]
+    columnas_nodos["lat"] = latlon[:, 0].tolist()
+    columnas_nodos["lon"] = latlon[:, 1].tolist()
+    columnas_nodos["x_proj"] = [n[0] for n in nodos]
+    columnas_nodos["y_proj"] = [n[1] for n in nodos]
+    columnas_nodos["dijkstra"] = [dijkstra.get(n) for n in nodos] if dijkstra else [None] * len(nodos)
+    columnas_nodos["bellman"] = [bellman.get(n) for n in nodos] if bellman else [None] * len(nodos)
+    columnas_nodos.update(erg.columnas_tramos(G))
+    columnas_nodos["componente"] = erg.etiquetas_componentes(G).tolist()
+    columnas_nodos["kmeans"] = np.asarray(erg.clusters_nodos(G)).tolist()
+    niveles = overlay.niveles_de(G) if overlay is not None else erg.niveles_gases(G)
+    for gas_attr in erg.GAS_ATTRS:
+        columnas_nodos[gas_attr] = np.asarray(niveles[gas_attr]).tolist()
+
+    if 'aristas_origen' in G.graph:
+        columnas_aristas = {
+            "source": np.asarray(G.graph['aristas_origen']).tolist(),
+            "target": np.asarray(G.graph['aristas_destino']).tolist(),
+            "weight": np.asarray(G.graph['aristas_peso']).tolist(),
+        }
+    else:
+        posicion = {n: i for i, n in enumerate(G.nodes())}
+        columnas_aristas = {"source": [], "target": [], "weight": []}
+        for u, v, data in G.edges(data=True):
+            columnas_aristas["source"].append(posicion[u])
+            columnas_aristas["target"].append(posicion[v])
+            columnas_aristas["weight"].append(float(data['weight']))
+    return columnas_nodos, columnas_aristas
+
+
+def parsear_bbox(texto, nombre='bbox'):
+    """Convierte 'min_lon,min_lat,max_lon,max_lat' en una tupla de floats (o None si no se indicó)."""
+    if not texto:
+        return None
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in texto.split(','))
+    except ValueError:
+        raise ValueError(f"El parámetro '{nombre}' debe ser 'min_lon,min_lat,max_lon,max_lat'.")
+    return min_lon, min_lat, max_lon, max_lat
+
+
+MAX_FILAS_CARGA = 50000 # Tope de max_rows pedible por query string
+FILAS_CARGA_PREDETERMINADAS = 300
+
+
+def leer_parametros_carga():
+    """
+    Lee de la query string qué tramos cargar: max_rows y, opcionalmente, una región
+    (region_bbox='min_lon,min_lat,max_lon,max_lat', region_poligono=WKT en EPSG:4326 o
+    region_radio='lon,lat,metros'). La región se filtra en PostGIS (ver erg.cargar_tramos_gas)
+    y forma parte de la clave de la caché de snapshots. Devuelve (parametros, None) o (None, mensaje de error).
+    """
+    try:
+        max_rows = int(request.args.get('max_rows', FILAS_CARGA_PREDETERMINADAS))
+    except ValueError:
+        return None, "El parámetro 'max_rows' debe ser un entero."
+    if not 0 < max_rows <= MAX_FILAS_CARGA:
+        return None, f"El parámetro 'max_rows' debe estar entre 1 y {MAX_FILAS_CARGA}."
+    parametros = {'max_rows': max_rows}
+
+    try:
+        region_bbox = parsear_bbox(request.args.get('region_bbox'), nombre='region_bbox')
+    except ValueError as e:
+        return None, str(e)
+    if region_bbox is not None:
+        parametros['region_bbox'] = region_bbox
+
+    region_poligono = request.args.get('region_poligono')
+    if region_poligono:
+        import shapely
+        try:
+            poligono = shapely.from_wkt(region_poligono)
+        except shapely.errors.GEOSException:
+            poligono = None
+        if poligono is None or poligono.geom_type not in ('Polygon', 'MultiPolygon') or poligono.is_empty:
+            return None, "El parámetro 'region_poligono' debe ser un POLYGON o MULTIPOLYGON en WKT (EPSG:4326)."
+        parametros['region_poligono'] = poligono.wkt
+
+    region_radio = request.args.get('region_radio')
+    if region_radio:
+        try:
+            lon, lat, metros = (float(v) for v in region_radio.split(','))
+        except ValueError:
+            return None, "El parámetro 'region_radio' debe ser 'lon,lat,metros'."
+        if metros <= 0:
+            return None, "El radio de 'region_radio' debe ser positivo."
+        parametros['region_radio'] = (lon, lat, metros)
+    return parametros, None
+
+
+def filtros_region(parametros):
+    """Argumentos de región de erg.cargar_tramos_gas / erg.cargar_cambios_tramos a partir de los parámetros."""
+    return {
+        'bbox': parametros.get('region_bbox'),
+        'poligono': parametros.get('region_poligono'),
+        'radio': parametros.get('region_radio'),
+    }
+
+
+def filtrar_columnas_bbox(columnas_nodos, columnas_aristas, bbox):
+    """
+    Recorta las columnas a los nodos dentro de bbox y a las aristas que tocan bbox.
+    Los nodos fuera de bbox que son extremo de una arista incluida también se devuelven,
+    y los índices de las aristas se renumeran a las nuevas posiciones.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    lat = np.array(columnas_nodos["lat"], dtype=float)
+    lon = np.array(columnas_nodos["lon"], dtype=float)
+    dentro = (lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)
+
+    source = np.array(columnas_aristas["source"], dtype=np.int64)
+    target = np.array(columnas_aristas["target"], dtype=np.int64)
+    aristas_dentro = np.flatnonzero(dentro[source] | dentro[target]) if len(source) else np.array([], dtype=np.int64)
+    dentro[source[aristas_dentro]] = True
+    dentro[target[aristas_dentro]] = True
+
+    seleccion = np.flatnonzero(dentro)
+    nueva_posicion = np.full(len(dentro), -1, dtype=np.int64)
+    nueva_posicion[seleccion] = np.arange(len(seleccion))
+
+    nodos = {columna: [valores[i] for i in seleccion] for columna, valores in columnas_nodos.items()}
+    aristas = {
+        "source": nueva_posicion[source[aristas_dentro]].tolist(),
+        "target": nueva_posicion[target[aristas_dentro]].tolist(),
+        "weight": [columnas_aristas["weight"][i] for i in aristas_dentro],
+    }
+    return nodos, aristas
+
+
+def columnas_a_filas(columnas):
+    """Convierte {'col': [...]} en una lista de dicts (formato 'completo')."""
+    nombres = list(columnas)
+    return [dict(zip(nombres, fila)) for fila in zip(*columnas.values())]
+
+
+def aristas_a_filas(columnas_nodos, columnas_aristas):
+    """Aristas en el formato 'completo': IDs string y coordenadas geográficas de ambos extremos."""
+    ids, lats, lons = columnas_nodos["id"], columnas_nodos["lat"], columnas_nodos["lon"]
+    return [
+        {
+            "source": ids[u],
+            "target": ids[v],
+            "source_lat": lats[u], 
+            "source_lon": lons[u],
+            "target_lat": lats[v],
+            "target_lon": lons[v],
+            "weight": weight,
+        }
+        for u, v, weight in zip(columnas_aristas["source"], columnas_aristas["target"], columnas_aristas["weight"])
+    ]
+
+
+def generar_ndjson(columnas_nodos, columnas_aristas, meta, tamano_bloque):
+    """
+    Genera la respuesta NDJSON: una línea 'meta' con los totales, luego bloques de nodos
+    y bloques de aristas en formato columnar. Los índices de las aristas son posiciones globales de nodos.
+    """
+    total_nodos = len(columnas_nodos["id"])
+    total_aristas = len(columnas_aristas["source"])
+    yield json.dumps(dict(meta, tipo="meta", total_nodes=total_nodos, total_edges=total_aristas), separators=(',', ':')) + "\n"
+    for inicio in range(0, total_nodos, tamano_bloque):
+        bloque = {columna: valores[inicio:inicio + tamano_bloque] for columna, valores in columnas_nodos.items()}
+        yield json.dumps({"tipo": "nodes", "inicio": inicio, "datos": bloque}, separators=(',', ':')) + "\n"
+    for inicio in range(0, total_aristas, tamano_bloque):
+        bloque = {columna: valores[inicio:inicio + tamano_bloque] for columna, valores in columnas_aristas.items()}
+        yield json.dumps({"tipo": "edges", "inicio": inicio, "datos": bloque}, separators=(',', ':')) + "\n"
+    yield json.dumps({"tipo": "fin"}) + "\n"
+
+
+def responder_json(payload, status=200):
+    """Serializa payload a JSON compacto y lo comprime con gzip si el cliente lo acepta."""
+    return responder_cuerpo_json(json.dumps(payload, separators=(',', ':')).encode('utf-8'), status)
+
+
+def responder_cuerpo_json(cuerpo, status=200, mimetype='application/json'):
+    """Devuelve un cuerpo JSON ya serializado (bytes), comprimido con gzip si el cliente lo acepta."""
+    respuesta = Response(cuerpo, status=status, mimetype=mimetype)
+    if 'gzip' in request.headers.get('Accept-Encoding', '') and len(cuerpo) > 1024:
+        respuesta.set_data(gzip.compress(cuerpo, compresslevel=5))
+        respuesta.headers['Content-Encoding'] = 'gzip'
+        respuesta.headers['Vary'] = 'Accept-Encoding'
+    return respuesta
+
+
+def ejecutar_analisis(parametros, analisis_pedidos, logprint):
+    """
+    Obtiene el snapshot (de la caché o construyéndolo), calcula los análisis pedidos
+    y publica el grafo en las variables globales. Devuelve un dict con los resultados.
+    """
+    # Solo se consulta la versión de la tabla; el grafo y los algoritmos salen de la caché
+    version = erg.obtener_version_tramos(logprint)
+    construidos = []
+    def constructor(version, parametros, logprint, base):
+        # Si ya hay un snapshot precompilado en disco para esta versión y parámetros (de otro worker
+        # o de una ejecución anterior), se carga con mmap en lugar de reconstruirlo desde PostGIS
+        nombre = snapshot_compartido.buscar_snapshot(version, parametros)
+        if nombre is not None:
+            if version is None:
+                logprint("   Versión de 'tramos_gas' desconocida. Usando el snapshot precompilado más reciente.")
+            snapshot = adjuntar_snapshot_compartido(logprint, nombre=nombre)
+            if snapshot is not None:
+                return snapshot
+        construidos.append(version)
+        # Si solo cambiaron algunos tramos (importación incremental), se actualiza el snapshot anterior
+        snapshot = actualizar_snapshot(base, version, parametros, logprint)
+        if snapshot is not None:
+            return snapshot
+        return construir_snapshot(version, parametros, logprint)
+    with metricas.medir_etapa('obtener_snapshot', logprint):
+        snapshot = SNAPSHOT_CACHE.obtener(version, parametros, constructor, logprint)
+    if not construidos:
+        # Snapshot en caché: incluir el log de la construcción original para la bitácora
+        logprint("")
+        for msg in snapshot.log:
+            logprint(msg)
+
+    # Análisis pedidos (ej. ?analyses=dijkstra,mst,kmeans); se memoizan en el snapshot
+    resultado = resultados_analisis(snapshot, analisis_pedidos, logprint)
+
+    # === Publicar el snapshot (intercambio atómico de una sola referencia) ===
+    # Se publica para los demás workers. Si venía de la caché y otro worker publicó otro snapshot
+    # después, se vuelve a marcar como el actual para que todos sirvan el último análisis pedido.
+    if snapshot.nombre_compartido is None or snapshot.nombre_compartido != snapshot_compartido.nombre_publicado():
+        with metricas.medir_etapa('publicar_snapshot', logprint):
+            snapshot_compartido.publicar_snapshot(snapshot, logprint)
+    global GLOBAL_SNAPSHOT
+    GLOBAL_SNAPSHOT = snapshot
+
+    return resultado
+
+
+def resultados_analisis(snapshot, analisis_pedidos, logprint):
+    """Calcula (o toma de la memoización del snapshot) los análisis pedidos. Devuelve el dict de resultados."""
+    dijkstra = {}
+    bellman = {}
+    mst_weight = None
+    if snapshot.resultados.get('nodo_inicial') is not None:
+        if 'dijkstra' in analisis_pedidos:
+            dijkstra = snapshot.analisis('dijkstra', logprint)
+        if 'bellman_ford' in analisis_pedidos:
+            bellman = snapshot.analisis('bellman_ford', logprint)
+        if 'mst' in analisis_pedidos:
+            mst_weight = snapshot.analisis('mst', logprint)[1]
+    return {
+        "snapshot": snapshot,
+        "analyses": analisis_pedidos,
+        "dijkstra": dijkstra,
+        "bellman": bellman,
+        "mst_weight": mst_weight,
+    }
+
+
+def resumir_resultado_trabajo(resultado, parametros):
+    """
+    Lo que guarda un trabajo terminado: la clave del snapshot (versión, parámetros y nombre compartido)
+    y los análisis pedidos, sin referencias al snapshot. Así un trabajo no retiene el grafo, el CSR
+    ni el índice espacial después de que CacheSnapshots los descartó.
+    """
+    snapshot = resultado["snapshot"]
+    return {
+        "version": snapshot.version,
+        "parametros": parametros,
+        "nombre_compartido": snapshot.nombre_compartido,
+        "analyses": resultado["analyses"],
+    }
+
+
+def recuperar_resultado_trabajo(resumen, logprint):
+    """
+    Vuelve a armar el resultado de un trabajo a partir de su resumen: busca el snapshot en la caché
+    (o lo adjunta desde el snapshot compartido con ese nombre) y toma los análisis memoizados.
+    Devuelve None si el snapshot ya no está disponible.
+    """
+    snapshot = SNAPSHOT_CACHE.buscar(resumen["version"], resumen["parametros"])
+    if snapshot is None and resumen["nombre_compartido"] is not None:
+        actual = GLOBAL_SNAPSHOT # Leer la referencia una sola vez
+        if actual is not None and actual.nombre_compartido == resumen["nombre_compartido"]:
+            snapshot = actual
+        else:
+            snapshot = adjuntar_snapshot_compartido(logprint, nombre=resumen["nombre_compartido"])
+    if snapshot is None:
+        return None
+    return resultados_analisis(snapshot, resumen["analyses"], logprint)
+
+
+def leer_opciones_respuesta():
+    """
+    Lee formato, bbox, chunk y scenario_id de la query string. Devuelve (opciones, None) o
+    (None, respuesta de error 400).
+    """
+    formato = request.args.get('formato', 'completo')
+    if formato not in FORMATOS_ANALISIS:
+        return None, (jsonify({"nodes": [], "edges": [], "mst_weight": 0, "log": [f"Formato desconocido: '{formato}'. Disponibles: {', '.join(FORMATOS_ANALISIS)}."]}), 400)
+    try:
+        bbox = parsear_bbox(request.args.get('bbox'))
+    except ValueError as e:
+        return None, (jsonify({"nodes": [], "edges": [], "mst_weight": 0, "log": [str(e)]}), 400)
+    try:
+        tamano_bloque = max(1, int(request.args.get('chunk', 5000)))
+    except ValueError:
+        tamano_bloque = 5000
+    escenario = request.args.get('scenario_id', 'default')
+    return {"formato": formato, "bbox": bbox, "tamano_bloque": tamano_bloque, "escenario": escenario}, None
+
+
+def responder_analisis(resultado, log, opciones):
+    """Arma la respuesta de /api/analisis en el formato pedido a partir del resultado de ejecutar_analisis."""
+    snapshot = resultado["snapshot"]
+    mst_weight = resultado["mst_weight"]
+
+    # 7. Preparar los datos de nodos y aristas para el frontend, en columnas (una lista por atributo)
+    overlay = obtener_escenario(snapshot, opciones["escenario"], crear=False)
+    with metricas.medir_etapa('columnas_respuesta', log.append):
+        columnas_nodos, columnas_aristas = preparar_columnas_grafo(snapshot.vista, resultado["dijkstra"], resultado["bellman"], overlay)
+    if opciones["bbox"] is not None:
+        columnas_nodos, columnas_aristas = filtrar_columnas_bbox(columnas_nodos, columnas_aristas, opciones["bbox"])
+        log.append(f"   Filtro bbox aplicado: {len(columnas_nodos['id'])} nodos, {len(columnas_aristas['source'])} aristas.")
+
+    meta = {
+        "mst_weight": round(mst_weight, 3) if mst_weight is not None else None, 
+        "analyses": list(resultado["analyses"]),
+        "componentes": snapshot.resultados.get('componentes'),
+        "log": log 
+    }
+
+    if opciones["formato"] == 'ndjson':
+        # Respuesta por bloques: el mapa puede dibujar cada bloque de nodos apenas llega
+        return Response(generar_ndjson(columnas_nodos, columnas_aristas, meta, opciones["tamano_bloque"]), mimetype='application/x-ndjson')
+
+    if opciones["formato"] == 'columnar':
+        # Aristas con índices enteros que apuntan a las posiciones de los arreglos de nodos
+        payload = {"formato": "columnar", "nodes": columnas_nodos, "edges": columnas_aristas}
+    else:
+        with metricas.medir_etapa('filas_respuesta', log.append):
+            payload = {"nodes": columnas_a_filas(columnas_nodos), "edges": aristas_a_filas(columnas_nodos, columnas_aristas)}
+    payload.update(meta)
+    # La serialización se mide sin log: el log ya forma parte del cuerpo que se está serializando
+    with metricas.medir_etapa('serializacion_json'):
+        return responder_json(payload)
+
+
 @app.route('/api/analisis')
 def api_analisis():
     print("LLEGA AL ENDPOINT /api/analisis") 
@@ -53,165 +722,19 @@ def api_analisis():
             log.append(msg)
             print(msg)
 
-        max_rows_for_display = 300 
-
-        gdf_gas = erg.cargar_tramos_gas(logprint, max_rows=max_rows_for_display) 
-        if gdf_gas.empty:
-            raise ValueError("No se cargaron tramos de gas válidos desde la base de datos.")
-        
-        gdf_gas_proj = gdf_gas.to_crs(CRS_PROJECTED)
-        logprint(f"   Geometrías proyectadas a {CRS_PROJECTED} para cálculos métricos precisos.")
-        log.append("")
-
-        G = erg.construir_grafo_red(gdf_gas, gdf_gas_proj, logprint)
-        if G.number_of_nodes() == 0:
-            raise ValueError("No se pudo construir un grafo con nodos válidos.")
-        log.append("")
-
-        # === Actualizar variables globales del grafo y mapeos ===
-        global GLOBAL_GRAPH
-        global GLOBAL_NODE_ID_STRING_TO_ROUNDED_PROJ_COORD 
-        global GLOBAL_ROUNDED_PROJ_COORD_TO_ACTUAL_PROJ_COORD 
-        global GLOBAL_ACTUAL_PROJ_COORD_TO_GEO_COORD 
-
-        GLOBAL_GRAPH = G
-        GLOBAL_NODE_ID_STRING_TO_ROUNDED_PROJ_COORD = {} 
-        GLOBAL_ROUNDED_PROJ_COORD_TO_ACTUAL_PROJ_COORD = {} 
-        GLOBAL_ACTUAL_PROJ_COORD_TO_GEO_COORD = {} 
-
-        # Llenar los mapeos globales directamente desde los nodos del grafo real
-        for actual_proj_coord_tuple in G.nodes(): # Estos son los nodos EXACTOS del grafo
-            # Redondear para la creación del ID string y para el mapeo intermedio
-            rounded_proj_coord_tuple = (round(actual_proj_coord_tuple[0], 6), round(actual_proj_coord_tuple[1], 6))
-            node_id_str = f"{rounded_proj_coord_tuple[0]:.6f}_{rounded_proj_coord_tuple[1]:.6f}".replace('.', '_').replace('-', 'minus') 
-
-            # Mapear el ID string al nodo redondeado (para búsqueda desde el frontend)
-            GLOBAL_NODE_ID_STRING_TO_ROUNDED_PROJ_COORD[node_id_str] = rounded_proj_coord_tuple
-            # Mapear el nodo redondeado al nodo real del grafo (para usarlo en NetworkX)
-            GLOBAL_ROUNDED_PROJ_COORD_TO_ACTUAL_PROJ_COORD[rounded_proj_coord_tuple] = actual_proj_coord_tuple
-            
-            # Mapear el nodo real del grafo a sus coordenadas geográficas (para Leaflet)
-            lon_geo_temp, lat_geo_temp = transformer_proj_to_geo.transform(actual_proj_coord_tuple[0], actual_proj_coord_tuple[1])
-            GLOBAL_ACTUAL_PROJ_COORD_TO_GEO_COORD[actual_proj_coord_tuple] = (lat_geo_temp, lon_geo_temp)
-
-
-        # 4. Definir y encontrar el nodo inicial más cercano (ej. centro de Lima)
-        center_lon_geo, center_lat_geo = -77.0428, -12.0464 
-        center_x_proj, center_y_proj = transformer_geo_to_proj.transform(center_lon_geo, center_lat_geo)
-        center_point_proj = (center_x_proj, center_y_proj)
-
-        nodo_inicial = erg.encontrar_nodo_inicial(G, center_point_proj, logprint)
-        if nodo_inicial is None:
-            log.append("   Advertencia: No se encontró un nodo inicial cercano para los algoritmos. El grafo puede estar vacío o muy disperso.")
-            dijkstra = {}
-            bellman = {}
-            mst_graph = nx.Graph()
-            mst_weight = 0
-            kmeans_labels = [] 
-        else:
-            # 5. Ejecutar algoritmos de grafos
-            dijkstra = erg.ejecutar_dijkstra(G, nodo_inicial, logprint)
-            bellman = erg.ejecutar_bellman_ford(G, nodo_inicial, logprint)
-            mst_graph, mst_weight = erg.calcular_mst(G, logprint)
-            kmeans_labels = erg.ejecutar_kmeans(list(G.nodes()), logprint)
-        
-        log.append("")
-
-        # 6. Preparar propiedades adicionales para los nodos del frontend (gases, codtramo, longitud)
-        # Esto se hace iterando sobre gdf_gas_proj para obtener CODTRAMO y longitud
-        # y generar los gases simulados en base a los KMeans (si aplica).
-        # Usaremos el nodo REAL (no redondeado) como clave aquí.
-        
-        # Primero, asignar los niveles de gases simulados y otros atributos a los nodos del GLOBAL_GRAPH
-        for i, actual_proj_coord_tuple in enumerate(G.nodes()):
-            node_kmeans_label = -1 
-            if i < len(kmeans_labels):
-                node_kmeans_label = int(kmeans_labels[i])
-
-            base_co2 = 50 + node_kmeans_label * 10 if node_kmeans_label != -1 else 50 
-            base_ch4 = 10 + node_kmeans_label * 2 if node_kmeans_label != -1 else 10 
-            base_nox = 5 + node_kmeans_label * 1 if node_kmeans_label != -1 else 5 
-
-            # Asignar niveles de gases al nodo directamente en el GLOBAL_GRAPH
-            G.nodes[actual_proj_coord_tuple]['co2_level'] = round(max(0, base_co2 + random.uniform(-10, 10)), 2)
-            G.nodes[actual_proj_coord_tuple]['ch4_level'] = round(max(0, base_ch4 + random.uniform(-3, 3)), 2)
-            G.nodes[actual_proj_coord_tuple]['nox_level'] = round(max(0, base_nox + random.uniform(-1, 1)), 2)
-            G.nodes[actual_proj_coord_tuple]['kmeans'] = node_kmeans_label # Asignar KMeans al nodo
-            G.nodes[actual_proj_coord_tuple]['dijkstra'] = dijkstra.get(actual_proj_coord_tuple, None)
-            G.nodes[actual_proj_coord_tuple]['bellman'] = bellman.get(actual_proj_coord_tuple, None)
-            
-            # Asignar CODTRAMO y LONGITUD (esto es una simplificación, ya que un nodo puede ser parte de varios tramos)
-            # Podrías necesitar una lógica más sofisticada si un nodo tiene múltiples CODTRAMO/LONGITUD
-            # Por ahora, buscamos el primer tramo que contenga este nodo para obtener su CODTRAMO y LONGITUD
-            found_tramo_props = False
-            for _, row_proj in gdf_gas_proj.iterrows():
-                line_proj = row_proj['geometry']
-                if line_proj.geom_type == 'LineString':
-                    if (actual_proj_coord_tuple == line_proj.coords[0] or
-                        actual_proj_coord_tuple == line_proj.coords[-1]):
-                        G.nodes[actual_proj_coord_tuple]['codtramo'] = str(row_proj["CODTRAMO"]) if "CODTRAMO" in row_proj else ""
-                        G.nodes[actual_proj_coord_tuple]['longitud'] = float(row_proj["LONGITUD"]) if "LONGITUD" in row_proj else None
-                        found_tramo_props = True
-                        break # Si ya encontramos las propiedades, salimos del bucle interno
-
-            if not found_tramo_props:
-                G.nodes[actual_proj_coord_tuple]['codtramo'] = "N/A"
-                G.nodes[actual_proj_coord_tuple]['longitud'] = None
-
-
-        # 7. Preparar los datos de nodos para el frontend
-        nodes_for_frontend = []
-        for actual_proj_coord_tuple in G.nodes(): # Iterar sobre los nodos REALES del grafo
-            rounded_proj_coord_tuple = (round(actual_proj_coord_tuple[0], 6), round(actual_proj_coord_tuple[1], 6))
-            
-            # Obtener las coordenadas geográficas del mapeo global
-            lat_geo, lon_geo = GLOBAL_ACTUAL_PROJ_COORD_TO_GEO_COORD.get(actual_proj_coord_tuple, (None, None)) 
-
-            node_attrs = G.nodes[actual_proj_coord_tuple] # Obtener los atributos del nodo directamente del grafo
-
-            nodes_for_frontend.append({
-                # El ID del nodo para el frontend sigue siendo el string de las coordenadas proyectadas redondeadas
-                "id": f"{rounded_proj_coord_tuple[0]:.6f}_{rounded_proj_coord_tuple[1]:.6f}".replace('.', '_').replace('-', 'minus'),
-                "lat": lat_geo, 
-                "lon": lon_geo,
-                "x_proj": actual_proj_coord_tuple[0], # Coordenadas X, Y reales (sin redondear) del nodo del grafo
-                "y_proj": actual_proj_coord_tuple[1],
-                "kmeans": node_attrs.get("kmeans", -1), 
-                "dijkstra": node_attrs.get("dijkstra", None),
-                "bellman": node_attrs.get("bellman", None),
-                "codtramo": node_attrs.get("codtramo", "N/A"), 
-                "longitud": node_attrs.get("longitud", None), 
-                "co2_level": node_attrs.get("co2_level", 0), 
-                "ch4_level": node_attrs.get("ch4_level", 0),
-                "nox_level": node_attrs.get("nox_level", 0),
-            })
-        
-        edges_for_frontend = []
-        for u, v in G.edges():
-            lat_u, lon_u = GLOBAL_ACTUAL_PROJ_COORD_TO_GEO_COORD.get(u, (None, None))
-            lat_v, lon_v = GLOBAL_ACTUAL_PROJ_COORD_TO_GEO_COORD.get(v, (None, None))
-
-            # Los 'source' y 'target' de las aristas usan los IDs (coordenadas proyectadas redondeadas)
-            # para que coincidan con los IDs de los nodos.
-            rounded_u_id = (round(u[0], 6), round(u[1], 6))
-            rounded_v_id = (round(v[0], 6), round(v[1], 6))
-
-            edges_for_frontend.append({
-                "source": f"{rounded_u_id[0]:.6f}_{rounded_u_id[1]:.6f}".replace('.', '_').replace('-', 'minus'),
-                "target": f"{rounded_v_id[0]:.6f}_{rounded_v_id[1]:.6f}".replace('.', '_').replace('-', 'minus'),
-                "source_lat": lat_u, 
-                "source_lon": lon_u,
-                "target_lat": lat_v,
-                "target_lon": lon_v,
-                "weight": float(G[u][v]['weight']) 
-            })
+        parametros, error = leer_parametros_carga()
+        if error is not None:
+            return jsonify({"nodes": [], "edges": [], "mst_weight": 0, "log": [error]}), 400
+        try:
+            analisis_pedidos = erg.parsear_analisis(request.args.get('analyses', ''))
+        except ValueError as e:
+            return jsonify({"nodes": [], "edges": [], "mst_weight": 0, "log": [str(e)]}), 400
+        opciones, error = leer_opciones_respuesta()
+        if error is not None:
+            return error
 
-        return jsonify({
-            "nodes": nodes_for_frontend,
-            "edges": edges_for_frontend,
-            "mst_weight": round(mst_weight, 3), 
-            "log": log 
-        })
+        resultado = ejecutar_analisis(parametros, analisis_pedidos, logprint)
+        return responder_analisis(resultado, log, opciones)
     except Exception as e:
         import traceback
         tb = traceback.format_exc()
@@ -221,10 +744,88 @@ def api_analisis():
         return jsonify({"nodes": [], "edges": [], "mst_weight": 0, "log": log}), 500
 
 
+# === Análisis como trabajos en segundo plano ===
+# POST crea (o reutiliza) un trabajo; GET consulta el progreso (o lo transmite como SSE con ?stream=1)
+# y /resultado devuelve la misma respuesta que /api/analisis cuando el trabajo terminó.
+GESTOR_TRABAJOS = GestorTrabajos(max_workers=2)
+
+
+@app.route('/api/analisis/trabajos', methods=['POST'])
+def crear_trabajo_analisis_api():
+    parametros, error = leer_parametros_carga()
+    if error is not None:
+        return jsonify({"message": error}), 400
+    try:
+        analisis_pedidos = erg.parsear_analisis(request.args.get('analyses', ''))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    clave = (tuple(sorted(parametros.items())), tuple(sorted(analisis_pedidos)))
+    trabajo, nuevo = GESTOR_TRABAJOS.enviar(
+        clave, lambda logprint: resumir_resultado_trabajo(ejecutar_analisis(parametros, analisis_pedidos, logprint), parametros))
+    respuesta = trabajo.a_dict()
+    respuesta["nuevo"] = nuevo
+    return jsonify(respuesta), 202
+
+
+@app.route('/api/analisis/trabajos/<job_id>')
+def estado_trabajo_analisis_api(job_id):
+    trabajo = GESTOR_TRABAJOS.obtener(job_id)
+    if trabajo is None:
+        return jsonify({"message": f"Trabajo '{job_id}' no encontrado."}), 404
+    try:
+        desde = max(0, int(request.args.get('desde', 0)))
+    except ValueError:
+        desde = 0
+
+    if request.args.get('stream') == '1' or 'text/event-stream' in request.headers.get('Accept', ''):
+        def eventos():
+            enviados = desde
+            while True:
+                nuevos, terminado = trabajo.esperar_cambios(enviados, timeout=15)
+                for msg in nuevos:
+                    yield f"event: log\ndata: {json.dumps(msg)}\n\n"
+                enviados += len(nuevos)
+                if terminado and not nuevos:
+                    yield f"event: estado\ndata: {json.dumps(trabajo.a_dict(desde=enviados))}\n\n"
+                    return
+                if not nuevos:
+                    yield ": keep-alive\n\n"
+        return Response(eventos(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    return jsonify(trabajo.a_dict(desde=desde)), 200
+
+
+@app.route('/api/analisis/trabajos/<job_id>/resultado')
+def resultado_trabajo_analisis_api(job_id):
+    trabajo = GESTOR_TRABAJOS.obtener(job_id)
+    if trabajo is None:
+        return jsonify({"message": f"Trabajo '{job_id}' no encontrado."}), 404
+    if not trabajo.terminado:
+        return jsonify(trabajo.a_dict()), 202
+    if trabajo.estado == ERROR:
+        return jsonify({"nodes": [], "edges": [], "mst_weight": 0, "log": list(trabajo.log)}), 500
+
+    opciones, error = leer_opciones_respuesta()
+    if error is not None:
+        return error
+    try:
+        log = list(trabajo.log)
+        resultado = recuperar_resultado_trabajo(trabajo.resultado, log.append)
+        if resultado is None:
+            return jsonify({"message": f"El grafo del trabajo '{job_id}' ya no está en caché. Vuelve a enviar el análisis."}), 410
+        return responder_analisis(resultado, log, opciones)
+    except Exception as e:
+        app.logger.error(f"Error armando el resultado del trabajo {job_id}: {e}", exc_info=True)
+        return jsonify({"nodes": [], "edges": [], "mst_weight": 0, "log": list(trabajo.log) + ["ERROR: " + str(e)]}), 500
+
+
 @app.route('/api/ruta-optima', methods=['POST'])
 def calculate_optimal_route_api():
-    if GLOBAL_GRAPH is None:
+    snapshot = obtener_snapshot_publicado() # Leer la referencia una sola vez
+    if snapshot is None:
         return jsonify({"message": "El grafo no ha sido cargado. Por favor, carga el grafo primero."}), 503
+    G = snapshot.vista
 
     data = request.get_json()
     origin_id_str = data.get('origin_id') 
@@ -236,44 +837,34 @@ def calculate_optimal_route_api():
     print(f"Solicitud de ruta óptima: Origen='{origin_id_str}', Destino='{destination_id_str}'")
 
     try:
-        # Obtener las coordenadas PROYECTADAS REDONDEADAS del ID string del frontend
-        rounded_origin_proj_coord = GLOBAL_NODE_ID_STRING_TO_ROUNDED_PROJ_COORD.get(origin_id_str.strip()) # .strip() para eliminar espacios
-        rounded_destination_proj_coord = GLOBAL_NODE_ID_STRING_TO_ROUNDED_PROJ_COORD.get(destination_id_str.strip()) # .strip()
+        # Obtener las coordenadas EXACTAS del grafo a partir del ID string del frontend (.strip() para eliminar espacios)
+        actual_origin_proj_coord = resolver_nodo(snapshot, origin_id_str)
+        actual_destination_proj_coord = resolver_nodo(snapshot, destination_id_str)
 
-        if rounded_origin_proj_coord is None:
+        if actual_origin_proj_coord is None:
              return jsonify({"message": f"Nodo de origen con ID '{origin_id_str.strip()}' no encontrado. Posible error en el ID."}), 404
-        if rounded_destination_proj_coord is None:
+        if actual_destination_proj_coord is None:
              return jsonify({"message": f"Nodo de destino con ID '{destination_id_str.strip()}' no encontrado. Posible error en el ID."}), 404
 
-        # Ahora, obtener las coordenadas EXACTAS del grafo a partir de las redondeadas
-        actual_origin_proj_coord = GLOBAL_ROUNDED_PROJ_COORD_TO_ACTUAL_PROJ_COORD.get(rounded_origin_proj_coord)
-        actual_destination_proj_coord = GLOBAL_ROUNDED_PROJ_COORD_TO_ACTUAL_PROJ_COORD.get(rounded_destination_proj_coord)
-
-        if actual_origin_proj_coord is None or actual_origin_proj_coord not in GLOBAL_GRAPH.nodes:
-            return jsonify({"message": f"Nodo de origen '{origin_id_str.strip()}' no es un nodo válido en el grafo (problema de mapeo interno)."}), 404
-        if actual_destination_proj_coord is None or actual_destination_proj_coord not in GLOBAL_GRAPH.nodes:
-            return jsonify({"message": f"Nodo de destino '{destination_id_str.strip()}' no es un nodo válido en el grafo (problema de mapeo interno)."}), 404
-
+        import networkx as nx # Solo para su excepción NetworkXNoPath (ver erg.calcular_ruta_optima)
         try:
             # === Intenta calcular la ruta a través de la red (Dijkstra) usando los nodos REALES del grafo ===
-            path_proj = nx.shortest_path(GLOBAL_GRAPH, source=actual_origin_proj_coord, target=actual_destination_proj_coord, weight='weight')
+            # El motor ('csr' o 'networkx') se puede elegir por petición
+            motor = data.get('motor', erg.MOTOR_GRAFO_PREDETERMINADO)
+            if motor not in ('csr', 'networkx'):
+                return jsonify({"message": f"Motor de grafos desconocido: '{motor}'. Usa 'csr' o 'networkx'."}), 400
+            algoritmo = data.get('algoritmo', erg.ALGORITMO_RUTA_PREDETERMINADO)
+            if algoritmo not in erg.ALGORITMOS_RUTA:
+                return jsonify({"message": f"Algoritmo de ruta desconocido: '{algoritmo}'. Usa {', '.join(erg.ALGORITMOS_RUTA)}."}), 400
+            path_proj, total_distance_network = erg.calcular_ruta_optima(snapshot.grafo_para(motor), actual_origin_proj_coord, actual_destination_proj_coord, motor=motor, algoritmo=algoritmo)
             
-            total_distance_network = 0
-            path_geo = [] 
-            for i in range(len(path_proj)): 
-                current_actual_proj_node = path_proj[i]
-                
-                if i < len(path_proj) - 1:
-                    next_actual_proj_node = path_proj[i+1]
-                    if GLOBAL_GRAPH.has_edge(current_actual_proj_node, next_actual_proj_node):
-                        total_distance_network += GLOBAL_GRAPH[current_actual_proj_node][next_actual_proj_node]['weight']
-                
-                # Convertir coordenadas reales a geográficas para el frontend
-                if current_actual_proj_node in GLOBAL_ACTUAL_PROJ_COORD_TO_GEO_COORD:
-                    path_geo.append(list(GLOBAL_ACTUAL_PROJ_COORD_TO_GEO_COORD[current_actual_proj_node]))
-                else:
-                    lon_curr, lat_curr = transformer_proj_to_geo.transform(current_actual_proj_node[0], current_actual_proj_node[1])
-                    path_geo.append([lat_curr, lon_curr])
+            # Convertir coordenadas reales a geográficas para el frontend: los nodos del grafo ya
+            # tienen sus coordenadas precalculadas; los que falten se convierten en una sola llamada
+            posiciones = erg.indices_de_nodos(G, path_proj) if path_proj else np.zeros(0, dtype=np.int64)
+            path_geo = np.asarray(erg.coordenadas_geograficas(G))[np.maximum(posiciones, 0)]
+            if (posiciones < 0).any():
+                path_geo[posiciones < 0] = erg.proyectadas_a_geograficas([path_proj[i] for i in np.flatnonzero(posiciones < 0)])
+            path_geo = path_geo.tolist()
             
             return jsonify({
                 "path": path_geo, 
@@ -304,39 +895,197 @@ def calculate_optimal_route_api():
         traceback.print_exc()
         return jsonify({"message": f"Error interno del servidor: {str(e)}"}), 500
 
+# Límite de nodos por lado en /api/matriz-distancias
+MAX_NODOS_MATRIZ = 1000
+
+
+def resolver_nodo(snapshot, node_id_str):
+    """Devuelve la tupla proyectada REAL del grafo para un ID string del frontend, o None si no existe."""
+    idx = indice_nodo_por_id(snapshot, node_id_str)
+    return snapshot.vista.graph['indice_espacial'].nodo(idx) if idx is not None else None
+
+
+@app.route('/api/matriz-distancias', methods=['POST'])
+def matriz_distancias_api():
+    """
+    Matriz origen-destino de distancias por la red (km) entre listas de nodos.
+    Body: {"origin_ids": [...], "destination_ids": [...]}. Los pares sin camino devuelven null.
+    """
+    snapshot = obtener_snapshot_publicado() # Leer la referencia una sola vez
+    if snapshot is None:
+        return jsonify({"message": "El grafo no ha sido cargado. Por favor, carga el grafo primero."}), 503
+
+    data = request.get_json() or {}
+    origin_ids = data.get('origin_ids') or []
+    destination_ids = data.get('destination_ids') or []
+    if not isinstance(origin_ids, list) or not isinstance(destination_ids, list) or not origin_ids or not destination_ids:
+        return jsonify({"message": "Listas 'origin_ids' y 'destination_ids' no vacías son requeridas."}), 400
+    if len(origin_ids) > MAX_NODOS_MATRIZ or len(destination_ids) > MAX_NODOS_MATRIZ:
+        return jsonify({"message": f"Máximo {MAX_NODOS_MATRIZ} orígenes y {MAX_NODOS_MATRIZ} destinos por petición."}), 400
+    if not all(isinstance(i, (str, int)) and not isinstance(i, bool) for i in origin_ids + destination_ids):
+        return jsonify({"message": "Los IDs de 'origin_ids' y 'destination_ids' deben ser strings o enteros."}), 400
+
+    try:
+        csr = erg.obtener_grafo_csr(snapshot.vista)
+        indices = {}
+        for node_id_str in set(origin_ids) | set(destination_ids):
+            idx = indice_nodo_por_id(snapshot, node_id_str)
+            if idx is None:
+                return jsonify({"message": f"Nodo con ID '{str(node_id_str).strip()}' no encontrado."}), 404
+            indices[node_id_str] = idx
+
+        matriz = csr.matriz_distancias([indices[o] for o in origin_ids], [indices[d] for d in destination_ids])
+        matriz_km = np.round(matriz / 1000, 3) # Convertir a km
+        return jsonify({
+            "origin_ids": origin_ids,
+            "destination_ids": destination_ids,
+            "matrix": [[v if np.isfinite(v) else None for v in fila] for fila in matriz_km.tolist()],
+        }), 200
+    except Exception as e:
+        app.logger.error(f"Error calculando la matriz de distancias: {e}", exc_info=True)
+        return jsonify({"message": f"Error interno del servidor: {str(e)}"}), 500
+
+
+@app.route('/api/snap-nodo')
+def snap_nodo_api():
+    """
+    Ajusta una coordenada geográfica (lat, lon) al nodo de la red más cercano.
+    Parámetros opcionales: k (devuelve los k nodos más cercanos) y radio (metros).
+    """
+    snapshot = obtener_snapshot_publicado() # Leer la referencia una sola vez
+    if snapshot is None:
+        return jsonify({"message": "El grafo no ha sido cargado. Por favor, carga el grafo primero."}), 503
+
+    indice = snapshot.vista.graph.get('indice_espacial')
+    if indice is None:
+        return jsonify({"message": "El grafo cargado no tiene índice espacial."}), 503
+
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        k = int(request.args.get('k', 1))
+        radio = request.args.get('radio')
+        radio = float(radio) if radio is not None else None
+    except (KeyError, ValueError):
+        return jsonify({"message": "Parámetros 'lat' y 'lon' numéricos son requeridos (opcionales: 'k', 'radio')."}), 400
+    if not (math.isfinite(lat) and math.isfinite(lon)) or (radio is not None and not math.isfinite(radio)):
+        return jsonify({"message": "Los parámetros 'lat', 'lon' y 'radio' deben ser números finitos."}), 400
+    if radio is not None and radio < 0:
+        return jsonify({"message": "El parámetro 'radio' no puede ser negativo."}), 400
+    if k < 1:
+        return jsonify({"message": "El parámetro 'k' debe ser un entero mayor o igual a 1."}), 400
+
+    punto_proj = erg.obtener_transformador(CRS_GEOGRAPHIC, CRS_PROJECTED).transform(lon, lat)
+    if radio is not None:
+        candidatos = indice.dentro_de_radio(punto_proj, radio)
+        if 'k' in request.args:
+            candidatos = candidatos[:k]
+    else:
+        candidatos = indice.k_mas_cercanos(punto_proj, k)
+
+    if not candidatos:
+        return jsonify({"message": "No se encontró ningún nodo de la red cerca de la coordenada indicada."}), 404
+
+    nodos_latlon = erg.coordenadas_geograficas(snapshot.vista)
+    resultado = []
+    for idx, dist in candidatos:
+        lat_geo, lon_geo = nodos_latlon[idx].tolist()
+        resultado.append({
+            "node_id": formatear_id_nodo(indice.nodo(idx)),
+            "lat": lat_geo,
+            "lon": lon_geo,
+            "distance": dist, # metros proyectados
+        })
+
+    respuesta = dict(resultado[0])
+    respuesta["candidatos"] = resultado
+    return jsonify(respuesta), 200
+
+# Caché de teselas GeoJSON de la red: (z, x, y) -> bytes, válida para una versión de 'tramos_gas'.
+# Al cambiar la versión de la tabla se descarta entera.
+MAX_TESELAS_CACHE = 4096
+CACHE_TESELAS = OrderedDict()
+CACHE_TESELAS_VERSION = {'version': None}
+LOCK_TESELAS = threading.Lock()
+
+
+@app.route('/api/teselas/<int:z>/<int:x>/<int:y>.geojson')
+def tesela_tramos_api(z, x, y):
+    """
+    Tramos de la red que cruzan la tesela z/x/y, simplificados para ese zoom (GeoJSON).
+    El mapa solo pide las teselas visibles; las respuestas se cachean por tesela y versión de la tabla,
+    y el ETag permite al navegador revalidarlas sin volver a descargarlas.
+    """
+    if z > erg.MAX_ZOOM_TESELAS or x >= 2 ** z or y >= 2 ** z:
+        return jsonify({"message": f"Tesela {z}/{x}/{y} fuera de rango (zoom máximo {erg.MAX_ZOOM_TESELAS})."}), 400
+
+    version = erg.obtener_version_tramos(app.logger.info)
+    etag = f'"{version}-{z}-{x}-{y}"' if version is not None else None
+    if etag is not None and request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers={'ETag': etag})
+
+    clave = (z, x, y)
+    with LOCK_TESELAS:
+        if CACHE_TESELAS_VERSION['version'] != version:
+            CACHE_TESELAS.clear()
+            CACHE_TESELAS_VERSION['version'] = version
+        cuerpo = CACHE_TESELAS.get(clave)
+        if cuerpo is not None:
+            CACHE_TESELAS.move_to_end(clave)
+
+    if cuerpo is None:
+        try:
+            cuerpo = erg.tesela_tramos_geojson(z, x, y, app.logger.info).encode('utf-8')
+        except Exception as e:
+            app.logger.error(f"Error generando la tesela {z}/{x}/{y}: {e}", exc_info=True)
+            return jsonify({"message": f"No se pudo generar la tesela {z}/{x}/{y}: {e}"}), 503
+        with LOCK_TESELAS:
+            if CACHE_TESELAS_VERSION['version'] == version:
+                CACHE_TESELAS[clave] = cuerpo
+                while len(CACHE_TESELAS) > MAX_TESELAS_CACHE:
+                    CACHE_TESELAS.popitem(last=False)
+
+    respuesta = responder_cuerpo_json(cuerpo, mimetype='application/geo+json')
+    respuesta.headers['Cache-Control'] = 'no-cache' # Revalidar con ETag: la tabla puede cambiar
+    if etag is not None:
+        respuesta.headers['ETag'] = etag
+    return respuesta
+
+
 # NUEVO: Endpoint para el Simulador de Impacto (Módulo 5)
 @app.route('/api/simulate-impact', methods=['POST'])
 def simulate_impact_api():
-    if GLOBAL_GRAPH is None:
+    """
+    Simula una acción sobre un nodo en el escenario 'scenario_id'. Los niveles del escenario se guardan
+    junto al snapshot publicado (ver simulacion_compartida), así cualquier worker los ve en
+    /api/analisis?scenario_id=... sin necesidad de sesiones fijas (sticky) en el balanceador.
+    """
+    snapshot = obtener_snapshot_publicado() # Leer la referencia una sola vez
+    if snapshot is None:
         return jsonify({'message': 'El grafo no ha sido cargado. Por favor, carga el grafo primero.', 'type': 'error'}), 503
 
     data = request.get_json()
     node_id_str = data.get('node_id')
     action_type = data.get('action_type')
+    scenario_id = data.get('scenario_id', 'default') # Cada escenario guarda sus simulaciones por separado
 
     if not node_id_str or not action_type:
         return jsonify({'message': 'Se requieren ID de nodo y tipo de acción para la simulación.', 'type': 'error'}), 400
 
     try:
-        # Obtener las coordenadas PROYECTADAS REDONDEADAS del ID string del frontend
-        rounded_proj_coord = GLOBAL_NODE_ID_STRING_TO_ROUNDED_PROJ_COORD.get(node_id_str.strip())
-        if rounded_proj_coord is None:
+        # Obtener las coordenadas EXACTAS del grafo a partir del ID string del frontend
+        actual_proj_coord = resolver_nodo(snapshot, node_id_str)
+        if actual_proj_coord is None:
             return jsonify({'message': f'Nodo con ID "{node_id_str.strip()}" no encontrado para simulación.', 'type': 'error'}), 404
 
-        # Obtener las coordenadas EXACTAS del grafo a partir de las redondeadas
-        actual_proj_coord = GLOBAL_ROUNDED_PROJ_COORD_TO_ACTUAL_PROJ_COORD.get(rounded_proj_coord)
-        if actual_proj_coord is None or actual_proj_coord not in GLOBAL_GRAPH.nodes:
-            return jsonify({'message': f'Nodo "{node_id_str.strip()}" no es un nodo válido en el grafo (problema de mapeo interno).', 'type': 'error'}), 404
-
         # Llamar a la lógica de simulación en grafo_logic.py
-        # Esta función modificará los atributos del nodo directamente en GLOBAL_GRAPH
-        erg.simulate_node_impact(GLOBAL_GRAPH, actual_proj_coord, action_type)
-
-        # Devolver los nuevos niveles de gases simulados del nodo que ya está en GLOBAL_GRAPH
-        updated_node_attrs = GLOBAL_GRAPH.nodes[actual_proj_coord]
+        # Los nuevos niveles se guardan en el overlay del escenario; el grafo compartido no se modifica
+        with simulacion_compartida(snapshot, scenario_id) as overlay:
+            updated_node_attrs = erg.simulate_node_impact(snapshot.vista, actual_proj_coord, action_type, overlay=overlay)
 
         return jsonify({
             'node_id': node_id_str, # Devolvemos el ID string original para el frontend
+            'scenario_id': scenario_id,
             'new_co2': updated_node_attrs.get('co2_level', 0),
             'new_ch4': updated_node_attrs.get('ch4_level', 0),
             'new_nox': updated_node_attrs.get('nox_level', 0),
@@ -350,6 +1099,70 @@ def simulate_impact_api():
         return jsonify({'message': f'Error interno del servidor al simular impacto: {e}', 'type': 'error'}), 500
 
 
+# Tope de nodos que se pueden indicar por ID en una simulación en lote (los clusters no tienen tope)
+MAX_NODOS_SIMULACION_LOTE = 50000
+
+
+@app.route('/api/simulate-impact/lote', methods=['POST'])
+def simulate_impact_lote_api():
+    """
+    Aplica una o varias acciones a un conjunto de nodos (por ID y/o por cluster KMeans) de un escenario
+    en una sola pasada, y devuelve los niveles totales de CO2/CH4/NOx antes y después para toda
+    la red y para cada cluster afectado. El grafo no se reconstruye ni se modifica.
+    Como en /api/simulate-impact, el escenario se comparte entre workers a través del snapshot publicado.
+    """
+    snapshot = obtener_snapshot_publicado() # Leer la referencia una sola vez
+    if snapshot is None:
+        return jsonify({'message': 'El grafo no ha sido cargado. Por favor, carga el grafo primero.', 'type': 'error'}), 503
+
+    data = request.get_json(silent=True) or {}
+    scenario_id = data.get('scenario_id', 'default')
+    acciones = data.get('actions') or ([data['action_type']] if data.get('action_type') else [])
+    node_ids = data.get('node_ids') or []
+    clusters = data.get('clusters') or []
+
+    if not acciones or not isinstance(acciones, list):
+        return jsonify({'message': 'Se requiere al menos un tipo de acción (action_type o actions).', 'type': 'error'}), 400
+    desconocidas = [a for a in acciones if a not in erg.REDUCTION_PERCENTAGES]
+    if desconocidas:
+        return jsonify({'message': f"Tipos de acción desconocidos: {', '.join(map(str, desconocidas))}. "
+                                   f"Disponibles: {', '.join(erg.REDUCTION_PERCENTAGES)}.", 'type': 'error'}), 400
+    if not isinstance(node_ids, list) or not isinstance(clusters, list) or (not node_ids and not clusters):
+        return jsonify({'message': 'Se requiere una lista de node_ids y/o de clusters.', 'type': 'error'}), 400
+    if len(node_ids) > MAX_NODOS_SIMULACION_LOTE:
+        return jsonify({'message': f'Se admiten como máximo {MAX_NODOS_SIMULACION_LOTE} node_ids por simulación.', 'type': 'error'}), 400
+    try:
+        clusters = [int(c) for c in clusters]
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Los clusters deben ser números enteros.', 'type': 'error'}), 400
+
+    try:
+        G = snapshot.vista
+        # IDs string -> posiciones en los arreglos de niveles
+        no_encontrados = []
+        encontrados = []
+        for node_id_str in node_ids:
+            idx = indice_nodo_por_id(snapshot, node_id_str)
+            if idx is None:
+                no_encontrados.append(node_id_str)
+            else:
+                encontrados.append(idx)
+        indices = np.asarray(encontrados, dtype=np.int64)
+        if clusters:
+            indices = np.concatenate([indices, np.flatnonzero(np.isin(erg.clusters_nodos(G), clusters))])
+        indices = indices[indices >= 0]
+
+        with simulacion_compartida(snapshot, scenario_id) as overlay:
+            resumen = erg.simular_impacto_lote(G, indices, acciones, overlay=overlay)
+        resumen['clusters'] = {str(c): valores for c, valores in resumen['clusters'].items()}
+        return jsonify(dict(resumen, scenario_id=scenario_id, actions=acciones, nodos_no_encontrados=no_encontrados,
+                            message='Simulación en lote aplicada con éxito.')), 200
+
+    except Exception as e:
+        app.logger.error(f"Error en la simulación en lote del escenario {scenario_id}: {e}", exc_info=True)
+        return jsonify({'message': f'Error interno del servidor al simular impacto en lote: {e}', 'type': 'error'}), 500
+
+
 if __name__ == '__main__':
     print("Starting Flask app...")
     app.run(debug=True)
@@ -0,0 +1,5 @@
+"""
+Benchmarks de grafo_logic y de los endpoints de app.py sobre redes sintéticas.
+No necesitan PostGIS: la tabla 'tramos_gas' se reemplaza por una red generada
+con red_sintetica. Ver ejecutar.py para el uso.
+"""
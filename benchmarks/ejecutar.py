@@ -0,0 +1,373 @@
+"""
+Mide las etapas del pipeline de grafo_logic y los endpoints de la API sobre redes sintéticas
+(ver red_sintetica) y guarda tiempos, pico de memoria y throughput en JSON para comparar entre commits.
+
+Uso (desde la raíz del repositorio):
+    python -m benchmarks.ejecutar
+    python -m benchmarks.ejecutar --tamanos 10000 100000 1000000 --repeticiones 3
+    python -m benchmarks.ejecutar --comparar benchmarks/resultados/anterior.json
+
+También mide el arranque: el tiempo de 'import app' en un proceso nuevo y si alguna dependencia
+pesada que debería importarse en el primer uso (MODULOS_DIFERIDOS) se cargó al importar.
+
+No necesita PostGIS: la carga de 'tramos_gas' se reemplaza por la red sintética (ignorando max_rows,
+para medir el endpoint a escala real). La memoria se mide con tracemalloc en una pasada aparte,
+para que su costo no se sume a los tiempos.
+"""
+import argparse
+import contextlib
+import datetime
+import gc
+import importlib
+import importlib.metadata
+import itertools
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource # Solo Unix: pico de RSS del proceso
+except ImportError:
+    resource = None
+
+import numpy as np
+import shapely
+
+import grafo_logic as erg
+from benchmarks.red_sintetica import generar_red_sintetica, CRS_GEOGRAPHIC
+
+RAIZ_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORIO_RESULTADOS = os.path.join(RAIZ_REPO, 'benchmarks', 'resultados')
+TAMANOS_PREDETERMINADOS = (10000, 100000)
+FORMATOS_API = ('completo', 'columnar', 'ndjson')
+NODOS_MATRIZ_API = 50 # Orígenes y destinos de /api/matriz-distancias
+NODOS_LOTE_API = 1000 # node_ids de /api/simulate-impact/lote
+PAQUETES_REPORTADOS = ('numpy', 'scipy', 'networkx', 'scikit-learn', 'shapely', 'geopandas', 'pyproj', 'flask')
+UMBRAL_REGRESION = 1.2 # En --comparar se marcan las etapas que tardan un 20% más
+# Dependencias pesadas que grafo_logic/app importan en el primer uso; importar app no debería cargarlas
+MODULOS_DIFERIDOS = ('sklearn', 'geopandas', 'pandas', 'scipy', 'sqlalchemy', 'pyproj', 'networkx', 'shapely')
+REPETICIONES_ARRANQUE = 5
+_CODIGO_ARRANQUE = (
+    "import sys, time, json\n"
+    "inicio = time.perf_counter()\n"
+    "import app\n"
+    "segundos = time.perf_counter() - inicio\n"
+    "print(json.dumps({'segundos': segundos, 'cargados': [m for m in %r if m in sys.modules]}))\n"
+)
+
+
+def _sin_log(mensaje):
+    pass
+
+
+def medir(funcion, repeticiones=1, memoria=True):
+    """
+    Ejecuta funcion() 'repeticiones' veces y devuelve (resultado de la última, métricas).
+    El tiempo reportado es el mínimo de las repeticiones; con memoria, se hace una pasada
+    extra bajo tracemalloc para obtener el pico de memoria asignada por la etapa.
+    """
+    tiempos = []
+    resultado = None
+    for _ in range(repeticiones):
+        gc.collect()
+        inicio = time.perf_counter()
+        resultado = funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    metricas = {'segundos': min(tiempos), 'segundos_media': float(np.mean(tiempos)), 'repeticiones': repeticiones}
+    if memoria:
+        resultado = None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            resultado = funcion()
+            metricas['pico_memoria_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+    return resultado, metricas
+
+
+def _throughput(metricas, cantidad, unidad):
+    metricas['throughput'] = cantidad / metricas['segundos'] if metricas['segundos'] > 0 else None
+    metricas['unidad'] = unidad
+    return metricas
+
+
+def medir_etapas(gdf_proj, repeticiones, memoria):
+    """Mide cada etapa de grafo_logic por separado sobre la red proyectada."""
+    etapas = {}
+    n_segmentos = len(gdf_proj)
+
+    gdf_geo, m = medir(lambda: gdf_proj.to_crs(CRS_GEOGRAPHIC), repeticiones, memoria)
+    etapas['reproyeccion'] = _throughput(m, n_segmentos, 'segmentos/s')
+
+    # Lo que hace el cliente con la carga binaria (erg.cargar_tramos_gas_proyectados) en lugar de reproyectar
+    wkb = shapely.to_wkb(np.asarray(gdf_proj.geometry.values))
+    _, m = medir(lambda: shapely.from_wkb(wkb), repeticiones, memoria)
+    etapas['decodificacion_wkb'] = _throughput(m, n_segmentos, 'segmentos/s')
+
+    G, m = medir(lambda: erg.construir_grafo_red(gdf_geo, gdf_proj, _sin_log), repeticiones, memoria)
+    etapas['construir_grafo_red'] = _throughput(m, n_segmentos, 'segmentos/s')
+    n_nodos = G.number_of_nodes()
+
+    centro = tuple(np.asarray(G.graph['nodos_xy']).mean(axis=0))
+    nodo_inicial, m = medir(lambda: erg.encontrar_nodo_inicial(G, centro, _sin_log), repeticiones, memoria)
+    etapas['encontrar_nodo_inicial'] = _throughput(m, 1, 'consultas/s')
+
+    _, m = medir(lambda: erg.obtener_grafo_csr(G).preparar_landmarks(), repeticiones, memoria)
+    etapas['preparar_landmarks'] = _throughput(m, n_nodos, 'nodos/s')
+
+    _, m = medir(lambda: erg.ejecutar_dijkstra(G, nodo_inicial, _sin_log), repeticiones, memoria)
+    etapas['ejecutar_dijkstra'] = _throughput(m, n_nodos, 'nodos/s')
+
+    _, m = medir(lambda: erg.calcular_mst(G, _sin_log), repeticiones, memoria)
+    etapas['calcular_mst'] = _throughput(m, G.number_of_edges(), 'aristas/s')
+
+    _, m = medir(lambda: erg.ejecutar_kmeans(G.graph['nodos_xy'], _sin_log), repeticiones, memoria)
+    etapas['ejecutar_kmeans'] = _throughput(m, n_nodos, 'nodos/s')
+
+    resumen = {'segmentos': n_segmentos, 'nodos': n_nodos, 'aristas': G.number_of_edges()}
+    return gdf_geo, resumen, etapas
+
+
+def medir_api(gdf_geo, gdf_proj, n_nodos, repeticiones, memoria):
+    """
+    Mide los endpoints con el cliente de pruebas de Flask: /api/analisis en frío (construye el snapshot)
+    y en caliente por formato (solo serialización), y sobre el snapshot ya construido las rutas
+    (un caso por algoritmo), la matriz de distancias, el ajuste a nodo y las simulaciones.
+    """
+    import app
+
+    contador = itertools.count()
+    version_actual = {'version': None}
+    erg.cargar_tramos_gas = lambda logprint, max_rows=None, **filtros: gdf_geo
+    erg.cargar_tramos_gas_proyectados = lambda logprint, max_rows=None, **filtros: gdf_proj
+    erg.obtener_version_tramos = lambda logprint: version_actual['version']
+    erg.obtener_ultimo_lote_cambios = lambda logprint: None
+    cliente = app.app.test_client()
+    consulta = f'/api/analisis?max_rows={app.MAX_FILAS_CARGA}'
+
+    def enviar(ruta, cuerpo_json=None):
+        with open(os.devnull, 'w') as nulo, contextlib.redirect_stdout(nulo):
+            if cuerpo_json is None:
+                respuesta = cliente.get(ruta)
+            else:
+                respuesta = cliente.post(ruta, json=cuerpo_json)
+            cuerpo = respuesta.get_data() # En ndjson consume el stream completo
+        if respuesta.status_code != 200:
+            raise RuntimeError(f"{ruta} respondió {respuesta.status_code}: {cuerpo[:300]!r}")
+        return cuerpo
+
+    def pedir(formato):
+        return len(enviar(f'{consulta}&formato={formato}'))
+
+    def en_frio():
+        # Versión nueva en cada llamada: ni la caché en memoria ni los snapshots en disco sirven
+        version_actual['version'] = f"bench-{os.getpid()}-{next(contador)}"
+        app.SNAPSHOT_CACHE = erg.CacheSnapshots()
+        app.GLOBAL_SNAPSHOT = None
+        erg.MODELOS_KMEANS.clear()
+        return pedir('columnar')
+
+    etapas = {}
+    _, m = medir(en_frio, repeticiones, memoria)
+    etapas['api_analisis_frio'] = _throughput(m, n_nodos, 'nodos/s')
+    for formato in FORMATOS_API:
+        n_bytes, m = medir(lambda: pedir(formato), repeticiones, memoria)
+        m['bytes_respuesta'] = n_bytes
+        m['mb_por_segundo'] = n_bytes / 2**20 / m['segundos'] if m['segundos'] > 0 else None
+        etapas[f'api_analisis_{formato}'] = _throughput(m, n_nodos, 'nodos/s')
+
+    # IDs de nodos del snapshot ya publicado: ruta entre dos nodos alejados de la componente mayor
+    nodos = json.loads(enviar(f'{consulta}&formato=columnar'))['nodes']
+    ids = nodos['id']
+    componentes = np.asarray(nodos['componente'])
+    mayor = np.flatnonzero(componentes == np.bincount(componentes).argmax())
+    xy = np.column_stack([nodos['x_proj'], nodos['y_proj']])[mayor]
+    origen, destino = mayor[np.argmin(xy.sum(axis=1))], mayor[np.argmax(xy.sum(axis=1))]
+    for algoritmo in erg.ALGORITMOS_RUTA:
+        cuerpo = {'origin_id': ids[origen], 'destination_id': ids[destino], 'algoritmo': algoritmo}
+        enviar('/api/ruta-optima', cuerpo) # 'alt' prepara sus landmarks en la primera ruta: no se mide
+        _, m = medir(lambda: enviar('/api/ruta-optima', cuerpo), repeticiones, memoria)
+        etapas[f'api_ruta_optima_{algoritmo}'] = _throughput(m, 1, 'rutas/s')
+
+    muestra = np.random.default_rng(0).choice(len(ids), size=min(len(ids), 2 * NODOS_MATRIZ_API), replace=False)
+    cuerpo_matriz = {'origin_ids': [ids[i] for i in muestra[:NODOS_MATRIZ_API]],
+                     'destination_ids': [ids[i] for i in muestra[NODOS_MATRIZ_API:]]}
+    def matriz():
+        # Sin las filas de distancias cacheadas por peticiones anteriores (ver erg.GrafoCSR.matriz_distancias)
+        erg.obtener_grafo_csr(app.GLOBAL_SNAPSHOT.vista)._iniciar_cache_filas()
+        return enviar('/api/matriz-distancias', cuerpo_matriz)
+    _, m = medir(matriz, repeticiones, memoria)
+    etapas['api_matriz_distancias'] = _throughput(
+        m, len(cuerpo_matriz['origin_ids']) * len(cuerpo_matriz['destination_ids']), 'pares/s')
+
+    _, m = medir(lambda: enviar(f"/api/snap-nodo?lat={nodos['lat'][origen]}&lon={nodos['lon'][origen]}&k=5"), repeticiones, memoria)
+    etapas['api_snap_nodo'] = _throughput(m, 1, 'consultas/s')
+
+    cuerpo_simulacion = {'node_id': ids[origen], 'action_type': 'panel_solar', 'scenario_id': 'benchmark'}
+    _, m = medir(lambda: enviar('/api/simulate-impact', cuerpo_simulacion), repeticiones, memoria)
+    etapas['api_simulate_impact'] = _throughput(m, 1, 'simulaciones/s')
+
+    cuerpo_lote = {'node_ids': ids[::max(1, len(ids) // NODOS_LOTE_API)][:NODOS_LOTE_API], # Repartidos por la red
+                   'actions': ['panel_solar', 'biodigestor'], 'scenario_id': 'benchmark'}
+    _, m = medir(lambda: enviar('/api/simulate-impact/lote', cuerpo_lote), repeticiones, memoria)
+    etapas['api_simulate_impact_lote'] = _throughput(m, len(cuerpo_lote['node_ids']), 'nodos/s')
+    return etapas
+
+
+def medir_arranque(repeticiones=REPETICIONES_ARRANQUE):
+    """
+    Mide en procesos nuevos cuánto tarda 'import app' (lo que paga cada worker al arrancar) y
+    qué dependencias de MODULOS_DIFERIDOS quedaron cargadas, que deberían ser ninguna.
+    """
+    tiempos = []
+    cargados = []
+    for _ in range(repeticiones):
+        salida = subprocess.run([sys.executable, '-c', _CODIGO_ARRANQUE % (MODULOS_DIFERIDOS,)], cwd=RAIZ_REPO,
+                                capture_output=True, text=True, check=True).stdout
+        medicion = json.loads(salida.strip().splitlines()[-1])
+        tiempos.append(medicion['segundos'])
+        cargados = medicion['cargados']
+    return {'segundos': min(tiempos), 'segundos_media': float(np.mean(tiempos)), 'repeticiones': repeticiones,
+            'modulos_diferidos_cargados': cargados}
+
+
+def commit_actual():
+    """Hash del commit de HEAD (con '+' si hay cambios sin commitear), o None fuera de git."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ_REPO, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        sucio = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=RAIZ_REPO,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ('+' if sucio else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def entorno():
+    versiones = {}
+    for paquete in PAQUETES_REPORTADOS:
+        try:
+            versiones[paquete] = importlib.metadata.version(paquete)
+        except importlib.metadata.PackageNotFoundError:
+            versiones[paquete] = None
+    return {
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'procesadores': os.cpu_count(),
+        'versiones': versiones,
+    }
+
+
+def ejecutar(tamanos, repeticiones=1, memoria=True, con_api=True, semilla=0):
+    """Corre el benchmark para cada tamaño (número de segmentos) y devuelve el dict de resultados."""
+    arranque = medir_arranque()
+    aviso = f" (cargó al importar: {', '.join(arranque['modulos_diferidos_cargados'])})" if arranque['modulos_diferidos_cargados'] else ""
+    print(f"== arranque: import app {arranque['segundos']:.3f} s{aviso} ==", flush=True)
+
+    # Las etapas miden los algoritmos, no la importación diferida de sus dependencias (eso es el arranque)
+    for modulo in ('sklearn.cluster', 'scipy.sparse.csgraph', 'scipy.spatial', 'geopandas', 'networkx'):
+        importlib.import_module(modulo)
+
+    resultados = []
+    for n in tamanos:
+        print(f"== {n} segmentos ==", flush=True)
+        inicio = time.perf_counter()
+        gdf_proj = generar_red_sintetica(n, semilla=semilla)
+        generacion = time.perf_counter() - inicio
+
+        gdf_geo, resumen, etapas = medir_etapas(gdf_proj, repeticiones, memoria)
+        if con_api:
+            etapas.update(medir_api(gdf_geo, gdf_proj, resumen['nodos'], repeticiones, memoria))
+        for nombre, m in etapas.items():
+            pico = f", pico {m['pico_memoria_mb']:.1f} MB" if 'pico_memoria_mb' in m else ""
+            throughput = f", {m['throughput']:,.0f} {m['unidad']}" if m.get('throughput') else ""
+            print(f"   {nombre:<28} {m['segundos']:9.3f} s{pico}{throughput}", flush=True)
+        resultados.append(dict(resumen, tamano=n, segundos_generacion=generacion, etapas=etapas))
+        del gdf_proj, gdf_geo
+        gc.collect()
+
+    pico_rss = None
+    if resource is not None:
+        # ru_maxrss está en KB en Linux y en bytes en macOS
+        pico_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+    return {
+        'fecha': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit_actual(),
+        'entorno': entorno(),
+        'parametros': {'tamanos': list(tamanos), 'repeticiones': repeticiones, 'memoria': memoria,
+                       'api': con_api, 'semilla': semilla},
+        'pico_rss_proceso_mb': pico_rss,
+        'arranque': arranque,
+        'resultados': resultados,
+    }
+
+
+def comparar(anterior, actual):
+    """Imprime, por tamaño y etapa, la razón entre el tiempo actual y el de un JSON anterior."""
+    previos = {r['tamano']: r['etapas'] for r in anterior.get('resultados', [])}
+    print(f"Comparación con {anterior.get('commit')} ({anterior.get('fecha')}):")
+    previo, arranque = anterior.get('arranque'), actual.get('arranque')
+    if previo and arranque and previo.get('segundos'):
+        razon = arranque['segundos'] / previo['segundos']
+        marca = "  <-- más lento" if razon > UMBRAL_REGRESION else ""
+        print(f"   {'arranque (import app)':<31} {previo['segundos']:9.3f} s -> {arranque['segundos']:9.3f} s (x{razon:.2f}){marca}")
+    if arranque and arranque['modulos_diferidos_cargados']:
+        print(f"   Al importar app se cargan: {', '.join(arranque['modulos_diferidos_cargados'])}  <-- deberían importarse en el primer uso")
+    for resultado in actual['resultados']:
+        etapas_previas = previos.get(resultado['tamano'])
+        if etapas_previas is None:
+            print(f"   {resultado['tamano']} segmentos: sin datos previos.")
+            continue
+        print(f"   {resultado['tamano']} segmentos:")
+        for nombre, m in resultado['etapas'].items():
+            previa = etapas_previas.get(nombre)
+            if not previa or not previa.get('segundos'):
+                continue
+            razon = m['segundos'] / previa['segundos']
+            marca = "  <-- más lento" if razon > UMBRAL_REGRESION else ""
+            print(f"      {nombre:<28} {previa['segundos']:9.3f} s -> {m['segundos']:9.3f} s (x{razon:.2f}){marca}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de grafo_logic y /api/analisis sobre redes sintéticas.")
+    parser.add_argument('--tamanos', type=int, nargs='+', default=list(TAMANOS_PREDETERMINADOS),
+                        help="Número de segmentos de cada red (ej. 10000 100000 1000000).")
+    parser.add_argument('--repeticiones', type=int, default=1, help="Repeticiones por etapa (se reporta el mínimo).")
+    parser.add_argument('--sin-memoria', action='store_true', help="No medir el pico de memoria (más rápido).")
+    parser.add_argument('--sin-api', action='store_true', help="No medir los endpoints de Flask.")
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--salida', help="Archivo JSON de resultados (por defecto en benchmarks/resultados/).")
+    parser.add_argument('--comparar', help="JSON de una corrida anterior contra el cual comparar.")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.INFO) # app.py configura logging en DEBUG; los logs distorsionan los tiempos
+    with tempfile.TemporaryDirectory(prefix='bench_snapshots_') as directorio:
+        # Los snapshots publicados por /api/analisis van a un directorio temporal, no al del servidor
+        os.environ['GRAFO_SNAPSHOT_DIR'] = directorio
+        import snapshot_compartido
+        snapshot_compartido.DIRECTORIO_SNAPSHOTS = directorio
+        resultados = ejecutar(args.tamanos, args.repeticiones, not args.sin_memoria, not args.sin_api, args.semilla)
+
+    salida = args.salida
+    if salida is None:
+        os.makedirs(DIRECTORIO_RESULTADOS, exist_ok=True)
+        marca = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        salida = os.path.join(DIRECTORIO_RESULTADOS, f"bench_{marca}_{(resultados['commit'] or 'sin_git').rstrip('+')}.json")
+    with open(salida, 'w', encoding='utf-8') as f:
+        json.dump(resultados, f, indent=2, ensure_ascii=False)
+    print(f"Resultados guardados en {salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            comparar(json.load(f), resultados)
+
+
+if __name__ == '__main__':
+    main()
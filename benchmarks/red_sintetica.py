@@ -0,0 +1,57 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+from pyproj import Transformer
+
+CRS_GEOGRAPHIC = "EPSG:4326"
+CRS_PROJECTED = "EPSG:32718"
+
+# Centro de la red sintética: el mismo centro de referencia que usa app.py (Lima)
+CENTRO_LON, CENTRO_LAT = -77.0428, -12.0464
+ESPACIADO_CALLES = 120.0 # Distancia media entre intersecciones (m)
+VERTICES_INTERMEDIOS = 3 # Vértices entre los extremos de cada tramo
+FRACCION_DIAGONALES = 0.1 # Proporción de tramos diagonales candidatos (avenidas que cortan la grilla)
+
+
+def generar_red_sintetica(n_segmentos, semilla=0, espaciado=ESPACIADO_CALLES, vertices_intermedios=VERTICES_INTERMEDIOS):
+    """
+    Genera una red de distribución tipo ciudad peruana como GeoDataFrame proyectado (EPSG:32718)
+    con n_segmentos tramos LineString y las columnas CODTRAMO y LONGITUD de 'tramos_gas'.
+
+    La red es una grilla de calles con intersecciones desplazadas al azar, centrada en Lima:
+    cada tramo une dos intersecciones vecinas (horizontal, vertical o diagonal) y tiene
+    vértices intermedios levemente ondulados. Como no todas las conexiones posibles se usan,
+    quedan calles cortadas y algunas componentes aisladas, igual que en los datos reales.
+    """
+    rng = np.random.default_rng(semilla)
+    # Lado de la grilla: 2 * L * (L - 1) conexiones horizontales y verticales >= n_segmentos
+    lado = int(np.ceil(np.sqrt(n_segmentos / 2))) + 2
+    cx, cy = Transformer.from_crs(CRS_GEOGRAPHIC, CRS_PROJECTED, always_xy=True).transform(CENTRO_LON, CENTRO_LAT)
+
+    filas, columnas = np.divmod(np.arange(lado * lado), lado)
+    intersecciones = np.column_stack([
+        cx + (columnas - lado / 2) * espaciado,
+        cy + (filas - lado / 2) * espaciado,
+    ]) + rng.normal(scale=espaciado * 0.15, size=(lado * lado, 2))
+
+    # Conexiones candidatas entre intersecciones vecinas (índices planos fila * lado + columna)
+    idx = np.arange(lado * lado).reshape(lado, lado)
+    horizontales = np.column_stack([idx[:, :-1].ravel(), idx[:, 1:].ravel()])
+    verticales = np.column_stack([idx[:-1, :].ravel(), idx[1:, :].ravel()])
+    diagonales = np.column_stack([idx[:-1, :-1].ravel(), idx[1:, 1:].ravel()])
+    diagonales = diagonales[rng.random(len(diagonales)) < FRACCION_DIAGONALES]
+    candidatas = np.vstack([horizontales, verticales, diagonales])
+    elegidas = candidatas[rng.permutation(len(candidatas))[:n_segmentos]]
+
+    # Vértices intermedios a lo largo del tramo, con una pequeña ondulación perpendicular
+    inicio = intersecciones[elegidas[:, 0]]
+    fin = intersecciones[elegidas[:, 1]]
+    t = np.linspace(0.0, 1.0, vertices_intermedios + 2)
+    coords = inicio[:, None, :] + (fin - inicio)[:, None, :] * t[None, :, None]
+    coords[:, 1:-1, :] += rng.normal(scale=espaciado * 0.02, size=(len(elegidas), vertices_intermedios, 2))
+
+    geometrias = shapely.linestrings(coords)
+    return gpd.GeoDataFrame({
+        "CODTRAMO": np.char.add("S", np.arange(len(elegidas)).astype(str)).astype(object),
+        "LONGITUD": np.round(shapely.length(geometrias), 2),
+    }, geometry=geometrias, crs=CRS_PROJECTED)
@@ -1,14 +1,18 @@
-import pandas as pd
-import geopandas as gpd
-import networkx as nx
-from sklearn.cluster import KMeans
-from shapely import wkt
-from sqlalchemy import create_engine
-import psycopg2 
-from pyproj import CRS, Transformer 
-from shapely.geometry import Point 
-import random # Necesario para la simulación de gases
+import numpy as np
+# geopandas, scipy, sklearn, sqlalchemy y pyproj se importan en el primer uso (ver obtener_engine,
+# obtener_transformador y las funciones que los usan): importar este módulo no debe costar segundos
+# a cada worker, y sklearn solo se carga si alguien ejecuta KMeans.
 import math # Necesario para cálculos de distancia
+import threading # Para proteger la caché de snapshots entre peticiones concurrentes
+import heapq # Cola de prioridad para A*
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import Future
+import time
+import json
+import contextlib
+import metricas
 
 import logging # Asegurarse de que logging esté importado
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s') # Cambiado a INFO para menos verbosidad en consola
@@ -21,71 +25,1329 @@ DB_PORT = '5432'
 DB_NAME = 'ecoregula_db'
 
 DATABASE_URL = f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-ENGINE = create_engine(DATABASE_URL) 
+# Pool de conexiones por proceso (el engine se crea en el primer uso, después del fork de cada worker)
+DB_POOL_SIZE = int(os.environ.get('GRAFO_DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('GRAFO_DB_MAX_OVERFLOW', 5))
+DB_POOL_TIMEOUT = 30 # Segundos de espera por una conexión libre
+DB_POOL_RECYCLE = 1800 # Renovar conexiones cada 30 min para no usar conexiones cortadas por el servidor
+
+# Motor de grafos por defecto para Dijkstra, MST y rutas: 'csr' (SciPy) o 'networkx'
+MOTOR_GRAFO_PREDETERMINADO = 'csr'
+# Algoritmo por defecto para rutas punto a punto: 'dijkstra', 'astar' o 'alt' (A* + landmarks).
+# 'dijkstra' (csgraph, compilado) le gana a A*/ALT, que recorren la cola de prioridad en Python:
+# cambiar el valor por defecto solo si benchmarks/ejecutar.py (api_ruta_optima_*) muestra lo contrario
+ALGORITMO_RUTA_PREDETERMINADO = 'dijkstra'
+ALGORITMOS_RUTA = ('dijkstra', 'astar', 'alt')
+NUM_LANDMARKS = 8
+# KMeans: 'kmeans' (ajuste completo), 'minibatch' o 'auto' (minibatch a partir de UMBRAL_MINIBATCH nodos)
+KMEANS_MODO_PREDETERMINADO = 'auto'
+UMBRAL_MINIBATCH = 50000
+# Modelos KMeans ajustados (sus centroides), por parámetros de carga; sobreviven a la invalidación de
+# snapshots para que un cambio de datos solo requiera asignar los nodos al centroide más cercano.
+# También se publican con el snapshot compartido, así un worker nuevo no tiene que volver a ajustarlos.
+# LRU acotada: cada región (bbox/polígono/radio) distinta es una entrada, así que sin límite crecería sin fin
+MAX_MODELOS_KMEANS = 8
+MODELOS_KMEANS = OrderedDict()
+_LOCK_MODELOS_KMEANS = threading.Lock()
+# Memoria máxima para las filas de distancias cacheadas por origen (matrices origen-destino)
+MAX_BYTES_CACHE_FILAS = 256 * 1024 * 1024
 
 # Transformadores de Coordenadas
 CRS_GEOGRAPHIC = "EPSG:4326" 
 CRS_PROJECTED = "EPSG:32718" 
 
-transformer_geo_to_proj = Transformer.from_crs(CRS_GEOGRAPHIC, CRS_PROJECTED, always_xy=True)
-transformer_proj_to_geo = Transformer.from_crs(CRS_PROJECTED, CRS_GEOGRAPHIC, always_xy=True) 
+_ENGINE = None
+_TRANSFORMADORES = {}
+_LOCK_SINGLETONS = threading.Lock()
+
+
+def obtener_engine():
+    """Engine de SQLAlchemy compartido por el proceso; se crea (con su pool) la primera vez que se pide."""
+    global _ENGINE
+    if _ENGINE is None:
+        with _LOCK_SINGLETONS:
+            if _ENGINE is None:
+                from sqlalchemy import create_engine
+                _ENGINE = create_engine(DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                                        pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=True)
+    return _ENGINE
+
+
+def obtener_transformador(crs_origen, crs_destino):
+    """Transformer de pyproj (always_xy) compartido para el par de CRS; se crea la primera vez que se pide."""
+    clave = (crs_origen, crs_destino)
+    transformador = _TRANSFORMADORES.get(clave)
+    if transformador is None:
+        with _LOCK_SINGLETONS:
+            transformador = _TRANSFORMADORES.get(clave)
+            if transformador is None:
+                from pyproj import Transformer
+                transformador = Transformer.from_crs(crs_origen, crs_destino, always_xy=True)
+                _TRANSFORMADORES[clave] = transformador
+    return transformador
+
+
+def proyectadas_a_geograficas(nodos_xy):
+    """
+    Convierte un arreglo (N, 2) de coordenadas proyectadas (x, y) a un arreglo (N, 2) de (lat, lon)
+    con una sola llamada vectorizada a pyproj.
+    """
+    nodos_xy = np.asarray(nodos_xy, dtype=float).reshape(-1, 2)
+    lon, lat = obtener_transformador(CRS_PROJECTED, CRS_GEOGRAPHIC).transform(nodos_xy[:, 0], nodos_xy[:, 1])
+    return np.column_stack([lat, lon])
+
+
+def coordenadas_geograficas(G):
+    """
+    Devuelve el arreglo (N, 2) de (lat, lon) de los nodos de G en el orden de G.nodes().
+    Se calcula una sola vez y queda guardado en G.graph['nodos_latlon'].
+    """
+    latlon = G.graph.get('nodos_latlon')
+    if latlon is None:
+        nodos_xy = G.graph.get('nodos_xy')
+        if nodos_xy is None:
+            nodos_xy = np.array(list(G.nodes()), dtype=float).reshape(-1, 2)
+        latlon = proyectadas_a_geograficas(nodos_xy)
+        G.graph['nodos_latlon'] = latlon
+    return latlon
+
+
+def _filtros_tramos(bbox=None, poligono=None, radio=None):
+    """
+    Condiciones SQL (y sus parámetros) para cargar solo los tramos LineString de una región.
+    bbox = (min_lon, min_lat, max_lon, max_lat) y poligono (WKT) en EPSG:4326 se evalúan con
+    ST_Intersects sobre 'geometry'; radio = (lon, lat, metros) con ST_DWithin sobre 'geometry_proj'
+    (metros reales). Ambas consultas usan los índices GiST de la tabla.
+    """
+    condiciones = ["geometry IS NOT NULL", "ST_GeometryType(geometry) = 'ST_LineString'"]
+    params = {}
+    if bbox is not None:
+        condiciones.append("ST_Intersects(geometry, ST_MakeEnvelope(:bbox_xmin, :bbox_ymin, :bbox_xmax, :bbox_ymax, 4326))")
+        params.update(zip(("bbox_xmin", "bbox_ymin", "bbox_xmax", "bbox_ymax"), (float(v) for v in bbox)))
+    if poligono is not None:
+        condiciones.append("ST_Intersects(geometry, ST_GeomFromText(:poligono, 4326))")
+        params["poligono"] = poligono
+    if radio is not None:
+        condiciones.append(
+            "ST_DWithin(geometry_proj, ST_Transform(ST_SetSRID(ST_MakePoint(:radio_lon, :radio_lat), 4326), 32718), :radio_m)"
+        )
+        params.update(zip(("radio_lon", "radio_lat", "radio_m"), (float(v) for v in radio)))
+    return condiciones, params
 
 
-def cargar_tramos_gas(logprint, max_rows=None):
+def cargar_tramos_gas(logprint, max_rows=None, bbox=None, poligono=None, radio=None):
     """
     Carga tramos de gas desde la tabla 'tramos_gas' de PostgreSQL.
-    Permite limitar el número de filas cargadas.
+    Permite limitar el número de filas cargadas y filtrar por región (ver _filtros_tramos);
+    el filtro espacial y el de tipo LineString se resuelven en PostGIS.
     """
-    logprint(f"Cargando tramos de gas desde la tabla 'tramos_gas' de PostgreSQL ...")
+    import geopandas as gpd
+    from sqlalchemy import text
+    logprint("Cargando tramos de gas desde la tabla 'tramos_gas' de PostgreSQL ...")
     try:
+        condiciones, params = _filtros_tramos(bbox, poligono, radio)
         # Consulta SQL base: ya no seleccionamos la columna de región ni filtramos por ella.
-        query = f"SELECT \"CODTRAMO\", \"LONGITUD\", geometry FROM tramos_gas" 
+        query = f"SELECT \"CODTRAMO\", \"LONGITUD\", geometry FROM tramos_gas WHERE {' AND '.join(condiciones)}"
+        if bbox is not None:
+            logprint(f"   Filtrando por bbox {tuple(bbox)}.")
+        if poligono is not None:
+            logprint("   Filtrando por polígono.")
+        if radio is not None:
+            logprint(f"   Filtrando a {radio[2]:.0f} m de ({radio[0]:.6f}, {radio[1]:.6f}).")
 
         # Añadir límite de filas si se especifica
         if max_rows:
-            query += f" LIMIT {max_rows}" # Esta sintaxis es correcta para gpd.read_postgis
+            query += " LIMIT :max_rows"
+            params["max_rows"] = int(max_rows)
             logprint(f"   Limitando la carga a {max_rows} filas.")
         
-        gdf = gpd.read_postgis(query, ENGINE, geom_col='geometry', crs="EPSG:4326")
-
-        initial_count = len(gdf)
-        gdf = gdf[gdf['geometry'].notnull()]
-        gdf = gdf[gdf['geometry'].apply(lambda g: g.geom_type == "LineString")]
+        gdf = gpd.read_postgis(text(query), obtener_engine(), geom_col='geometry', crs="EPSG:4326", params=params)
         
-        logprint(f"   Tramos de gas cargados: {len(gdf)} filas válidas. ({initial_count - len(gdf)} descartadas por ser nulas o no LineString).")
+        logprint(f"   Tramos de gas cargados: {len(gdf)} filas LineString válidas.")
         return gdf
     except Exception as e:
         logprint(f"   Error al cargar datos desde PostgreSQL: {e}")
         logging.error(f"Error al cargar datos desde PostgreSQL: {e}", exc_info=True)
         raise 
 
+# Carga binaria: filas leídas por lote desde el cursor de servidor
+TAMANO_LOTE_WKB = 50000
+
+
+def _consultar_tramos_wkb(condiciones, params, limite=None):
+    """
+    Ejecuta la consulta de tramos devolviendo la geometría proyectada (geometry_proj, EPSG:32718)
+    como WKB binario. Las filas se leen por lotes de TAMANO_LOTE_WKB con un cursor de servidor
+    (stream_results), sin materializar el resultado completo en el cliente.
+    Devuelve (codtramos, longitudes, wkb) como arreglos NumPy de objetos / float.
+    """
+    from sqlalchemy import text
+    condiciones = condiciones + ["geometry_proj IS NOT NULL"]
+    query = f"SELECT \"CODTRAMO\", \"LONGITUD\", ST_AsBinary(geometry_proj) FROM tramos_gas WHERE {' AND '.join(condiciones)}"
+    if limite:
+        query += " LIMIT :max_rows"
+        params = dict(params, max_rows=int(limite))
+    codtramos, longitudes, wkb = [], [], []
+    with obtener_engine().connect() as conn:
+        resultado = conn.execution_options(stream_results=True, max_row_buffer=TAMANO_LOTE_WKB).execute(text(query), params)
+        for lote in resultado.partitions(TAMANO_LOTE_WKB):
+            c, l, g = zip(*lote)
+            codtramos.extend(c)
+            longitudes.extend(l)
+            wkb.extend(g)
+    return (np.array(codtramos, dtype=object),
+            np.array([np.nan if v is None else v for v in longitudes], dtype=float),
+            np.array([bytes(g) for g in wkb], dtype=object)) # psycopg2 entrega bytea como memoryview
+
+
+def _tabla_arrow_tramos(codtramos, longitudes, wkb):
+    """Tabla pyarrow con la geometría como columna binaria GeoArrow (extensión geoarrow.wkb, EPSG:32718)."""
+    import pyarrow as pa
+    campo_geometria = pa.field('geometry', pa.binary(), metadata={
+        'ARROW:extension:name': 'geoarrow.wkb',
+        'ARROW:extension:metadata': json.dumps({'crs': CRS_PROJECTED}),
+    })
+    return pa.table(
+        [pa.array(codtramos.astype(str), pa.string()), pa.array(longitudes, pa.float64()), pa.array(wkb, pa.binary())],
+        schema=pa.schema([pa.field('CODTRAMO', pa.string()), pa.field('LONGITUD', pa.float64()), campo_geometria]),
+    )
+
+
+def cargar_tramos_gas_proyectados(logprint, max_rows=None, bbox=None, poligono=None, radio=None, arrow=False):
+    """
+    Carga 'tramos_gas' con la geometría ya proyectada que guarda el importador (geometry_proj),
+    transferida como WKB binario por lotes y decodificada en bloque con shapely.from_wkb.
+    Evita read_postgis (decodificación fila por fila) y el to_crs posterior en el cliente.
+    Mismos filtros que cargar_tramos_gas. Devuelve un GeoDataFrame en EPSG:32718, o con arrow=True
+    una tabla pyarrow (GeoArrow WKB) sin decodificar las geometrías.
+    Devuelve None si la consulta falla (p. ej. tabla sin geometry_proj) para que se use cargar_tramos_gas.
+    """
+    import shapely
+    logprint("Cargando tramos de gas proyectados (WKB binario) desde la tabla 'tramos_gas' de PostgreSQL ...")
+    condiciones, params = _filtros_tramos(bbox, poligono, radio)
+    if max_rows:
+        logprint(f"   Limitando la carga a {max_rows} filas.")
+    try:
+        inicio = time.perf_counter()
+        codtramos, longitudes, wkb = _consultar_tramos_wkb(condiciones, params, max_rows)
+        logprint(f"   {len(wkb)} filas recibidas en {time.perf_counter() - inicio:.2f} s.")
+    except Exception as e:
+        logprint(f"   No se pudo cargar 'geometry_proj' en binario: {e}")
+        logging.warning(f"No se pudo cargar 'geometry_proj' en binario: {e}")
+        return None
+
+    if arrow:
+        return _tabla_arrow_tramos(codtramos, longitudes, wkb)
+
+    import geopandas as gpd
+    geometrias = shapely.from_wkb(wkb) if len(wkb) else np.array([], dtype=object)
+    gdf = gpd.GeoDataFrame({"CODTRAMO": codtramos, "LONGITUD": longitudes}, geometry=geometrias, crs=CRS_PROJECTED)
+    logprint(f"   Tramos de gas cargados: {len(gdf)} filas LineString válidas (ya proyectadas a {CRS_PROJECTED}).")
+    return gdf
+
+
+# Teselas de la red para el mapa (esquema XYZ de Leaflet/OSM)
+MAX_ZOOM_TESELAS = 22
+MAX_TRAMOS_TESELA = 20000 # Tope de tramos por tesela; si se supera la respuesta se marca como truncada
+TOLERANCIA_PIXELES_TESELA = 1.0 # Simplificación: se eliminan detalles menores a ~1 píxel de pantalla
+
+
+def limites_tesela(z, x, y):
+    """(min_lon, min_lat, max_lon, max_lat) en EPSG:4326 de la tesela XYZ z/x/y (Web Mercator)."""
+    n = 2 ** z
+    def lon(i):
+        return i / n * 360.0 - 180.0
+    def lat(j):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * j / n))))
+    return lon(x), lat(y + 1), lon(x + 1), lat(y)
+
+
+def tolerancia_tesela(z):
+    """Tolerancia de simplificación (grados) equivalente a TOLERANCIA_PIXELES_TESELA en una tesela de 256 px."""
+    return TOLERANCIA_PIXELES_TESELA * 360.0 / (256 * 2 ** z)
+
+
+def tesela_tramos_geojson(z, x, y, logprint, max_tramos=MAX_TRAMOS_TESELA):
+    """
+    Devuelve un FeatureCollection GeoJSON (str) con los tramos que cruzan la tesela z/x/y, simplificados
+    en PostGIS con ST_SimplifyPreserveTopology según el zoom. Los tramos más chicos que la tolerancia
+    (invisibles a ese zoom) no se envían. La selección usa el índice GiST vía ST_Intersects.
+    """
+    tolerancia = tolerancia_tesela(z)
+    condiciones, params = _filtros_tramos(bbox=limites_tesela(z, x, y))
+    condiciones.append("(ST_XMax(geometry) - ST_XMin(geometry)) + (ST_YMax(geometry) - ST_YMin(geometry)) >= :tolerancia")
+    params.update(tolerancia=tolerancia, limite=max_tramos + 1)
+    from sqlalchemy import text
+    query = text(
+        "SELECT \"CODTRAMO\", \"LONGITUD\", ST_AsGeoJSON(ST_SimplifyPreserveTopology(geometry, :tolerancia), 6) "
+        f"FROM tramos_gas WHERE {' AND '.join(condiciones)} LIMIT :limite"
+    )
+    with obtener_engine().connect() as conn:
+        filas = conn.execute(query, params).fetchall()
+    truncada = len(filas) > max_tramos
+    if truncada:
+        logprint(f"   Tesela {z}/{x}/{y}: más de {max_tramos} tramos, respuesta truncada.")
+    # La geometría ya viene como GeoJSON desde PostGIS: se concatena sin volver a parsearla
+    features = [
+        '{"type":"Feature","geometry":%s,"properties":%s}' % (
+            geometria,
+            json.dumps({"codtramo": None if codtramo is None else str(codtramo),
+                        "longitud": None if longitud is None else float(longitud)}, separators=(',', ':')),
+        )
+        for codtramo, longitud, geometria in filas[:max_tramos]
+    ]
+    return '{"type":"FeatureCollection","zoom":%d,"truncada":%s,"features":[%s]}' % (
+        z, 'true' if truncada else 'false', ','.join(features))
+
+
+def obtener_version_tramos(logprint):
+    """
+    Devuelve una firma de la versión actual de la tabla 'tramos_gas'.
+    Combina el OID de la tabla (cambia cuando la importación completa la reemplaza), el contador de
+    'tramos_gas_version' (lo incrementa import_data_to_db en la misma transacción de cada importación,
+    completa o incremental, así que es monótono y se ve junto con los datos) y los contadores de
+    inserciones, actualizaciones y eliminaciones de pg_stat_user_tables.
+    Los contadores de estadísticas solo detectan, con retraso, ediciones hechas fuera del importador:
+    se actualizan de forma asíncrona (hasta que el backend que escribió los publica) y vuelven a cero
+    con pg_stat_reset o una conmutación por error, así que una edición manual puede no invalidar la
+    caché hasta la siguiente importación. Sin 'tramos_gas_version' (bases importadas antes de que
+    existiera) la versión depende solo del OID y de esos contadores.
+    Si la consulta falla devuelve None (versión desconocida).
+    """
+    from sqlalchemy import text
+    query = text(
+        "SELECT c.oid, COALESCE(s.n_tup_ins, 0), COALESCE(s.n_tup_upd, 0), COALESCE(s.n_tup_del, 0) "
+        "FROM pg_class c LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid "
+        "WHERE c.oid = to_regclass('public.tramos_gas')"
+    )
+    try:
+        with obtener_engine().connect() as conn:
+            row = conn.execute(query).fetchone()
+            if row is None:
+                return None
+            version_importacion = 0
+            if conn.execute(text("SELECT to_regclass('public.tramos_gas_version')")).scalar() is not None:
+                version_importacion = conn.execute(text("SELECT version FROM tramos_gas_version WHERE id = 1")).scalar() or 0
+        oid, insertadas, actualizadas, eliminadas = row
+        return f"{oid}-{version_importacion}-{insertadas}-{actualizadas}-{eliminadas}"
+    except Exception as e:
+        logprint(f"   No se pudo obtener la versión de 'tramos_gas': {e}")
+        logging.warning(f"No se pudo obtener la versión de 'tramos_gas': {e}")
+        return None
+
+
+def misma_tabla_tramos(version_a, version_b):
+    """True si ambas versiones son de la misma tabla 'tramos_gas' (mismo OID, sin reemplazo completo)."""
+    if version_a is None or version_b is None:
+        return False
+    return version_a.split('-')[0] == version_b.split('-')[0]
+
+
+def obtener_ultimo_lote_cambios(logprint):
+    """
+    Devuelve el último lote registrado en la bitácora 'tramos_gas_cambios' (0 si está vacía),
+    o None si la bitácora no existe o la consulta falla.
+    """
+    from sqlalchemy import text
+    try:
+        with obtener_engine().connect() as conn:
+            if conn.execute(text("SELECT to_regclass('public.tramos_gas_cambios')")).scalar() is None:
+                return None
+            return int(conn.execute(text("SELECT COALESCE(MAX(lote), 0) FROM tramos_gas_cambios")).scalar())
+    except Exception as e:
+        logprint(f"   No se pudo leer la bitácora 'tramos_gas_cambios': {e}")
+        logging.warning(f"No se pudo leer la bitácora 'tramos_gas_cambios': {e}")
+        return None
+
+
+def cargar_cambios_tramos(desde_lote, logprint, bbox=None, poligono=None, radio=None):
+    """
+    Carga los cambios registrados en 'tramos_gas_cambios' después de desde_lote.
+    Devuelve (ultimo_lote, codtramos_afectados, gdf_actuales) donde gdf_actuales tiene las filas
+    que hoy existen en 'tramos_gas' para esos CODTRAMO (altas y modificaciones; las bajas no aparecen),
+    con los mismos filtros de región que cargar_tramos_gas.
+    Devuelve None si la bitácora no se puede leer.
+    """
+    import geopandas as gpd
+    from sqlalchemy import text
+    logprint(f"Cargando cambios de 'tramos_gas' posteriores al lote {desde_lote} ...")
+    try:
+        with obtener_engine().connect() as conn:
+            filas = conn.execute(
+                text("SELECT lote, codtramo FROM tramos_gas_cambios WHERE lote > :desde ORDER BY lote"),
+                {"desde": desde_lote},
+            ).fetchall()
+        ultimo_lote = max((f[0] for f in filas), default=desde_lote)
+        codtramos = sorted({str(f[1]) for f in filas})
+        if not codtramos:
+            return ultimo_lote, [], gpd.GeoDataFrame({"CODTRAMO": [], "LONGITUD": []}, geometry=[], crs="EPSG:4326")
+        condiciones, params = _filtros_tramos(bbox, poligono, radio)
+        condiciones.append("\"CODTRAMO\" = ANY(:codtramos)")
+        params["codtramos"] = codtramos
+        query = text(f"SELECT \"CODTRAMO\", \"LONGITUD\", geometry FROM tramos_gas WHERE {' AND '.join(condiciones)}")
+        gdf = gpd.read_postgis(query, obtener_engine(), geom_col='geometry', crs="EPSG:4326", params=params)
+        logprint(f"   {len(codtramos)} tramos cambiados hasta el lote {ultimo_lote}; {len(gdf)} filas vigentes.")
+        return int(ultimo_lote), codtramos, gdf
+    except Exception as e:
+        logprint(f"   No se pudieron cargar los cambios de 'tramos_gas': {e}")
+        logging.warning(f"No se pudieron cargar los cambios de 'tramos_gas': {e}", exc_info=True)
+        return None
+
+
+class SnapshotGrafo:
+    """
+    Resultado completo de un análisis: el grafo construido, los resultados de los algoritmos
+    y el log de construcción.
+    Se guarda en la caché para que las siguientes peticiones no reconstruyan nada.
+    Una vez publicado se trata como inmutable: cada análisis se calcula una sola vez (ver analisis) y las
+    simulaciones se guardan en overlays por escenario (ver OverlaySimulacion).
+    'vista' es el grafo tal como llegó: un nx.Graph (snapshot construido en este proceso) o un
+    GrafoArreglos (snapshot adjuntado de otro proceso, sobre arreglos mapeados con mmap). Los endpoints
+    trabajan con la vista; 'grafo' devuelve un nx.Graph y, si la vista no lo es, lo construye la
+    primera vez que un algoritmo de NetworkX lo pide.
+    """
+    def __init__(self, version, parametros, grafo, log=None):
+        self.version = version
+        self.parametros = parametros
+        self.vista = grafo
+        self._grafo = None if isinstance(grafo, GrafoArreglos) else grafo
+        self._lock_grafo = threading.Lock()
+        self.log = log if log is not None else []
+        self.resultados = {} # Resultados de los algoritmos (dijkstra, mst, kmeans, ...)
+        self.modelo_kmeans = None # {'configuracion', 'centroides'} del KMeans de este snapshot (ver _kmeans_snapshot)
+        self.escenarios = {} # escenario_id -> OverlaySimulacion
+        self.creado_en = time.time()
+        self.nombre_compartido = None # Nombre con el que se publicó para otros procesos (ver snapshot_compartido)
+        self.lote_cambios = None # Último lote de 'tramos_gas_cambios' incluido en el grafo (None si no se conoce)
+        self._analisis_en_curso = {} # nombre -> Future del análisis que se está calculando
+        self._lock_analisis = threading.Lock() # Solo para registrar los análisis en curso
+        self._lock_escenarios = threading.Lock() # Aparte, para no esperar a un análisis largo
+
+    @property
+    def grafo(self):
+        """Grafo NetworkX del snapshot (construido desde la vista de arreglos la primera vez, si hace falta)."""
+        if self._grafo is None:
+            with self._lock_grafo:
+                if self._grafo is None:
+                    self._grafo = grafo_networkx(self.vista)
+        return self._grafo
+
+    def grafo_para(self, motor):
+        """El grafo a pasar a un algoritmo con ese motor: la vista para 'csr', el nx.Graph para 'networkx'."""
+        return self.grafo if motor == 'networkx' else self.vista
+
+    def escenario(self, escenario_id='default'):
+        """
+        Devuelve el OverlaySimulacion del escenario, creándolo si no existe.
+        Los escenarios viven en este objeto; si el snapshot está publicado, app los comparte con los
+        demás workers a través de snapshot_compartido (ver OverlaySimulacion).
+        """
+        with self._lock_escenarios:
+            overlay = self.escenarios.get(escenario_id)
+            if overlay is None:
+                overlay = OverlaySimulacion()
+                self.escenarios[escenario_id] = overlay
+            return overlay
+
+    def analisis(self, nombre, logprint):
+        """
+        Devuelve el resultado del análisis 'nombre' (ver ANALISIS_DISPONIBLES), calculándolo
+        solo la primera vez que se pide y memoizándolo en self.resultados.
+        Los resultados memoizados se devuelven sin tomar ningún lock. Mientras se calcula, las demás
+        peticiones del MISMO análisis esperan su Future; las de otros análisis no esperan (un
+        Bellman-Ford largo no frena a Dijkstra, MST ni KMeans).
+        """
+        nombre = ALIAS_ANALISIS.get(nombre, nombre)
+        if nombre in self.resultados:
+            return self.resultados[nombre]
+        with self._lock_analisis:
+            if nombre in self.resultados:
+                return self.resultados[nombre]
+            futuro = self._analisis_en_curso.get(nombre)
+            calcular = futuro is None
+            if calcular:
+                futuro = self._analisis_en_curso[nombre] = Future()
+        if not calcular:
+            return futuro.result()
+
+        try:
+            with metricas.medir_etapa(f'analisis_{nombre}', logprint):
+                resultado = ANALISIS_DISPONIBLES[nombre](self, logprint)
+        except BaseException as e:
+            with self._lock_analisis:
+                del self._analisis_en_curso[nombre]
+            futuro.set_exception(e)
+            raise
+        with self._lock_analisis:
+            self.resultados[nombre] = resultado
+            del self._analisis_en_curso[nombre]
+        futuro.set_result(resultado)
+        return resultado
+
+
+class CacheSnapshots:
+    """
+    Caché en memoria de snapshots del grafo, indexada por (versión de 'tramos_gas', parámetros).
+    Cuando la versión de la tabla cambia, los snapshots de versiones anteriores se descartan.
+    El lock solo protege las búsquedas e inserciones: cada construcción corre fuera de él y se
+    registra como un Future por clave, así las peticiones simultáneas con la misma clave esperan
+    ese Future (sin reconstruir el grafo) y las de otras claves no esperan nada.
+    """
+    def __init__(self, max_entradas=4):
+        self.max_entradas = max_entradas
+        self._snapshots = {}
+        self._en_construccion = {} # clave -> Future del snapshot que se está construyendo
+        self._version_actual = None # Última versión conocida de 'tramos_gas' (las anteriores no se guardan)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _clave(version, parametros):
+        return (version, tuple(sorted(parametros.items())))
+
+    def obtener(self, version, parametros, constructor, logprint):
+        """
+        Devuelve el snapshot para (version, parametros), construyéndolo con
+        constructor(version, parametros, logprint, base) si no está en caché. base es el snapshot
+        más reciente de una versión anterior con los mismos parámetros (o None), para que el
+        constructor pueda actualizarlo de forma incremental en lugar de reconstruirlo.
+        Si la versión es desconocida (None) se reutiliza el último snapshot con esos parámetros.
+        """
+        clave = self._clave(version, parametros)
+        with self._lock:
+            if version is None:
+                candidatos = [s for s in self._snapshots.values() if s.parametros == parametros]
+                if candidatos:
+                    snapshot = max(candidatos, key=lambda s: s.creado_en)
+                    logprint("   Versión de 'tramos_gas' desconocida. Usando el último snapshot en caché.")
+                    return snapshot
+            else:
+                snapshot = self._snapshots.get(clave)
+                if snapshot is not None:
+                    logprint(f"   Usando snapshot del grafo en caché (versión {version}).")
+                    return snapshot
+
+            futuro = self._en_construccion.get(clave)
+            if futuro is None:
+                futuro = self._en_construccion[clave] = Future()
+                base = max((s for s in self._snapshots.values() if s.parametros == parametros),
+                           key=lambda s: s.creado_en, default=None)
+                # Invalidar snapshots de versiones anteriores de la tabla
+                if version is not None:
+                    self._version_actual = version
+                    for c in [c for c in self._snapshots if c[0] != version]:
+                        del self._snapshots[c]
+                construir = True
+            else:
+                construir = False
+
+        if not construir:
+            # Otra petición está construyendo el mismo snapshot: se espera su resultado (o su error)
+            logprint(f"   Esperando el snapshot del grafo que construye otra petición (versión {version}).")
+            return futuro.result()
+
+        try:
+            snapshot = constructor(version, parametros, logprint, base)
+        except BaseException as e:
+            with self._lock:
+                del self._en_construccion[clave]
+            futuro.set_exception(e)
+            raise
+        with self._lock:
+            del self._en_construccion[clave]
+            # Si mientras tanto se pidió una versión más nueva, este snapshot se devuelve pero no se guarda
+            if version is None or version == self._version_actual:
+                self._snapshots[clave] = snapshot
+                while len(self._snapshots) > self.max_entradas:
+                    mas_antiguo = min((c for c in self._snapshots if c != clave), key=lambda c: self._snapshots[c].creado_en)
+                    del self._snapshots[mas_antiguo]
+        futuro.set_result(snapshot)
+        return snapshot
+
+    def buscar(self, version, parametros):
+        """Devuelve el snapshot en caché para (version, parametros) sin construirlo, o None."""
+        with self._lock:
+            return self._snapshots.get(self._clave(version, parametros))
+
+    def buscar_compartido(self, nombre):
+        """Devuelve el snapshot en caché publicado con ese nombre compartido, o None."""
+        with self._lock:
+            return next((s for s in self._snapshots.values() if s.nombre_compartido == nombre), None)
+
+    def agregar(self, snapshot):
+        """
+        Guarda un snapshot obtenido fuera de obtener() (p. ej. adjuntado del snapshot compartido) y
+        devuelve el que queda en caché: si ya había uno para su clave, ese (con sus escenarios).
+        """
+        clave = self._clave(snapshot.version, snapshot.parametros)
+        with self._lock:
+            existente = self._snapshots.get(clave)
+            if existente is not None:
+                return existente
+            self._snapshots[clave] = snapshot
+            while len(self._snapshots) > self.max_entradas:
+                mas_antiguo = min((c for c in self._snapshots if c != clave), key=lambda c: self._snapshots[c].creado_en)
+                del self._snapshots[mas_antiguo]
+            return snapshot
+
+    def invalidar(self):
+        with self._lock:
+            self._snapshots.clear()
+
+
+class IndiceEspacialNodos:
+    """
+    Índice espacial (KD-tree) sobre las coordenadas proyectadas de los nodos del grafo.
+    Las consultas devuelven posiciones enteras en nodos_xy junto con la distancia en metros.
+    El KD-tree se construye en la primera consulta: un snapshot adjuntado que solo sirve
+    /api/analisis no lo necesita.
+    """
+    def __init__(self, nodos_xy):
+        self.nodos_xy = np.asarray(nodos_xy, dtype=float).reshape(-1, 2)
+        self._kdtree = None
+        self._lock = threading.Lock()
+
+    @property
+    def _arbol(self):
+        """cKDTree de los nodos (None si no hay nodos), construido una sola vez."""
+        if self._kdtree is None and len(self.nodos_xy):
+            with self._lock:
+                if self._kdtree is None:
+                    from scipy.spatial import cKDTree
+                    self._kdtree = cKDTree(self.nodos_xy)
+        return self._kdtree
+
+    def __len__(self):
+        return len(self.nodos_xy)
+
+    def nodo(self, idx):
+        """Devuelve la tupla (x, y) del nodo idx, igual a la clave usada en el grafo."""
+        return tuple(self.nodos_xy[idx].tolist())
+
+    def mas_cercano(self, punto):
+        """Devuelve (idx, distancia) del nodo más cercano a punto, o (None, inf) si el índice está vacío."""
+        if self._arbol is None:
+            return None, float('inf')
+        dist, idx = self._arbol.query(punto, k=1)
+        return int(idx), float(dist)
+
+    def k_mas_cercanos(self, punto, k):
+        """Devuelve una lista [(idx, distancia), ...] con los k nodos más cercanos, ordenada por distancia."""
+        if self._arbol is None or k <= 0:
+            return []
+        k = min(k, len(self))
+        dist, idx = self._arbol.query(punto, k=k)
+        return [(int(i), float(d)) for i, d in zip(np.atleast_1d(idx), np.atleast_1d(dist))]
+
+    def indices_exactos(self, puntos):
+        """Posición de cada punto (M, 2) que coincide exactamente con un nodo, o -1 si no es un nodo."""
+        puntos = np.asarray(puntos, dtype=float).reshape(-1, 2)
+        if self._arbol is None or len(puntos) == 0:
+            return np.full(len(puntos), -1, dtype=np.int64)
+        dist, idx = self._arbol.query(puntos, k=1)
+        return np.where(dist == 0.0, idx, -1).astype(np.int64)
+
+    def dentro_de_radio(self, punto, radio):
+        """Devuelve [(idx, distancia), ...] de los nodos a menos de radio metros, ordenada por distancia."""
+        if self._arbol is None:
+            return []
+        idx = np.asarray(self._arbol.query_ball_point(punto, r=radio), dtype=np.int64)
+        dist = np.hypot(self.nodos_xy[idx, 0] - punto[0], self.nodos_xy[idx, 1] - punto[1])
+        orden = np.argsort(dist, kind='stable')
+        return [(int(i), float(d)) for i, d in zip(idx[orden], dist[orden])]
+
+
+class GrafoArreglos:
+    """
+    Grafo de la red guardado solo como arreglos (los mismos G.graph[...] que arma construir_grafo_red:
+    nodos_xy, aristas, CSR, componentes, tramos, clusters y niveles), sin grafo NetworkX.
+    Es lo que usa un snapshot adjuntado desde otro proceso: los arreglos siguen mapeados con mmap
+    y no hay que crear un objeto Python por nodo. Implementa la parte de la interfaz de nx.Graph
+    que usan las funciones de este módulo (graph, number_of_nodes, number_of_edges y 'nodo in G');
+    grafo_networkx lo convierte para los algoritmos que necesitan NetworkX.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+
+    def number_of_nodes(self):
+        return len(self.graph['nodos_xy'])
+
+    def number_of_edges(self):
+        return len(self.graph['aristas_origen'])
+
+    def __len__(self):
+        return self.number_of_nodes()
+
+    def __contains__(self, nodo):
+        try:
+            return bool(indices_de_nodos(self, [nodo])[0] >= 0)
+        except (TypeError, ValueError):
+            return False
+
+
+def grafo_networkx(G):
+    """
+    Devuelve G como nx.Graph: si es un GrafoArreglos, crea los nodos (tuplas proyectadas, en el orden
+    de nodos_xy) y las aristas con su peso, y comparte con él el mismo dict G.graph.
+    """
+    if not isinstance(G, GrafoArreglos):
+        return G
+    import networkx as nx
+    nodos = [tuple(xy) for xy in np.asarray(G.graph['nodos_xy']).tolist()]
+    H = nx.Graph()
+    H.add_nodes_from(nodos)
+    H.add_weighted_edges_from(zip([nodos[i] for i in np.asarray(G.graph['aristas_origen']).tolist()],
+                                  [nodos[i] for i in np.asarray(G.graph['aristas_destino']).tolist()],
+                                  np.asarray(G.graph['aristas_peso']).tolist()), weight='weight')
+    H.graph = G.graph
+    return H
+
+
+_LOCK_LANDMARKS = threading.Lock()
+
+
+class GrafoCSR:
+    """
+    Representación compacta del grafo: coordenadas de nodos en un arreglo NumPy (N, 2) y
+    adyacencia no dirigida en formato CSR con pesos float (metros proyectados).
+    Los nodos se identifican por su posición entera; Dijkstra, MST y componentes conexas
+    se resuelven con scipy.sparse.csgraph.
+    """
+    def __init__(self, nodos_xy, origen, destino, pesos, indice_espacial=None):
+        self.nodos_xy = np.asarray(nodos_xy, dtype=float).reshape(-1, 2)
+        n = len(self.nodos_xy)
+        origen = np.asarray(origen, dtype=np.int32)
+        destino = np.asarray(destino, dtype=np.int32)
+        pesos = np.asarray(pesos, dtype=float)
+        # Cada arista no dirigida se guarda en ambos sentidos. Las aristas deben venir deduplicadas:
+        # csr_matrix suma los duplicados.
+        from scipy.sparse import csr_matrix
+        self.matriz = csr_matrix(
+            (np.concatenate([pesos, pesos]), (np.concatenate([origen, destino]), np.concatenate([destino, origen]))),
+            shape=(n, n),
+        )
+        self.indice_espacial = indice_espacial if indice_espacial is not None else IndiceEspacialNodos(self.nodos_xy)
+        self._iniciar_cache_filas()
+
+    def _iniciar_cache_filas(self):
+        # Filas de distancias por origen (LRU, ver matriz_distancias), compartidas entre hilos
+        self._filas_distancias = OrderedDict()
+        self._lock_filas = threading.Lock()
+
+    @classmethod
+    def desde_grafo(cls, G):
+        """Construye el GrafoCSR de un grafo NetworkX, reutilizando los arreglos de construir_grafo_red si existen."""
+        if 'nodos_xy' in G.graph:
+            return cls(G.graph['nodos_xy'], G.graph['aristas_origen'], G.graph['aristas_destino'],
+                       G.graph['aristas_peso'], G.graph.get('indice_espacial'))
+        nodos = list(G.nodes())
+        posicion = {n: i for i, n in enumerate(nodos)}
+        aristas = [(posicion[u], posicion[v], d.get('weight', 1.0)) for u, v, d in G.edges(data=True) if u != v]
+        origen, destino, pesos = zip(*aristas) if aristas else ((), (), ())
+        return cls(np.array(nodos, dtype=float).reshape(-1, 2), origen, destino, pesos)
+
+    @classmethod
+    def desde_csr(cls, nodos_xy, indptr, indices, pesos, indice_espacial=None):
+        """Construye el GrafoCSR sobre arreglos CSR ya simétricos (p. ej. mapeados con mmap), sin copiarlos."""
+        csr = cls.__new__(cls)
+        csr.nodos_xy = np.asarray(nodos_xy, dtype=float).reshape(-1, 2)
+        n = len(csr.nodos_xy)
+        from scipy.sparse import csr_matrix
+        csr.matriz = csr_matrix((pesos, indices, indptr), shape=(n, n), copy=False)
+        csr.indice_espacial = indice_espacial if indice_espacial is not None else IndiceEspacialNodos(csr.nodos_xy)
+        csr._iniciar_cache_filas()
+        return csr
+
+    @property
+    def indptr(self):
+        return self.matriz.indptr
+
+    @property
+    def indices(self):
+        return self.matriz.indices
+
+    @property
+    def pesos(self):
+        return self.matriz.data
+
+    def number_of_nodes(self):
+        return self.matriz.shape[0]
+
+    def number_of_edges(self):
+        return self.matriz.nnz // 2
+
+    def nodo(self, idx):
+        """Devuelve la tupla (x, y) del nodo idx (la clave equivalente en el grafo NetworkX)."""
+        return tuple(self.nodos_xy[idx].tolist())
+
+    def indice_de(self, nodo):
+        """Devuelve la posición entera del nodo con coordenadas exactas 'nodo', o None si no existe."""
+        idx, dist = self.indice_espacial.mas_cercano(nodo)
+        if idx is None or dist != 0.0:
+            return None
+        return idx
+
+    def dijkstra(self, origen_idx):
+        """Distancias (metros) desde origen_idx a todos los nodos; inf si no son alcanzables."""
+        from scipy.sparse import csgraph
+        return csgraph.dijkstra(self.matriz, directed=False, indices=origen_idx)
+
+    def ruta(self, origen_idx, destino_idx):
+        """Devuelve (lista de índices del camino, distancia en metros) o (None, inf) si no hay camino."""
+        from scipy.sparse import csgraph
+        dist, predecesores = csgraph.dijkstra(self.matriz, directed=False, indices=origen_idx, return_predecessors=True)
+        if not np.isfinite(dist[destino_idx]):
+            return None, float('inf')
+        camino = [destino_idx]
+        while camino[-1] != origen_idx:
+            camino.append(int(predecesores[camino[-1]]))
+        camino.reverse()
+        return camino, float(dist[destino_idx])
+
+    def matriz_distancias(self, origenes, destinos):
+        """
+        Matriz (len(origenes), len(destinos)) de distancias en metros entre nodos (índices enteros);
+        inf donde no hay camino. Los orígenes sin fila en caché se resuelven con llamadas multi-origen
+        de csgraph.dijkstra, por lotes de tantos orígenes como filas completas (N float64) entran en
+        MAX_BYTES_CACHE_FILAS, así la memoria temporal no crece con len(origenes) * N.
+        Solo las últimas filas que caben en la caché (LRU) se guardan completas; del resto se conservan
+        las columnas de los destinos.
+        """
+        origenes = [int(o) for o in origenes]
+        destinos = np.asarray(destinos, dtype=np.int64)
+        if not origenes:
+            return np.empty((0, len(destinos)))
+        max_filas = max(1, MAX_BYTES_CACHE_FILAS // max(1, self.number_of_nodes() * 8))
+
+        with self._lock_filas:
+            filas = {o: self._filas_distancias[o][destinos] for o in origenes if o in self._filas_distancias}
+            for o in filas:
+                self._filas_distancias.move_to_end(o)
+        faltantes = sorted(set(origenes) - set(filas))
+        if faltantes:
+            from scipy.sparse import csgraph
+            primera_cacheada = max(0, len(faltantes) - max_filas)
+            for inicio in range(0, len(faltantes), max_filas):
+                lote = faltantes[inicio:inicio + max_filas]
+                distancias = np.atleast_2d(csgraph.dijkstra(self.matriz, directed=False, indices=lote))
+                completas = []
+                for posicion, (o, fila) in enumerate(zip(lote, distancias), start=inicio):
+                    filas[o] = fila[destinos]
+                    if posicion >= primera_cacheada:
+                        completas.append((o, fila))
+                del distancias
+                if completas:
+                    with self._lock_filas:
+                        for o, fila in completas:
+                            self._filas_distancias[o] = fila
+                            self._filas_distancias.move_to_end(o)
+                        while len(self._filas_distancias) > max_filas:
+                            self._filas_distancias.popitem(last=False)
+
+        return np.vstack([filas[o] for o in origenes])
+
+    def preparar_landmarks(self, k=NUM_LANDMARKS):
+        """
+        Preprocesamiento ALT: elige k landmarks por el método del punto más lejano dentro de la
+        componente conexa más grande y guarda las distancias de cada nodo a cada landmark (N, k).
+        Las distancias a nodos de otras componentes se guardan como 0, así esos landmarks no
+        aportan cota (la heurística sigue siendo admisible).
+        """
+        n = self.number_of_nodes()
+        if n == 0 or k <= 0:
+            self.landmarks, self.distancias_landmarks = [], None
+            return self.landmarks
+        _, etiquetas = self.componentes()
+        mayor = np.bincount(etiquetas).argmax()
+        candidatos = etiquetas == mayor
+
+        landmarks = []
+        distancias = []
+        # El primer landmark es el nodo más lejano a un nodo cualquiera de la componente
+        actual = int(np.flatnonzero(candidatos)[0])
+        distancia_minima = self.dijkstra(actual)
+        for _ in range(min(k, int(candidatos.sum()))):
+            lejanos = np.where(candidatos & np.isfinite(distancia_minima), distancia_minima, -1.0)
+            if landmarks:
+                lejanos[landmarks] = -1.0
+            siguiente = int(lejanos.argmax())
+            if lejanos[siguiente] < 0:
+                break
+            dist = self.dijkstra(siguiente)
+            landmarks.append(siguiente)
+            distancias.append(dist)
+            distancia_minima = np.minimum(distancia_minima, dist) if len(landmarks) > 1 else dist
+
+        matriz = np.column_stack(distancias)
+        matriz[~np.isfinite(matriz)] = 0.0
+        self.landmarks = landmarks
+        self.distancias_landmarks = matriz
+        return landmarks
+
+    def asegurar_landmarks(self):
+        """Prepara los landmarks la primera vez que se piden (una sola vez aunque lleguen rutas concurrentes)."""
+        if getattr(self, 'landmarks', None) is not None:
+            return self.landmarks
+        with _LOCK_LANDMARKS:
+            if getattr(self, 'landmarks', None) is None:
+                self.preparar_landmarks()
+        return self.landmarks
+
+    def _heuristica(self, destino_idx, usar_landmarks):
+        """Devuelve h(vecinos) -> arreglo de cotas inferiores de la distancia a destino_idx."""
+        destino_xy = self.nodos_xy[destino_idx]
+        landmarks = self.distancias_landmarks if usar_landmarks else None
+        landmarks_destino = landmarks[destino_idx] if landmarks is not None else None
+
+        def h(vecinos):
+            # Distancia euclidiana: los pesos son longitudes euclidianas, así que nunca sobreestima
+            cota = np.hypot(self.nodos_xy[vecinos, 0] - destino_xy[0], self.nodos_xy[vecinos, 1] - destino_xy[1])
+            if landmarks is not None:
+                # Desigualdad triangular con cada landmark: |d(l, t) - d(l, v)| <= d(v, t)
+                cota = np.maximum(cota, np.abs(landmarks[vecinos] - landmarks_destino).max(axis=1))
+            return cota
+        return h
+
+    def ruta_astar(self, origen_idx, destino_idx, usar_landmarks=True):
+        """
+        A* sobre la matriz CSR con heurística euclidiana y, si se prepararon, cotas ALT de landmarks.
+        Devuelve (lista de índices del camino, distancia en metros) o (None, inf) si no hay camino.
+        """
+        usar_landmarks = usar_landmarks and getattr(self, 'distancias_landmarks', None) is not None
+        h = self._heuristica(destino_idx, usar_landmarks)
+        indptr, indices, pesos = self.indptr, self.indices, self.pesos
+
+        distancia = {origen_idx: 0.0}
+        predecesor = {origen_idx: -1}
+        cerrados = set()
+        cola = [(float(h(np.array([origen_idx]))[0]), 0.0, origen_idx)]
+        while cola:
+            _, g, v = heapq.heappop(cola)
+            if v in cerrados:
+                continue
+            if v == destino_idx:
+                camino = [v]
+                while predecesor[camino[-1]] != -1:
+                    camino.append(predecesor[camino[-1]])
+                camino.reverse()
+                return camino, g
+            cerrados.add(v)
+            inicio, fin = indptr[v], indptr[v + 1]
+            vecinos = indices[inicio:fin]
+            cotas = h(vecinos).tolist()
+            for w, peso, cota in zip(vecinos.tolist(), pesos[inicio:fin].tolist(), cotas):
+                if w in cerrados:
+                    continue
+                nueva = g + peso
+                if nueva < distancia.get(w, float('inf')):
+                    distancia[w] = nueva
+                    predecesor[w] = v
+                    heapq.heappush(cola, (nueva + cota, nueva, w))
+        return None, float('inf')
+
+    def mst(self):
+        """Devuelve (matriz CSR del bosque de expansión mínima, peso total en metros)."""
+        from scipy.sparse import csgraph
+        arbol = csgraph.minimum_spanning_tree(self.matriz)
+        return arbol, float(arbol.sum())
+
+    def componentes(self):
+        """
+        Devuelve (número de componentes conexas, etiqueta de componente por nodo).
+        Se calcula una sola vez por grafo.
+        """
+        if getattr(self, '_componentes', None) is None:
+            from scipy.sparse import csgraph
+            n_componentes, etiquetas = csgraph.connected_components(self.matriz, directed=False)
+            self._componentes = (int(n_componentes), etiquetas.astype(np.int32))
+        return self._componentes
+
+
+def obtener_grafo_csr(G):
+    """Devuelve el GrafoCSR asociado a G, construyéndolo la primera vez y guardándolo en G.graph['csr']."""
+    csr = G.graph.get('csr')
+    if csr is None:
+        csr = GrafoCSR.desde_grafo(G)
+        G.graph['csr'] = csr
+    return csr
+
+
+def etiquetas_componentes(G):
+    """Etiqueta de componente conexa de cada nodo, en el orden de G.nodes() (arreglo NumPy)."""
+    return obtener_grafo_csr(G).componentes()[1]
+
+
+def resumen_componentes(G, max_tamanos=20):
+    """
+    Resumen de la fragmentación de la red: número de componentes, tamaño de la mayor,
+    nodos fuera de ella y los tamaños de las componentes más grandes (en nodos).
+    """
+    n_componentes, etiquetas = obtener_grafo_csr(G).componentes()
+    tamanos = np.sort(np.bincount(etiquetas, minlength=n_componentes))[::-1] if len(etiquetas) else np.array([], dtype=np.int64)
+    mayor = int(tamanos[0]) if len(tamanos) else 0
+    return {
+        'num_componentes': n_componentes,
+        'mayor': mayor,
+        'nodos_fuera_del_mayor': int(len(etiquetas) - mayor),
+        'tamanos': tamanos[:max_tamanos].tolist(),
+    }
+
+
+def _heuristica_euclidiana(u, v):
+    return math.hypot(u[0] - v[0], u[1] - v[1])
+
+
+def calcular_ruta_optima(G, origen, destino, motor=MOTOR_GRAFO_PREDETERMINADO, algoritmo=ALGORITMO_RUTA_PREDETERMINADO):
+    """
+    Camino más corto entre dos nodos (tuplas proyectadas) del grafo.
+    algoritmo: 'dijkstra', 'astar' (heurística euclidiana) o 'alt' (A* con landmarks; los landmarks
+    se preparan en la primera ruta 'alt' del grafo CSR si el snapshot no los trae).
+    Devuelve (lista de nodos del camino, distancia en metros) y lanza nx.NetworkXNoPath si no hay camino.
+    """
+    import networkx as nx
+    csr = obtener_grafo_csr(G)
+    origen_idx, destino_idx = csr.indice_de(origen), csr.indice_de(destino)
+    if origen_idx is None or destino_idx is None:
+        raise nx.NodeNotFound(f"Nodo {origen if origen_idx is None else destino} no encontrado en el grafo CSR.")
+    # Nodos en componentes distintas: no hay camino, sin necesidad de buscar
+    _, etiquetas = csr.componentes()
+    if etiquetas[origen_idx] != etiquetas[destino_idx]:
+        raise nx.NetworkXNoPath(f"No hay camino entre {origen} y {destino}: están en componentes distintas.")
+
+    if motor == 'csr':
+        if algoritmo == 'dijkstra':
+            camino, distancia = csr.ruta(origen_idx, destino_idx)
+        else:
+            if algoritmo == 'alt':
+                csr.asegurar_landmarks()
+            camino, distancia = csr.ruta_astar(origen_idx, destino_idx, usar_landmarks=(algoritmo == 'alt'))
+        if camino is None:
+            raise nx.NetworkXNoPath(f"No hay camino entre {origen} y {destino}.")
+        return [csr.nodo(i) for i in camino], distancia
+
+    if algoritmo == 'dijkstra':
+        camino = nx.shortest_path(G, source=origen, target=destino, weight='weight')
+    else:
+        # NetworkX no tiene landmarks: 'alt' usa solo la heurística euclidiana
+        camino = nx.astar_path(G, origen, destino, heuristic=_heuristica_euclidiana, weight='weight')
+    distancia = sum(G[u][v]['weight'] for u, v in zip(camino[:-1], camino[1:]))
+    return camino, distancia
+
+
 def construir_grafo_red(gdf_gas, gdf_gas_proj, logprint):
+    """
+    Construye el grafo de la red a partir de las geometrías proyectadas (gdf_gas, geográfico,
+    no se usa y puede ser None cuando los tramos se cargaron ya proyectados).
+    Todas las coordenadas se extraen de una vez con shapely.get_coordinates, las longitudes
+    de los segmentos se calculan con NumPy y los puntos repetidos se deduplican en IDs enteros.
+    Los nodos del grafo siguen siendo tuplas (x, y) proyectadas; el nodo i de G.nodes()
+    corresponde a la fila i de G.graph['nodos_xy'].
+    """
+    import shapely
+    import networkx as nx
     logprint("Construyendo el grafo de la red ...")
+    geometrias = np.asarray(gdf_gas_proj.geometry.values)
+    # Solo LineString (type id 1); las geometrías nulas dan -1
+    es_linea = shapely.get_type_id(geometrias) == 1
+    geometrias = geometrias[es_linea]
+
+    coords, idx_linea = shapely.get_coordinates(geometrias, return_index=True)
+    nodos_xy, inversa = np.unique(coords, axis=0, return_inverse=True)
+    inversa = inversa.ravel()
+
+    origen, destino, fila_segmento, extremos = _segmentos_de_lineas(inversa, idx_linea, len(geometrias))
+    a, b, pesos = _aristas_desde_segmentos(nodos_xy, origen, destino)
+
     G = nx.Graph()
-    for idx, row in gdf_gas_proj.iterrows():
-        if row.geometry and row.geometry.geom_type == "LineString":
-            coords = list(row.geometry.coords)
-            for i in range(len(coords) - 1):
-                u = coords[i]
-                v = coords[i + 1]
-                # Asegurarse de que 'LONGITUD' exista y sea un número. Si no, usar la distancia euclidiana.
-                # Tu código original usaba la distancia euclidiana entre los puntos proyectados
-                # Esto es consistente con cómo se calculaban los pesos antes.
-                dist = ((u[0] - v[0])**2 + (u[1] - v[1])**2) ** 0.5
-                G.add_edge(u, v, weight=dist) # El peso es la distancia euclidiana en metros proyectados
-    logprint(f"   Grafo construido. Nodos: {G.number_of_nodes()}, Aristas: {G.number_of_edges()}.")
+    nodos = [tuple(xy) for xy in nodos_xy.tolist()]
+    G.add_nodes_from(nodos)
+    G.add_weighted_edges_from(zip([nodos[i] for i in a], [nodos[i] for i in b], pesos.tolist()), weight='weight')
+
+    n_componentes = _indexar_grafo(G, nodos_xy, a, b, pesos)
+    G.graph['segmentos_origen'] = origen
+    G.graph['segmentos_destino'] = destino
+    G.graph['segmentos_fila'] = fila_segmento
+    _indexar_tramos(G, extremos, _columna_tramos(gdf_gas_proj, "CODTRAMO", es_linea), _columna_tramos(gdf_gas_proj, "LONGITUD", es_linea))
+    logprint(f"   Grafo construido. Nodos: {G.number_of_nodes()}, Aristas: {G.number_of_edges()}, Componentes conexas: {n_componentes}.")
     return G
 
+
+def _segmentos_de_lineas(inversa, idx_linea, n_filas):
+    """
+    A partir del nodo de cada coordenada (inversa) y de la fila de su línea (idx_linea), devuelve
+    (origen, destino, fila) de cada segmento y los nodos extremos (n_filas, 2) de cada fila (-1 si está vacía).
+    """
+    # Un segmento une dos puntos consecutivos de la misma línea
+    mismo_tramo = idx_linea[1:] == idx_linea[:-1]
+    origen = inversa[:-1][mismo_tramo]
+    destino = inversa[1:][mismo_tramo]
+    fila = idx_linea[:-1][mismo_tramo]
+
+    # Los puntos repetidos consecutivos no aportan aristas (lazos de longitud 0)
+    no_lazo = origen != destino
+    origen, destino, fila = origen[no_lazo], destino[no_lazo], fila[no_lazo]
+
+    # Primer y último punto de cada línea, para el índice extremo -> tramos
+    extremos = np.full((n_filas, 2), -1, dtype=np.int64)
+    if len(idx_linea):
+        inicio_linea = np.flatnonzero(np.r_[True, idx_linea[1:] != idx_linea[:-1]])
+        fin_linea = np.r_[inicio_linea[1:] - 1, len(idx_linea) - 1]
+        extremos[idx_linea[inicio_linea], 0] = inversa[inicio_linea]
+        extremos[idx_linea[fin_linea], 1] = inversa[fin_linea]
+    return origen.astype(np.int64), destino.astype(np.int64), fila.astype(np.int64), extremos
+
+
+def _aristas_desde_segmentos(nodos_xy, origen, destino):
+    """Aristas no dirigidas (a < b) deduplicadas y su peso (distancia euclidiana en metros proyectados)."""
+    # El peso solo depende de los extremos, así que cualquier copia de una arista repetida sirve
+    a = np.minimum(origen, destino).astype(np.int64)
+    b = np.maximum(origen, destino).astype(np.int64)
+    _, primera = np.unique(a * len(nodos_xy) + b, return_index=True)
+    a, b = a[primera], b[primera]
+    pesos = np.hypot(nodos_xy[a, 0] - nodos_xy[b, 0], nodos_xy[a, 1] - nodos_xy[b, 1])
+    return a, b, pesos
+
+
+def _indexar_grafo(G, nodos_xy, a, b, pesos, nodos_latlon=None):
+    """
+    Guarda en G.graph los arreglos de la red, el índice espacial, el grafo CSR y las componentes
+    conexas, reutilizables por otras etapas sin volver a recorrer el grafo. Devuelve el número de componentes.
+    """
+    G.graph['nodos_xy'] = nodos_xy
+    G.graph['aristas_origen'] = a
+    G.graph['aristas_destino'] = b
+    G.graph['aristas_peso'] = pesos
+    G.graph['indice_espacial'] = IndiceEspacialNodos(nodos_xy)
+    G.graph['nodos_latlon'] = nodos_latlon if nodos_latlon is not None else proyectadas_a_geograficas(nodos_xy)
+
+    # Grafo CSR y componentes conexas, calculadas una vez por construcción
+    csr = GrafoCSR(nodos_xy, a, b, pesos, G.graph['indice_espacial'])
+    G.graph['csr'] = csr
+    n_componentes, G.graph['componentes'] = csr.componentes()
+    return n_componentes
+
+
+def _columna_tramos(gdf, columna, filas):
+    """Valores de CODTRAMO (texto) o LONGITUD (float, NaN si falta) de las filas seleccionadas."""
+    n_filas = int(np.count_nonzero(filas))
+    if columna == "CODTRAMO":
+        if columna not in gdf.columns:
+            return np.full(n_filas, "", dtype=object)
+        return np.array([str(c) for c in gdf[columna].to_numpy()[filas]], dtype=object)
+    if columna not in gdf.columns:
+        return np.full(n_filas, np.nan)
+    return gdf[columna].to_numpy(dtype=float, na_value=np.nan)[filas]
+
+
+def _indexar_tramos(G, extremos, codtramos, longitudes):
+    """Guarda la atribución de tramos: índice extremo -> filas, CODTRAMO y LONGITUD por fila."""
+    # Índice extremo -> tramos: para cada nodo, las filas (en orden) cuyo primer o último punto es ese nodo
+    filas = np.concatenate([np.arange(len(extremos)), np.arange(len(extremos))])
+    nodos_extremo = np.concatenate([extremos[:, 0], extremos[:, 1]])
+    con_nodo = nodos_extremo >= 0
+    G.graph['tramos_indptr'], G.graph['tramos_filas'] = _agrupar_filas_por_nodo(
+        nodos_extremo[con_nodo], filas[con_nodo], len(G.graph['nodos_xy']))
+    G.graph['tramos_extremos'] = extremos
+    G.graph['tramos_codtramo'] = codtramos
+    G.graph['tramos_longitud'] = longitudes
+
+
+def actualizar_grafo_red(G, codtramos_quitados, gdf_agregados_proj, logprint, max_filas=None):
+    """
+    Aplica un cambio incremental de tramos sobre el grafo y devuelve un grafo NUEVO (G no se modifica,
+    puede seguir publicado). Se quitan las filas cuyo CODTRAMO está en codtramos_quitados y se agregan
+    las LineString de gdf_agregados_proj (ya proyectado); un tramo modificado va en ambos.
+    En NetworkX solo se insertan/eliminan las aristas y nodos que cambian; los arreglos, el CSR y las
+    componentes se recalculan con NumPy a partir de los segmentos guardados en G.graph.
+    Con max_filas no se agregan tramos por encima de ese total (como el LIMIT de cargar_tramos_gas).
+    Devuelve None si G no tiene los segmentos necesarios (hay que reconstruirlo completo).
+    """
+    import shapely
+    if 'segmentos_fila' not in G.graph or 'tramos_extremos' not in G.graph:
+        logprint("   El grafo en caché no tiene segmentos por tramo; no se puede actualizar de forma incremental.")
+        return None
+    logprint("Actualizando el grafo de la red de forma incremental ...")
+    nodos_xy = G.graph['nodos_xy']
+    n = len(nodos_xy)
+
+    # 1. Filas que se conservan y su nueva posición
+    codtramos = np.asarray(G.graph['tramos_codtramo']).astype(object)
+    conservar = ~np.isin(codtramos.astype(str), np.array([str(c) for c in codtramos_quitados], dtype=str))
+    nueva_fila = np.cumsum(conservar) - 1
+    n_conservadas = int(conservar.sum())
+    fila_segmento = np.asarray(G.graph['segmentos_fila'])
+    segmento_vigente = conservar[fila_segmento]
+    origen = np.asarray(G.graph['segmentos_origen'])[segmento_vigente]
+    destino = np.asarray(G.graph['segmentos_destino'])[segmento_vigente]
+    fila_segmento = nueva_fila[fila_segmento[segmento_vigente]]
+
+    # 2. Filas agregadas: las coordenadas que ya son nodos los reutilizan, el resto son nodos nuevos al final
+    geometrias = np.asarray(gdf_agregados_proj.geometry.values)
+    es_linea = shapely.get_type_id(geometrias) == 1
+    if max_filas is not None:
+        es_linea &= np.cumsum(es_linea) <= max(0, max_filas - n_conservadas)
+    geometrias = geometrias[es_linea]
+    coords, idx_linea = shapely.get_coordinates(geometrias, return_index=True)
+    nodo_coord = G.graph['indice_espacial'].indices_exactos(coords)
+    es_nuevo = nodo_coord < 0
+    nuevos_xy, inversa = np.unique(coords[es_nuevo], axis=0, return_inverse=True)
+    nodo_coord[es_nuevo] = n + inversa.ravel()
+    origen_ag, destino_ag, fila_ag, extremos_ag = _segmentos_de_lineas(nodo_coord, idx_linea, len(geometrias))
+
+    xy_total = np.vstack([nodos_xy, nuevos_xy.reshape(-1, 2)])
+    origen = np.concatenate([origen, origen_ag])
+    destino = np.concatenate([destino, destino_ag])
+    fila_segmento = np.concatenate([fila_segmento, n_conservadas + fila_ag])
+    extremos = np.vstack([np.asarray(G.graph['tramos_extremos'])[conservar], extremos_ag])
+
+    # 3. Solo quedan los nodos que siguen tocando algún tramo; se renumeran manteniendo el orden
+    en_uso = np.zeros(len(xy_total), dtype=bool)
+    en_uso[origen] = True
+    en_uso[destino] = True
+    en_uso[extremos[extremos >= 0]] = True
+    renumeracion = np.full(len(xy_total), -1, dtype=np.int64)
+    renumeracion[en_uso] = np.arange(int(en_uso.sum()))
+    origen, destino = renumeracion[origen], renumeracion[destino]
+    extremos = np.where(extremos >= 0, renumeracion[np.maximum(extremos, 0)], -1)
+    nuevos_nodos_xy = xy_total[en_uso]
+    a, b, pesos = _aristas_desde_segmentos(nuevos_nodos_xy, origen, destino)
+
+    # 4. NetworkX: sobre una copia, eliminar e insertar solo lo que cambió
+    H = G.copy()
+    nodos = [tuple(xy) for xy in nuevos_nodos_xy.tolist()]
+    quitados = np.flatnonzero(~en_uso[:n])
+    H.remove_nodes_from(tuple(nodos_xy[i].tolist()) for i in quitados)
+    H.add_nodes_from(nodos[int(en_uso[:n].sum()):])
+
+    n_nuevo = len(nuevos_nodos_xy)
+    a_viejo = renumeracion[np.asarray(G.graph['aristas_origen'])]
+    b_viejo = renumeracion[np.asarray(G.graph['aristas_destino'])]
+    sigue = (a_viejo >= 0) & (b_viejo >= 0) # Las aristas de nodos quitados ya se fueron con ellos
+    claves_viejas = np.minimum(a_viejo, b_viejo)[sigue] * n_nuevo + np.maximum(a_viejo, b_viejo)[sigue]
+    claves_nuevas = a * n_nuevo + b
+    eliminadas = claves_viejas[~np.isin(claves_viejas, claves_nuevas)]
+    agregadas = ~np.isin(claves_nuevas, claves_viejas)
+    H.remove_edges_from((nodos[k // n_nuevo], nodos[k % n_nuevo]) for k in eliminadas.tolist())
+    H.add_weighted_edges_from(zip([nodos[i] for i in a[agregadas]], [nodos[i] for i in b[agregadas]], pesos[agregadas].tolist()), weight='weight')
+
+    # 5. Arreglos, CSR, componentes y atribución de tramos del grafo nuevo
+    latlon = np.vstack([np.asarray(G.graph['nodos_latlon'])[en_uso[:n]], proyectadas_a_geograficas(xy_total[n:][en_uso[n:]])])
+    n_componentes = _indexar_grafo(H, nuevos_nodos_xy, a, b, pesos, nodos_latlon=latlon)
+    H.graph['segmentos_origen'] = origen
+    H.graph['segmentos_destino'] = destino
+    H.graph['segmentos_fila'] = fila_segmento
+    _indexar_tramos(
+        H, extremos,
+        np.concatenate([codtramos[conservar], _columna_tramos(gdf_agregados_proj, "CODTRAMO", es_linea)]),
+        np.concatenate([np.asarray(G.graph['tramos_longitud'], dtype=float)[conservar], _columna_tramos(gdf_agregados_proj, "LONGITUD", es_linea)]),
+    )
+    # Los niveles de gases de los nodos que siguen se conservan; los nodos nuevos quedan en NaN
+    # para que se les asignen niveles al completar el snapshot
+    if 'niveles_gases' in G.graph:
+        n_siguen = int(en_uso[:n].sum())
+        H.graph['niveles_gases'] = {
+            gas: np.concatenate([np.asarray(nivel, dtype=float)[en_uso[:n]], np.full(n_nuevo - n_siguen, np.nan)])
+            for gas, nivel in G.graph['niveles_gases'].items()
+        }
+    H.graph.pop('kmeans_nodos', None)
+    n_eliminadas = len(a_viejo) - int(sigue.sum()) + len(eliminadas)
+    logprint(f"   Tramos quitados: {len(conservar) - n_conservadas}, agregados: {len(geometrias)}. "
+             f"Nodos quitados: {len(quitados)}. Aristas eliminadas: {n_eliminadas}, insertadas: {int(agregadas.sum())}.")
+    logprint(f"   Grafo actualizado. Nodos: {H.number_of_nodes()}, Aristas: {H.number_of_edges()}, Componentes conexas: {n_componentes}.")
+    return H
+
+def _agrupar_filas_por_nodo(nodos, filas, n_nodos):
+    """
+    Agrupa las filas de tramos por nodo en formato CSR: (indptr, filas) con las filas del nodo i en
+    filas[indptr[i]:indptr[i + 1]], en orden ascendente y sin repetir (un tramo cerrado tiene el
+    mismo nodo al inicio y al final).
+    """
+    orden = np.lexsort((filas, nodos))
+    nodos, filas = np.asarray(nodos, dtype=np.int64)[orden], np.asarray(filas, dtype=np.int64)[orden]
+    unicos = np.r_[True, (nodos[1:] != nodos[:-1]) | (filas[1:] != filas[:-1])] if len(nodos) else np.zeros(0, dtype=bool)
+    nodos, filas = nodos[unicos], filas[unicos]
+    indptr = np.r_[0, np.cumsum(np.bincount(nodos, minlength=n_nodos))].astype(np.int64)
+    return indptr, filas
+
+
+def tramos_de_nodo(G, idx_nodo):
+    """
+    Devuelve la lista de tramos [{'codtramo': str, 'longitud': float|None}, ...] que empiezan
+    o terminan en el nodo idx_nodo, en el orden de carga de los tramos.
+    """
+    indptr = G.graph.get('tramos_indptr')
+    filas = G.graph['tramos_filas'][indptr[idx_nodo]:indptr[idx_nodo + 1]].tolist() if indptr is not None else []
+    codtramos = G.graph.get('tramos_codtramo')
+    longitudes = G.graph.get('tramos_longitud')
+    tramos = []
+    for fila in filas:
+        longitud = float(longitudes[fila])
+        tramos.append({
+            'codtramo': codtramos[fila],
+            'longitud': None if math.isnan(longitud) else longitud,
+        })
+    return tramos
+
+
+def columnas_tramos(G):
+    """
+    Columnas por nodo (listas, en el orden de los nodos) de la atribución de tramos: 'codtramo' y
+    'longitud' del primer tramo del nodo ("N/A" y None si no tiene) y 'codtramos' con todos.
+    Se arman de una vez desde los arreglos CSR de tramos, sin recorrer el grafo nodo por nodo.
+    """
+    n = G.number_of_nodes()
+    indptr = G.graph.get('tramos_indptr')
+    if n == 0:
+        return {'codtramo': [], 'codtramos': [], 'longitud': []}
+    if indptr is None:
+        return {'codtramo': ["N/A"] * n, 'codtramos': [[] for _ in range(n)], 'longitud': [None] * n}
+    indptr = np.asarray(indptr)
+    filas = np.asarray(G.graph['tramos_filas'])
+    codtramos = np.asarray(G.graph['tramos_codtramo']).astype(str)
+    tiene = indptr[1:] > indptr[:-1]
+    primera = filas[np.minimum(indptr[:-1], max(len(filas) - 1, 0))] if len(filas) else np.zeros(n, dtype=np.int64)
+    codtramo = np.full(n, "N/A", dtype=object)
+    codtramo[tiene] = codtramos[primera[tiene]]
+    longitud = np.full(n, None, dtype=object)
+    longitudes = np.asarray(G.graph['tramos_longitud'], dtype=float)[primera[tiene]]
+    longitud[np.flatnonzero(tiene)[~np.isnan(longitudes)]] = longitudes[~np.isnan(longitudes)]
+    return {
+        'codtramo': codtramo.tolist(),
+        'codtramos': [grupo.tolist() for grupo in np.split(codtramos[filas], indptr[1:-1])],
+        'longitud': longitud.tolist(),
+    }
+
+
+def atributos_nodo(G, idx_nodo, niveles=None):
+    """Atributos del nodo idx_nodo (cluster KMeans, tramos y niveles de gases) como dict, desde los arreglos del grafo."""
+    tramos = tramos_de_nodo(G, idx_nodo)
+    niveles = niveles if niveles is not None else niveles_gases(G)
+    atributos = {
+        'kmeans': int(clusters_nodos(G)[idx_nodo]),
+        'codtramo': str(tramos[0]['codtramo']) if tramos else "N/A",
+        'longitud': tramos[0]['longitud'] if tramos else None,
+        'codtramos': [str(t['codtramo']) for t in tramos],
+    }
+    atributos.update({gas: float(nivel[idx_nodo]) for gas, nivel in niveles.items()})
+    return atributos
+
+
 def encontrar_nodo_inicial(G, center_point_proj, logprint):
     logprint("Buscando nodo inicial más cercano al centro de referencia ...")
-    min_dist = float('inf')
     nodo_inicial = None
-    
-    for n in G.nodes:
-        dist = ((n[0] - center_point_proj[0])**2 + (n[1] - center_point_proj[1])**2) ** 0.5
-        if dist < min_dist:
-            min_dist = dist
-            nodo_inicial = n
+
+    indice = G.graph.get('indice_espacial')
+    if indice is not None:
+        idx, _ = indice.mas_cercano(center_point_proj)
+        if idx is not None:
+            nodo_inicial = indice.nodo(idx)
+    else:
+        # Grafo construido sin índice espacial: búsqueda lineal
+        min_dist = float('inf')
+        for n in G.nodes:
+            dist = ((n[0] - center_point_proj[0])**2 + (n[1] - center_point_proj[1])**2) ** 0.5
+            if dist < min_dist:
+                min_dist = dist
+                nodo_inicial = n
     
     if nodo_inicial:
         logprint(f"   Nodo inicial encontrado: ({nodo_inicial[0]:.8f}, {nodo_inicial[1]:.8f})")
@@ -94,13 +1356,20 @@ def encontrar_nodo_inicial(G, center_point_proj, logprint):
     return nodo_inicial
 
 
-def ejecutar_dijkstra(G, nodo_inicial, logprint):
+def ejecutar_dijkstra(G, nodo_inicial, logprint, motor=MOTOR_GRAFO_PREDETERMINADO):
+    import networkx as nx
     logprint("Ejecutando Dijkstra ...")
     try:
         if nodo_inicial not in G:
             logprint(f"   El nodo inicial {nodo_inicial} no se encuentra en el grafo. No se ejecutará Dijkstra.")
             return {}
-        lengths = nx.single_source_dijkstra_path_length(G, nodo_inicial, weight='weight') # Asegurar weight='weight'
+        if motor == 'csr':
+            csr = obtener_grafo_csr(G)
+            distancias = csr.dijkstra(csr.indice_de(nodo_inicial))
+            alcanzables = np.flatnonzero(np.isfinite(distancias))
+            lengths = {csr.nodo(i): float(distancias[i]) for i in alcanzables}
+        else:
+            lengths = nx.single_source_dijkstra_path_length(G, nodo_inicial, weight='weight') # Asegurar weight='weight'
         logprint("   Dijkstra calculado. Rutas encontradas a {} nodos.".format(len(lengths)))
         return {node: round(length / 1000, 3) for node, length in lengths.items()} # Convertir a km
     except Exception as e:
@@ -109,6 +1378,7 @@ def ejecutar_dijkstra(G, nodo_inicial, logprint):
         return {}
 
 def ejecutar_bellman_ford(G, nodo_inicial, logprint):
+    import networkx as nx
     logprint("Ejecutando Bellman-Ford ...")
     try:
         if nodo_inicial not in G:
@@ -122,19 +1392,31 @@ def ejecutar_bellman_ford(G, nodo_inicial, logprint):
         logging.error(f"Error en Bellman-Ford: {e}", exc_info=True)
         return {}
 
-def calcular_mst(G, logprint):
+def calcular_mst(G, logprint, motor=MOTOR_GRAFO_PREDETERMINADO):
+    import networkx as nx
     logprint("Calculando Árbol de Expansión Mínima (MST) ...")
     try:
         if G.number_of_nodes() == 0 or G.number_of_edges() == 0:
             logprint("   Grafo vacío o sin aristas. No se puede calcular MST.")
             return nx.Graph(), 0
 
-        # Si el grafo no es conexo, minimum_spanning_tree lo manejará por componentes
-        if not nx.is_connected(G):
-            logprint("   Advertencia: El grafo no es conexo. El MST solo conectará los componentes.")
-            
-        mst = nx.minimum_spanning_tree(G, weight='weight') # Asegurar weight='weight'
-        total_weight = sum(data['weight'] for u, v, data in mst.edges(data=True))
+        # Las componentes se calculan una sola vez por grafo; si hay varias, el resultado es un bosque
+        csr = obtener_grafo_csr(G)
+        n_componentes, _ = csr.componentes()
+        if n_componentes > 1:
+            logprint(f"   Advertencia: El grafo no es conexo ({n_componentes} componentes). El MST solo conectará los componentes.")
+
+        if motor == 'csr':
+            arbol, total_weight = csr.mst()
+            arbol = arbol.tocoo()
+            mst = nx.Graph()
+            mst.add_weighted_edges_from(
+                (csr.nodo(u), csr.nodo(v), w) for u, v, w in zip(arbol.row.tolist(), arbol.col.tolist(), arbol.data.tolist())
+            )
+        else:
+            # Si el grafo no es conexo, minimum_spanning_tree lo manejará por componentes
+            mst = nx.minimum_spanning_tree(G, weight='weight') # Asegurar weight='weight'
+            total_weight = sum(data['weight'] for u, v, data in mst.edges(data=True))
         logprint(f"   MST calculado. Peso total: {total_weight:.2f} m.")
         return mst, round(total_weight / 1000, 3) # Convertir a km
     except Exception as e:
@@ -142,10 +1424,17 @@ def calcular_mst(G, logprint):
         logging.error(f"Error en MST: {e}", exc_info=True)
         return nx.Graph(), 0 
 
-def ejecutar_kmeans(nodes, logprint, n_clusters=10): # Aumentado n_clusters por defecto a 10
+def ejecutar_kmeans(nodes, logprint, n_clusters=10, modo=KMEANS_MODO_PREDETERMINADO, cache=None): # Aumentado n_clusters por defecto a 10
+    """
+    Agrupa los nodos (lista de tuplas o arreglo NumPy (N, 2)) en clusters espaciales.
+    modo: 'kmeans', 'minibatch' (MiniBatchKMeans) o 'auto'.
+    cache: dict persistente donde se guardan los centroides ajustados, la firma de los nodos y las etiquetas.
+    Si los nodos no cambiaron se reutilizan las etiquetas; si cambiaron y hay centroides compatibles,
+    solo se asigna cada nodo a su centroide más cercano (lo mismo que predict) sin volver a ajustar.
+    """
     logprint("Ejecutando KMeans ...")
     try:
-        if not nodes: 
+        if len(nodes) == 0: 
             logprint("   No hay nodos para ejecutar KMeans.")
             return []
         
@@ -155,10 +1444,33 @@ def ejecutar_kmeans(nodes, logprint, n_clusters=10): # Aumentado n_clusters por
             logprint(f"   Número insuficiente de puntos ({num_points}) o clusters ({actual_n_clusters}) para ejecutar KMeans. Retornando etiquetas predeterminadas.")
             return [0] * num_points # Retornar 0 para todos si pocos nodos
         
-        X = [[n[0], n[1]] for n in nodes]
-        kmeans = KMeans(n_clusters=actual_n_clusters, n_init=10, random_state=0) 
-        labels = kmeans.fit_predict(X)
-        logprint(f"   KMeans calculado. {actual_n_clusters} clusters encontrados.")
+        X = np.ascontiguousarray(np.asarray(nodes, dtype=float).reshape(-1, 2))
+        if modo == 'auto':
+            modo = 'minibatch' if num_points >= UMBRAL_MINIBATCH else 'kmeans'
+        configuracion = (modo, actual_n_clusters)
+        firma = hashlib.blake2b(X.tobytes(), digest_size=16).hexdigest()
+
+        if cache is not None and cache.get('configuracion') == configuracion:
+            if cache.get('firma') == firma:
+                logprint(f"   KMeans reutilizado desde caché ({actual_n_clusters} clusters, nodos sin cambios).")
+                return cache['etiquetas'].tolist()
+            labels = asignar_centroides(X, cache['centroides'])
+            logprint(f"   KMeans: {num_points} nodos asignados con el modelo en caché ({actual_n_clusters} clusters).")
+        else:
+            from sklearn.cluster import KMeans, MiniBatchKMeans # Solo se importa si hay que ajustar un modelo
+            if modo == 'minibatch':
+                kmeans = MiniBatchKMeans(n_clusters=actual_n_clusters, batch_size=4096, n_init=3, random_state=0)
+            else:
+                kmeans = KMeans(n_clusters=actual_n_clusters, n_init=10, random_state=0) 
+            labels = kmeans.fit_predict(X)
+            logprint(f"   KMeans ({modo}) calculado. {actual_n_clusters} clusters encontrados.")
+            if cache is not None:
+                cache['configuracion'] = configuracion
+                cache['centroides'] = np.asarray(kmeans.cluster_centers_, dtype=float)
+
+        if cache is not None:
+            cache['firma'] = firma
+            cache['etiquetas'] = np.asarray(labels, dtype=np.int32) # Compacto: la caché vive más que el snapshot
         return labels.tolist() # Asegurarse de que devuelve una lista
     except Exception as e:
         logprint(f"   Error en KMeans: {e}")
@@ -166,49 +1478,247 @@ def ejecutar_kmeans(nodes, logprint, n_clusters=10): # Aumentado n_clusters por
         return [0] * len(nodes) # Retornar 0 para todos si hay error
 
 
+def asignar_centroides(X, centroides, tamano_bloque=65536):
+    """Etiqueta del centroide más cercano a cada punto de X (N, 2), por bloques para acotar la memoria."""
+    centroides = np.asarray(centroides, dtype=float)
+    etiquetas = np.empty(len(X), dtype=np.int32)
+    for inicio in range(0, len(X), tamano_bloque):
+        bloque = X[inicio:inicio + tamano_bloque]
+        distancias = ((bloque[:, None, :] - centroides[None, :, :]) ** 2).sum(axis=2)
+        etiquetas[inicio:inicio + tamano_bloque] = distancias.argmin(axis=1)
+    return etiquetas
+
+
+def cache_kmeans(parametros):
+    """Entrada de MODELOS_KMEANS para esos parámetros de carga (creada si no existe), marcada como la más reciente."""
+    clave = tuple(sorted(parametros.items()))
+    with _LOCK_MODELOS_KMEANS:
+        cache = MODELOS_KMEANS.get(clave)
+        if cache is None:
+            cache = MODELOS_KMEANS[clave] = {}
+        MODELOS_KMEANS.move_to_end(clave)
+        while len(MODELOS_KMEANS) > MAX_MODELOS_KMEANS:
+            MODELOS_KMEANS.popitem(last=False)
+    return cache
+
+
+def restaurar_modelo_kmeans(snapshot, configuracion, centroides):
+    """
+    Vuelve a cargar en MODELOS_KMEANS los centroides publicados con un snapshot compartido
+    (si este proceso no tiene ya un modelo para sus parámetros), para asignar sin reajustar.
+    """
+    if configuracion is None or not len(centroides):
+        return
+    configuracion = tuple(configuracion)
+    centroides = np.array(centroides, dtype=float)
+    snapshot.modelo_kmeans = {'configuracion': configuracion, 'centroides': centroides}
+    cache = cache_kmeans(snapshot.parametros)
+    with _LOCK_MODELOS_KMEANS:
+        if 'centroides' not in cache:
+            cache['configuracion'] = configuracion
+            cache['centroides'] = centroides
+
+
+def _kmeans_snapshot(snapshot, logprint):
+    G = snapshot.vista
+    nodos = G.graph['nodos_xy'] if 'nodos_xy' in G.graph else list(G.nodes())
+    cache = cache_kmeans(snapshot.parametros)
+    etiquetas = np.asarray(ejecutar_kmeans(nodos, logprint, cache=cache), dtype=np.int32)
+    if 'centroides' in cache:
+        # Copia de lo que usa este snapshot: la entrada de la caché puede cambiar con la siguiente versión
+        snapshot.modelo_kmeans = {'configuracion': cache['configuracion'], 'centroides': cache['centroides']}
+    # Mismo tipo que en un snapshot adjuntado (arreglo int32 de snapshot_compartido)
+    return etiquetas
+
+
+# Análisis seleccionables por petición. Cada uno recibe el snapshot y devuelve su resultado,
+# que SnapshotGrafo.analisis memoiza. Bellman-Ford da las mismas distancias que Dijkstra
+# (pesos no negativos) a un costo O(V·E), por eso no forma parte de los predeterminados.
+ANALISIS_DISPONIBLES = {
+    'dijkstra': lambda snapshot, logprint: ejecutar_dijkstra(snapshot.grafo_para(MOTOR_GRAFO_PREDETERMINADO), snapshot.resultados.get('nodo_inicial'), logprint),
+    'bellman_ford': lambda snapshot, logprint: ejecutar_bellman_ford(snapshot.grafo, snapshot.resultados.get('nodo_inicial'), logprint),
+    'mst': lambda snapshot, logprint: calcular_mst(snapshot.grafo_para(MOTOR_GRAFO_PREDETERMINADO), logprint),
+    'kmeans': _kmeans_snapshot,
+}
+ALIAS_ANALISIS = {'bellman': 'bellman_ford'}
+ANALISIS_PREDETERMINADOS = ('dijkstra', 'mst', 'kmeans')
+
+
+def parsear_analisis(texto):
+    """
+    Convierte un parámetro tipo 'dijkstra,mst,kmeans' en una tupla de nombres de análisis.
+    Si texto está vacío devuelve ANALISIS_PREDETERMINADOS. Lanza ValueError si hay nombres desconocidos.
+    """
+    if not texto:
+        return ANALISIS_PREDETERMINADOS
+    nombres = []
+    for nombre in texto.split(','):
+        nombre = ALIAS_ANALISIS.get(nombre.strip().lower(), nombre.strip().lower())
+        if not nombre:
+            continue
+        if nombre not in ANALISIS_DISPONIBLES:
+            raise ValueError(f"Análisis desconocido: '{nombre}'. Disponibles: {', '.join(ANALISIS_DISPONIBLES)}.")
+        if nombre not in nombres:
+            nombres.append(nombre)
+    return tuple(nombres)
+
+
 # NUEVO: Lógica de simulación de impacto (Módulo 5)
-def simulate_node_impact(graph, actual_proj_coord_tuple, action_type):
+# Definir los porcentajes de reducción para cada acción
+REDUCTION_PERCENTAGES = {
+    'panel_solar': {
+        'co2': 0.15, # 15% de reducción de CO2
+        'nox': 0.10  # 10% de reducción de NOx
+    },
+    'biodigestor': {
+        'ch4': 0.30   # 30% de reducción de CH4
+    }
+}
+GAS_ATTRS = ('co2_level', 'ch4_level', 'nox_level')
+
+
+def niveles_gases(G):
+    """
+    Devuelve {gas_attr: arreglo float (N,)} con los niveles de gases de los nodos en el orden de G.nodes().
+    Los niveles viven en G.graph['niveles_gases'] (no en los atributos de cada nodo) para poder
+    simular y agregar escenarios sobre muchos nodos en una sola pasada.
+    """
+    niveles = G.graph.get('niveles_gases')
+    if niveles is None:
+        niveles = {gas: np.zeros(G.number_of_nodes()) for gas in GAS_ATTRS}
+        G.graph['niveles_gases'] = niveles
+    return niveles
+
+
+def clusters_nodos(G):
+    """Arreglo int (N,) con el cluster KMeans de cada nodo en el orden de G.nodes() (-1 si no tiene)."""
+    clusters = G.graph.get('kmeans_nodos')
+    if clusters is None:
+        clusters = np.full(G.number_of_nodes(), -1, dtype=np.int32)
+    return clusters
+
+
+def indices_de_nodos(G, nodos):
+    """Posición en G.nodes() de cada nodo (tuplas de coordenadas proyectadas exactas), o -1 si no es un nodo."""
+    indice = G.graph.get('indice_espacial')
+    if indice is None:
+        posicion = {n: i for i, n in enumerate(G.nodes())}
+        return np.array([posicion.get(tuple(n), -1) for n in nodos], dtype=np.int64)
+    return indice.indices_exactos(nodos)
+
+
+class OverlaySimulacion:
+    """
+    Niveles de gases simulados de un escenario, guardados aparte del grafo compartido.
+    El grafo del snapshot nunca se modifica: el primer cambio copia los arreglos de niveles
+    del grafo y las simulaciones siguientes escriben sobre esa copia.
+    Si el snapshot está publicado, app sincroniza el overlay con el guardado junto a él
+    (ver snapshot_compartido.sincronizar_escenario) para que todos los workers vean el mismo escenario.
+    """
+    def __init__(self):
+        self.niveles = None # {gas_attr: arreglo por nodo}; None mientras el escenario no tenga cambios
+        self.version = 0 # Versión del escenario compartido que tienen los niveles (0 = ninguna)
+        self.firma_disco = None # (mtime, tamaño) del archivo del escenario la última vez que se leyó o guardó
+        self.lock = threading.Lock()
+
+    def niveles_de(self, graph):
+        """Niveles del escenario (o los del grafo si todavía no se simuló nada)."""
+        return self.niveles if self.niveles is not None else niveles_gases(graph)
+
+    def niveles_editables(self, graph):
+        if self.niveles is None:
+            self.niveles = {gas: np.array(nivel, dtype=float) for gas, nivel in niveles_gases(graph).items()}
+        return self.niveles
+
+
+def _niveles_editables(graph, overlay):
+    """Arreglos de niveles donde escribir: los del overlay o, sin overlay, los del grafo (copiados si son de solo lectura)."""
+    if overlay is not None:
+        return overlay.niveles_editables(graph)
+    niveles = niveles_gases(graph)
+    for gas, nivel in niveles.items():
+        if not isinstance(nivel, np.ndarray) or not nivel.flags.writeable:
+            niveles[gas] = np.array(nivel, dtype=float)
+    return niveles
+
+
+def _reducir_niveles(niveles, indices, action_type):
+    """Aplica a los nodos 'indices' las reducciones de action_type (en su lugar, sin bajar de 0)."""
+    for gas, reduction_percent in REDUCTION_PERCENTAGES[action_type].items():
+        nivel = niveles[f'{gas}_level']
+        nivel[indices] = np.round(np.maximum(0, nivel[indices] * (1 - reduction_percent)), 2)
+
+
+def simulate_node_impact(graph, actual_proj_coord_tuple, action_type, overlay=None):
     """
     Simula el impacto de una acción en los niveles de gases de un nodo en el grafo.
-    Modifica los atributos del nodo directamente en el grafo en memoria.
-    Devuelve los datos actualizados del nodo.
+    Si se pasa un OverlaySimulacion, los nuevos niveles se guardan en el overlay y el grafo no se toca;
+    sin overlay, modifica los niveles del grafo en memoria.
+    Devuelve los datos del nodo con los niveles actualizados (ver atributos_nodo).
     """
     logging.info(f"Simulando impacto '{action_type}' en el nodo {actual_proj_coord_tuple}")
     
-    # Acceder a los atributos del nodo directamente en el grafo
-    # Asegúrate de que el nodo exista en el grafo y tenga los atributos de gases.
-    if actual_proj_coord_tuple not in graph.nodes:
+    # Asegúrate de que el nodo exista en el grafo
+    idx = int(indices_de_nodos(graph, [actual_proj_coord_tuple])[0])
+    if idx < 0:
         logging.error(f"Nodo {actual_proj_coord_tuple} no encontrado en el grafo para simulación.")
         return None # O levantar un error
 
-    node_attrs = graph.nodes[actual_proj_coord_tuple]
+    if action_type not in REDUCTION_PERCENTAGES:
+        logging.warning(f"Tipo de acción de simulación desconocido: {action_type}")
+        niveles = overlay.niveles_de(graph) if overlay is not None else niveles_gases(graph)
+    elif overlay is None:
+        niveles = _niveles_editables(graph, None)
+        _reducir_niveles(niveles, idx, action_type)
+    else:
+        # Leer, reducir y guardar bajo el lock del escenario para no perder simulaciones concurrentes
+        with overlay.lock:
+            niveles = _niveles_editables(graph, overlay)
+            _reducir_niveles(niveles, idx, action_type)
 
-    # Definir los porcentajes de reducción para cada acción
-    reduction_percentages = {
-        'panel_solar': {
-            'co2': 0.15, # 15% de reducción de CO2
-            'nox': 0.10  # 10% de reducción de NOx
-        },
-        'biodigestor': {
-            'ch4': 0.30   # 30% de reducción de CH4
-        }
-    }
+    return atributos_nodo(graph, idx, niveles)
 
-    # Aplicar la simulación
-    if action_type in reduction_percentages:
-        for gas, reduction_percent in reduction_percentages[action_type].items():
-            attr_name = f'{gas}_level'
-            if attr_name in node_attrs:
-                current_level = node_attrs[attr_name]
-                # Reducir el nivel, asegurándose de que no sea negativo
-                node_attrs[attr_name] = round(max(0, current_level * (1 - reduction_percent)), 2)
-                logging.info(f"Nivel de {gas} del nodo {actual_proj_coord_tuple} reducido en {reduction_percent*100}% a {node_attrs[attr_name]:.2f}")
-            else:
-                logging.warning(f"Atributo '{attr_name}' no encontrado para el nodo {actual_proj_coord_tuple}. No se aplicó reducción para {gas}.")
-    else:
-        logging.warning(f"Tipo de acción de simulación desconocido: {action_type}")
 
-    # Devolver los atributos actualizados del nodo
-    # Se devuelve una copia para evitar problemas si el frontend modifica el objeto.
-    return node_attrs.copy()
+def _totales_por_cluster(clusters, niveles):
+    """{cluster: {gas_attr: suma}} de los niveles agrupados por cluster KMeans (-1 = sin cluster)."""
+    etiquetas, posicion = np.unique(clusters, return_inverse=True)
+    sumas = {gas: np.bincount(posicion, weights=nivel, minlength=len(etiquetas)) for gas, nivel in niveles.items()}
+    return {int(c): {gas: float(sumas[gas][k]) for gas in niveles} for k, c in enumerate(etiquetas)}
+
+
+def simular_impacto_lote(graph, indices, acciones, overlay=None):
+    """
+    Aplica las acciones (lista de claves de REDUCTION_PERCENTAGES, en orden) a todos los nodos 'indices'
+    (posiciones en G.nodes()) en una pasada vectorizada por acción. Con overlay, los cambios quedan en el
+    escenario; sin overlay, en los niveles del grafo.
+    Devuelve el resumen de niveles totales antes y después, y su diferencia, para toda la red
+    y por cluster KMeans.
+    """
+    desconocidas = [a for a in acciones if a not in REDUCTION_PERCENTAGES]
+    if desconocidas:
+        raise ValueError(f"Tipos de acción desconocidos: {', '.join(map(str, desconocidas))}")
+    indices = np.unique(np.asarray(indices, dtype=np.int64))
+    clusters = np.asarray(clusters_nodos(graph))
+
+    with overlay.lock if overlay is not None else contextlib.nullcontext():
+        niveles = _niveles_editables(graph, overlay)
+        antes = {gas: nivel[indices].copy() for gas, nivel in niveles.items()}
+        totales_antes = {gas: float(nivel.sum()) for gas, nivel in niveles.items()}
+        clusters_antes = _totales_por_cluster(clusters, niveles)
+        for action_type in acciones:
+            _reducir_niveles(niveles, indices, action_type)
+        deltas = {gas: niveles[gas][indices] - antes[gas] for gas in niveles}
 
+    # Solo cambian los nodos afectados: los totales "después" salen de sumar sus diferencias
+    red = {gas: {'antes': totales_antes[gas], 'despues': totales_antes[gas] + float(deltas[gas].sum()),
+                 'delta': float(deltas[gas].sum())} for gas in niveles}
+    clusters_afectados, posicion = np.unique(clusters[indices], return_inverse=True)
+    deltas_cluster = {gas: np.bincount(posicion, weights=deltas[gas], minlength=len(clusters_afectados)) for gas in niveles}
+    nodos_cluster = np.bincount(posicion, minlength=len(clusters_afectados))
+    por_cluster = {}
+    for k, c in enumerate(clusters_afectados.tolist()):
+        resumen = {gas: {'antes': clusters_antes[c][gas], 'despues': clusters_antes[c][gas] + float(deltas_cluster[gas][k]),
+                         'delta': float(deltas_cluster[gas][k])} for gas in niveles}
+        por_cluster[int(c)] = dict(resumen, nodos_afectados=int(nodos_cluster[k]))
+    logging.info(f"Simulación en lote {acciones}: {len(indices)} nodos en {len(por_cluster)} clusters.")
+    return {'nodos_afectados': int(len(indices)), 'red': red, 'clusters': por_cluster}
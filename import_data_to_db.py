@@ -1,9 +1,14 @@
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-from shapely import wkt
-from shapely.errors import GEOSException # Importar la excepción específica
+import shapely
+from openpyxl import load_workbook
+from pyproj import Transformer
 from sqlalchemy import create_engine
-import psycopg2 
+import psycopg2
 
 # --- Configuración de la base de datos ---
 DB_USER = 'yakuza'       # Reemplazado con tu usuario
@@ -20,26 +25,244 @@ FILEPATH = "ly_osi_tramos.xlsx"
 COLS_TO_USE = ["CODTRAMO", "LONGITUD", "GEOMETRIA_WKT"]
 CRS_GEOGRAPHIC = "EPSG:4326" # CRS para latitud/longitud
 CRS_PROJECTED = "EPSG:32718" # CRS proyectado para Perú (para cálculos de distancia)
+SRID_GEOGRAPHIC = 4326
+SRID_PROJECTED = 32718
 
 # --- Nombre de la tabla en PostgreSQL ---
 TABLE_NAME = "tramos_gas"
+STAGING_TABLE_NAME = f"{TABLE_NAME}_staging" # Se carga aquí y luego se intercambia con TABLE_NAME
+CHANGES_TABLE_NAME = f"{TABLE_NAME}_cambios" # Bitácora de altas/modificaciones/bajas de la importación incremental
+VERSION_TABLE_NAME = f"{TABLE_NAME}_version" # Una fila con un contador que cada importación incrementa (ver grafo_logic.obtener_version_tramos)
 
-# Función para intentar cargar WKT y manejar errores
-def load_wkt_safe(wkt_string):
-    if not isinstance(wkt_string, str):
-        return None # No es una cadena, retornar None
+# 'completo' reemplaza la tabla; 'delta' aplica solo los tramos que cambiaron, por CODTRAMO
+MODOS_IMPORTACION = ('completo', 'delta')
+
+# --- Carga por bloques ---
+TAMANO_BLOQUE = 20000 # Filas del Excel por bloque
+HILOS_PARSEO = min(4, os.cpu_count() or 1) # shapely libera el GIL, así que los bloques se parsean en paralelo
+
+transformer_geo_to_proj = Transformer.from_crs(CRS_GEOGRAPHIC, CRS_PROJECTED, always_xy=True)
+
+
+def leer_bloques(filepath, columnas, tamano_bloque=TAMANO_BLOQUE):
+    """
+    Lee el archivo por bloques de tamano_bloque filas y devuelve un DataFrame por bloque,
+    sin cargar el archivo completo en memoria. Soporta .xlsx (openpyxl en modo solo lectura) y .csv.
+    """
+    if filepath.lower().endswith('.csv'):
+        yield from pd.read_csv(filepath, usecols=columnas, chunksize=tamano_bloque)
+        return
+
+    libro = load_workbook(filepath, read_only=True, data_only=True)
     try:
-        geometry = wkt.loads(wkt_string)
-        # Opcional: Puedes añadir más validación aquí, como verificar el tipo de geometría
-        if geometry.is_empty: # Algunas geometrías malformadas pueden cargarse como vacías
-             return None
-        return geometry
-    except GEOSException as e:
-        # print(f"Advertencia: Error al parsear WKT '{wkt_string[:50]}...': {e}") # Descomentar para ver los errores
-        return None # Retornar None para geometrías que no se puedan parsear
-
-def import_data_to_postgresql():
-    print(f"Iniciando el proceso de importación a PostgreSQL para la base de datos '{DB_NAME}'...")
+        filas = libro.active.iter_rows(values_only=True)
+        encabezado = [str(c).strip() if c is not None else '' for c in next(filas, ())]
+        faltantes = [c for c in columnas if c not in encabezado]
+        if faltantes:
+            raise ValueError(f"Columnas no encontradas en '{filepath}': {', '.join(faltantes)}")
+        posiciones = [encabezado.index(c) for c in columnas]
+
+        bloque = []
+        for fila in filas:
+            bloque.append([fila[i] if i < len(fila) else None for i in posiciones])
+            if len(bloque) == tamano_bloque:
+                yield pd.DataFrame(bloque, columns=columnas)
+                bloque = []
+        if bloque:
+            yield pd.DataFrame(bloque, columns=columnas)
+    finally:
+        libro.close()
+
+
+def procesar_bloque(df):
+    """
+    Parsea el WKT del bloque de forma vectorizada, deja solo LineString válidos, los proyecta a
+    CRS_PROJECTED y devuelve (DataFrame listo para COPY, descartadas por WKT nulo, descartadas por
+    geometría inválida/no-LineString). Las geometrías van como EWKB hexadecimal, que PostGIS acepta en COPY.
+    """
+    # Filtra filas con GEOMETRIA_WKT vacía o nula ANTES de intentar parsear
+    con_wkt = df["GEOMETRIA_WKT"].notnull().to_numpy()
+    df = df[con_wkt]
+    wkts = df["GEOMETRIA_WKT"].to_numpy()
+    es_texto = np.array([isinstance(w, str) for w in wkts], dtype=bool)
+
+    # Las cadenas que no se pueden parsear quedan como None (on_invalid='ignore')
+    geometrias = np.full(len(wkts), None, dtype=object)
+    geometrias[es_texto] = shapely.from_wkt(wkts[es_texto].astype(str), on_invalid='ignore')
+
+    # Solo LineString (type id 1) y no vacías; los None dan -1
+    validas = (shapely.get_type_id(geometrias) == 1) & ~shapely.is_empty(geometrias)
+    df, geometrias = df[validas], geometrias[validas]
+
+    geometrias_proj = shapely.transform(
+        geometrias, lambda xy: np.column_stack(transformer_geo_to_proj.transform(xy[:, 0], xy[:, 1]))
+    )
+    salida = pd.DataFrame({
+        "CODTRAMO": df["CODTRAMO"].astype(str).where(df["CODTRAMO"].notnull(), None).to_numpy(),
+        "LONGITUD": pd.to_numeric(df["LONGITUD"], errors='coerce').to_numpy(),
+        "GEOMETRIA_WKT": df["GEOMETRIA_WKT"].to_numpy(),
+        "geometry": shapely.to_wkb(shapely.set_srid(geometrias, SRID_GEOGRAPHIC), hex=True, include_srid=True),
+        "geometry_proj": shapely.to_wkb(shapely.set_srid(geometrias_proj, SRID_PROJECTED), hex=True, include_srid=True),
+    })
+    return salida, int((~con_wkt).sum()), int((~validas).sum())
+
+
+def procesar_en_paralelo(bloques, hilos=HILOS_PARSEO):
+    """
+    Procesa los bloques con un pool de hilos manteniendo el orden de entrada y como máximo
+    2 * hilos bloques en vuelo, para no volver a tener el archivo completo en memoria.
+    """
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        pendientes = []
+        for bloque in bloques:
+            pendientes.append(pool.submit(procesar_bloque, bloque))
+            if len(pendientes) >= 2 * hilos:
+                yield pendientes.pop(0).result()
+        for futuro in pendientes:
+            yield futuro.result()
+
+
+def crear_tabla_staging(cursor):
+    cursor.execute(f'DROP TABLE IF EXISTS {STAGING_TABLE_NAME}')
+    cursor.execute(f'''
+        CREATE TABLE {STAGING_TABLE_NAME} (
+            "CODTRAMO" text,
+            "LONGITUD" double precision,
+            "GEOMETRIA_WKT" text,
+            geometry geometry(LineString, {SRID_GEOGRAPHIC}),
+            geometry_proj geometry(LineString, {SRID_PROJECTED})
+        )
+    ''')
+
+
+def copiar_bloque(cursor, df):
+    """Envía el bloque a la tabla staging con COPY ... FROM STDIN (CSV en memoria)."""
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor.copy_expert(
+        f'COPY {STAGING_TABLE_NAME} ("CODTRAMO", "LONGITUD", "GEOMETRIA_WKT", geometry, geometry_proj) '
+        f'FROM STDIN WITH (FORMAT csv)',
+        buffer,
+    )
+
+
+def intercambiar_tablas(cursor):
+    """
+    Crea los índices GiST sobre la tabla staging ya cargada y la intercambia con TABLE_NAME en
+    una sola transacción: las consultas concurrentes ven la tabla anterior completa hasta el
+    COMMIT y después la nueva, nunca una tabla vacía o a medio cargar.
+    """
+    cursor.execute(f'CREATE INDEX {STAGING_TABLE_NAME}_geometry_idx ON {STAGING_TABLE_NAME} USING GIST (geometry)')
+    cursor.execute(f'CREATE INDEX {STAGING_TABLE_NAME}_geometry_proj_idx ON {STAGING_TABLE_NAME} USING GIST (geometry_proj)')
+    cursor.execute(f'CREATE INDEX {STAGING_TABLE_NAME}_codtramo_idx ON {STAGING_TABLE_NAME} ("CODTRAMO")')
+    cursor.execute(f'ANALYZE {STAGING_TABLE_NAME}')
+    cursor.execute(f'DROP TABLE IF EXISTS {TABLE_NAME}')
+    cursor.execute(f'ALTER TABLE {STAGING_TABLE_NAME} RENAME TO {TABLE_NAME}')
+    cursor.execute(f'ALTER INDEX {STAGING_TABLE_NAME}_geometry_idx RENAME TO idx_{TABLE_NAME}_geometry')
+    cursor.execute(f'ALTER INDEX {STAGING_TABLE_NAME}_geometry_proj_idx RENAME TO idx_{TABLE_NAME}_geometry_proj')
+    cursor.execute(f'ALTER INDEX {STAGING_TABLE_NAME}_codtramo_idx RENAME TO idx_{TABLE_NAME}_codtramo')
+
+
+def incrementar_version(cursor):
+    """
+    Incrementa el contador de VERSION_TABLE_NAME dentro de la transacción de la importación:
+    el nuevo valor se ve recién con el COMMIT, junto con los datos. Devuelve la nueva versión.
+    """
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {VERSION_TABLE_NAME} (
+            id smallint PRIMARY KEY CHECK (id = 1),
+            version bigint NOT NULL
+        )
+    ''')
+    cursor.execute(f'''
+        INSERT INTO {VERSION_TABLE_NAME} (id, version) VALUES (1, 1)
+        ON CONFLICT (id) DO UPDATE SET version = {VERSION_TABLE_NAME}.version + 1
+        RETURNING version
+    ''')
+    return cursor.fetchone()[0]
+
+
+def existe_tabla(cursor, nombre):
+    cursor.execute("SELECT to_regclass(%s)", (f'public.{nombre}',))
+    return cursor.fetchone()[0] is not None
+
+
+def aplicar_delta(cursor):
+    """
+    Aplica la tabla staging sobre TABLE_NAME por CODTRAMO, sin reemplazarla: inserta las altas,
+    reemplaza las filas de los tramos modificados (geometría o longitud distinta) y borra las bajas.
+    Cada tramo afectado queda registrado en CHANGES_TABLE_NAME con el número de lote de esta
+    importación, para que grafo_logic actualice el grafo en caché solo con esos tramos.
+    Devuelve (lote, {operacion: cantidad}).
+    """
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {CHANGES_TABLE_NAME} (
+            id bigserial PRIMARY KEY,
+            lote bigint NOT NULL,
+            codtramo text NOT NULL,
+            operacion text NOT NULL CHECK (operacion IN ('alta', 'modificacion', 'baja')),
+            registrado_en timestamptz NOT NULL DEFAULT now()
+        )
+    ''')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS {CHANGES_TABLE_NAME}_lote_idx ON {CHANGES_TABLE_NAME} (lote)')
+    cursor.execute(f'CREATE SEQUENCE IF NOT EXISTS {CHANGES_TABLE_NAME}_lote_seq')
+    cursor.execute(f"SELECT nextval('{CHANGES_TABLE_NAME}_lote_seq')")
+    lote = cursor.fetchone()[0]
+
+    # Sin CODTRAMO no hay clave para comparar; si un CODTRAMO se repite se queda la última fila del archivo
+    cursor.execute(f'DELETE FROM {STAGING_TABLE_NAME} WHERE "CODTRAMO" IS NULL')
+    if cursor.rowcount:
+        print(f"   {cursor.rowcount} filas sin CODTRAMO descartadas en la importación incremental.")
+    cursor.execute(f'''
+        DELETE FROM {STAGING_TABLE_NAME} a USING {STAGING_TABLE_NAME} b
+        WHERE a."CODTRAMO" = b."CODTRAMO" AND a.ctid < b.ctid
+    ''')
+    cursor.execute(f'CREATE INDEX ON {STAGING_TABLE_NAME} ("CODTRAMO")')
+    cursor.execute(f'ANALYZE {STAGING_TABLE_NAME}')
+
+    # 1. Registrar los cambios comparando staging con la tabla actual
+    cursor.execute(f'''
+        INSERT INTO {CHANGES_TABLE_NAME} (lote, codtramo, operacion)
+        SELECT %(lote)s, s."CODTRAMO", 'alta' FROM {STAGING_TABLE_NAME} s
+        WHERE NOT EXISTS (SELECT 1 FROM {TABLE_NAME} t WHERE t."CODTRAMO" = s."CODTRAMO")
+    ''', {'lote': lote})
+    cursor.execute(f'''
+        INSERT INTO {CHANGES_TABLE_NAME} (lote, codtramo, operacion)
+        SELECT DISTINCT %(lote)s, s."CODTRAMO", 'modificacion' FROM {STAGING_TABLE_NAME} s
+        JOIN {TABLE_NAME} t ON t."CODTRAMO" = s."CODTRAMO"
+        WHERE ST_AsBinary(t.geometry) IS DISTINCT FROM ST_AsBinary(s.geometry)
+           OR t."LONGITUD" IS DISTINCT FROM s."LONGITUD"
+    ''', {'lote': lote})
+    cursor.execute(f'''
+        INSERT INTO {CHANGES_TABLE_NAME} (lote, codtramo, operacion)
+        SELECT DISTINCT %(lote)s, t."CODTRAMO", 'baja' FROM {TABLE_NAME} t
+        WHERE t."CODTRAMO" IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM {STAGING_TABLE_NAME} s WHERE s."CODTRAMO" = t."CODTRAMO")
+    ''', {'lote': lote})
+
+    # 2. Aplicarlos: las modificaciones se borran y se vuelven a insertar con los datos nuevos
+    cursor.execute(f'''
+        DELETE FROM {TABLE_NAME} t USING {CHANGES_TABLE_NAME} c
+        WHERE c.lote = %(lote)s AND c.operacion IN ('modificacion', 'baja') AND t."CODTRAMO" = c.codtramo
+    ''', {'lote': lote})
+    cursor.execute(f'''
+        INSERT INTO {TABLE_NAME} ("CODTRAMO", "LONGITUD", "GEOMETRIA_WKT", geometry, geometry_proj)
+        SELECT s."CODTRAMO", s."LONGITUD", s."GEOMETRIA_WKT", s.geometry, s.geometry_proj
+        FROM {STAGING_TABLE_NAME} s JOIN {CHANGES_TABLE_NAME} c ON c.codtramo = s."CODTRAMO"
+        WHERE c.lote = %(lote)s AND c.operacion IN ('alta', 'modificacion')
+    ''', {'lote': lote})
+    cursor.execute(f'DROP TABLE {STAGING_TABLE_NAME}')
+
+    cursor.execute(f'SELECT operacion, COUNT(*) FROM {CHANGES_TABLE_NAME} WHERE lote = %(lote)s GROUP BY operacion', {'lote': lote})
+    return lote, dict(cursor.fetchall())
+
+
+def import_data_to_postgresql(modo='completo'):
+    if modo not in MODOS_IMPORTACION:
+        print(f"Modo de importación desconocido: '{modo}'. Disponibles: {', '.join(MODOS_IMPORTACION)}.")
+        return
+    print(f"Iniciando el proceso de importación ({modo}) a PostgreSQL para la base de datos '{DB_NAME}'...")
 
     try:
         conn_check = psycopg2.connect(
@@ -58,41 +281,52 @@ def import_data_to_postgresql():
         return
 
     engine = create_engine(DATABASE_URL)
+    conn = engine.raw_connection()
 
     try:
-        print(f"Cargando datos desde '{FILEPATH}'...")
-        df = pd.read_excel(FILEPATH, usecols=COLS_TO_USE)
-
-        # Filtra filas con GEOMETRIA_WKT vacía o nula ANTES de intentar parsear
-        initial_rows = len(df)
-        df = df[df["GEOMETRIA_WKT"].notnull()]
-        print(f"Filas con GEOMETRIA_WKT no nulas: {len(df)} (descartadas {initial_rows - len(df)})")
-
-        # Aplica la función segura para cargar WKT
-        df["geometry"] = df["GEOMETRIA_WKT"].apply(load_wkt_safe)
-        
-        # Filtra para asegurar que solo tenemos LineString y no None después de la conversión
-        initial_parsed_rows = len(df)
-        df = df[df["geometry"].apply(lambda g: g is not None and g.geom_type == "LineString")]
-        print(f"Se encontraron {len(df)} geometrías LineString válidas (descartadas {initial_parsed_rows - len(df)} geometrías inválidas/no-LineString).")
-
-        gdf = gpd.GeoDataFrame(df, geometry="geometry", crs=CRS_GEOGRAPHIC)
-        print(f"GeoDataFrame creado con CRS: {gdf.crs}")
+        print(f"Cargando datos desde '{FILEPATH}' en bloques de {TAMANO_BLOQUE} filas ({HILOS_PARSEO} hilos de parseo)...")
+        cursor = conn.cursor()
+        crear_tabla_staging(cursor)
 
-        gdf['geometry_proj'] = gdf.to_crs(CRS_PROJECTED).geometry
+        total_filas = 0
+        descartadas_nulas = 0
+        descartadas_invalidas = 0
+        for salida, nulas, invalidas in procesar_en_paralelo(leer_bloques(FILEPATH, COLS_TO_USE)):
+            copiar_bloque(cursor, salida)
+            total_filas += len(salida)
+            descartadas_nulas += nulas
+            descartadas_invalidas += invalidas
+            print(f"   {total_filas} registros copiados a '{STAGING_TABLE_NAME}'...")
 
-        columns = [col for col in gdf.columns if col != 'geometry' and col != 'geometry_proj'] + ['geometry', 'geometry_proj']
-        gdf = gdf[columns]
+        print(f"Filas con GEOMETRIA_WKT nula descartadas: {descartadas_nulas}")
+        print(f"Se encontraron {total_filas} geometrías LineString válidas (descartadas {descartadas_invalidas} geometrías inválidas/no-LineString).")
 
-        print(f"Guardando {len(gdf)} registros en la tabla '{TABLE_NAME}' de PostgreSQL...")
-        gdf.to_postgis(TABLE_NAME, engine, if_exists='replace', index=False, schema='public')
+        if modo == 'delta' and not existe_tabla(cursor, TABLE_NAME):
+            print(f"La tabla '{TABLE_NAME}' no existe todavía: se hará una importación completa.")
+            modo = 'completo'
+        if modo == 'delta':
+            print(f"Aplicando cambios por CODTRAMO sobre '{TABLE_NAME}'...")
+            lote, conteos = aplicar_delta(cursor)
+            incrementar_version(cursor)
+            conn.commit()
+            print(f"Lote {lote} registrado en '{CHANGES_TABLE_NAME}': {conteos.get('alta', 0)} altas, "
+                  f"{conteos.get('modificacion', 0)} modificaciones, {conteos.get('baja', 0)} bajas.")
+        else:
+            print(f"Creando índices GiST e intercambiando '{STAGING_TABLE_NAME}' por '{TABLE_NAME}'...")
+            intercambiar_tablas(cursor)
+            incrementar_version(cursor)
+            conn.commit()
 
         print(f"Datos de '{FILEPATH}' importados exitosamente a la tabla '{TABLE_NAME}' en PostgreSQL.")
 
     except Exception as e:
+        conn.rollback()
         print(f"Ocurrió un error durante la importación de datos: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        conn.close()
 
 if __name__ == "__main__":
-    import_data_to_postgresql()
+    # python import_data_to_db.py [--delta]
+    import_data_to_postgresql(modo='delta' if '--delta' in sys.argv[1:] else 'completo')
@@ -0,0 +1,211 @@
+import os
+import time
+import math
+import threading
+import tracemalloc
+import cProfile
+import logging
+from contextlib import contextmanager
+
+# Límites (segundos) de los histogramas de latencia, como los buckets predeterminados de Prometheus
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, math.inf)
+
+# Perfilado con cProfile por petición (opt-in): solo si GRAFO_PERFIL_DIR está definido, y solo
+# para las peticiones que lo pidan con ?perfil=1 o la cabecera X-Perfil: 1
+DIRECTORIO_PERFILES = os.environ.get('GRAFO_PERFIL_DIR')
+
+try:
+    _PAGINA = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGINA = None
+
+
+def memoria_rss():
+    """Memoria residente actual del proceso en bytes (None si no se puede leer, p. ej. fuera de Linux)."""
+    if _PAGINA is None:
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGINA
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Histograma:
+    """Histograma acumulado (buckets, suma y conteo) de una serie con etiquetas, en formato Prometheus."""
+    def __init__(self, buckets=BUCKETS_LATENCIA):
+        self.buckets = buckets
+        self.conteos = [0] * len(buckets)
+        self.suma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        for i, limite in enumerate(self.buckets):
+            if valor <= limite:
+                self.conteos[i] += 1
+                break
+        self.suma += valor
+        self.total += 1
+
+
+class RegistroMetricas:
+    """
+    Histogramas de latencia por nombre de métrica y etiquetas, compartidos por todas las peticiones
+    del proceso. texto_prometheus() los expone en el formato de texto de Prometheus (ver /metrics).
+    """
+    def __init__(self):
+        self._metricas = {} # nombre -> (ayuda, {etiquetas (tupla ordenada): Histograma})
+        self._lock = threading.Lock()
+
+    def registrar(self, nombre, ayuda):
+        with self._lock:
+            self._metricas.setdefault(nombre, (ayuda, {}))
+
+    def observar(self, nombre, segundos, **etiquetas):
+        clave = tuple(sorted((k, str(v)) for k, v in etiquetas.items()))
+        with self._lock:
+            _, series = self._metricas.setdefault(nombre, ('', {}))
+            histograma = series.get(clave)
+            if histograma is None:
+                histograma = series[clave] = Histograma()
+            histograma.observar(segundos)
+
+    def texto_prometheus(self):
+        lineas = []
+        with self._lock:
+            for nombre, (ayuda, series) in sorted(self._metricas.items()):
+                if ayuda:
+                    lineas.append(f"# HELP {nombre} {ayuda}")
+                lineas.append(f"# TYPE {nombre} histogram")
+                for clave, h in sorted(series.items()):
+                    etiquetas = ','.join(f'{k}="{_escapar(v)}"' for k, v in clave)
+                    acumulado = 0
+                    for limite, conteo in zip(h.buckets, h.conteos):
+                        acumulado += conteo
+                        le = '+Inf' if math.isinf(limite) else repr(limite)
+                        etiquetas_bucket = _unir(etiquetas, 'le="%s"' % le)
+                        lineas.append(f'{nombre}_bucket{{{etiquetas_bucket}}} {acumulado}')
+                    sufijo = f'{{{etiquetas}}}' if etiquetas else ''
+                    lineas.append(f'{nombre}_sum{sufijo} {h.suma}')
+                    lineas.append(f'{nombre}_count{sufijo} {h.total}')
+        rss = memoria_rss()
+        if rss is not None:
+            lineas.append("# HELP grafo_memoria_rss_bytes Memoria residente del proceso.")
+            lineas.append("# TYPE grafo_memoria_rss_bytes gauge")
+            lineas.append(f"grafo_memoria_rss_bytes {rss}")
+        return '\n'.join(lineas) + '\n'
+
+
+def _escapar(valor):
+    return valor.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _unir(*partes):
+    return ','.join(p for p in partes if p)
+
+
+REGISTRO = RegistroMetricas()
+REGISTRO.registrar('grafo_etapa_duracion_segundos', "Duración de cada etapa del pipeline de análisis.")
+REGISTRO.registrar('grafo_http_duracion_segundos', "Duración de las peticiones HTTP por endpoint, método y código.")
+
+# Pila de etapas abiertas por hilo, para repartir el pico de tracemalloc entre etapas anidadas
+_ETAPAS_ABIERTAS = threading.local()
+# El pico de tracemalloc es uno solo para todo el proceso: se cuentan las etapas abiertas por hilo
+# y cuántas veces un hilo empezó a medir, para informar el pico solo de las etapas sin otros hilos midiendo
+_HILOS_MIDIENDO = {} # id de hilo -> etapas abiertas
+_TANDAS_MEDICION = [0] # Se incrementa cada vez que un hilo abre su primera etapa
+_LOCK_HILOS_MIDIENDO = threading.Lock()
+
+
+def _abrir_etapa_hilo():
+    """Registra una etapa abierta en este hilo. Devuelve (tanda actual, si ningún otro hilo está midiendo)."""
+    hilo = threading.get_ident()
+    with _LOCK_HILOS_MIDIENDO:
+        if hilo not in _HILOS_MIDIENDO:
+            _TANDAS_MEDICION[0] += 1
+        _HILOS_MIDIENDO[hilo] = _HILOS_MIDIENDO.get(hilo, 0) + 1
+        return _TANDAS_MEDICION[0], len(_HILOS_MIDIENDO) == 1
+
+
+def _cerrar_etapa_hilo(tanda):
+    """Quita la etapa de este hilo. Devuelve True si ningún otro hilo midió mientras estuvo abierta."""
+    hilo = threading.get_ident()
+    with _LOCK_HILOS_MIDIENDO:
+        exclusiva = _TANDAS_MEDICION[0] == tanda and len(_HILOS_MIDIENDO) == 1
+        _HILOS_MIDIENDO[hilo] -= 1
+        if not _HILOS_MIDIENDO[hilo]:
+            del _HILOS_MIDIENDO[hilo]
+        return exclusiva
+
+
+@contextmanager
+def medir_etapa(nombre, logprint=None):
+    """
+    Mide duración y memoria de una etapa del pipeline. La duración va al histograma
+    grafo_etapa_duracion_segundos{etapa=nombre} y, si se pasa logprint, se agrega una línea al log
+    con la duración y la memoria residente (RSS) al terminar y su variación.
+    Si tracemalloc está activo (ej. PYTHONTRACEMALLOC=1) también se informa el pico asignado en la etapa.
+    Ese pico es del proceso entero, así que solo se informa si ningún otro hilo midió etapas
+    mientras esta estaba abierta (con peticiones concurrentes se omite en lugar de mezclarlas).
+    """
+    pila = getattr(_ETAPAS_ABIERTAS, 'pila', None)
+    if pila is None:
+        pila = _ETAPAS_ABIERTAS.pila = []
+    tanda, exclusiva = _abrir_etapa_hilo()
+    trazando = tracemalloc.is_tracing() and exclusiva
+    if trazando:
+        if pila:
+            # El pico acumulado hasta ahora pertenece a la etapa que contiene a esta
+            pila[-1] = max(pila[-1], tracemalloc.get_traced_memory()[1])
+        base_traza = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    pila.append(0)
+    rss_inicial = memoria_rss()
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        segundos = time.perf_counter() - inicio
+        pico_hijas = pila.pop()
+        trazando = _cerrar_etapa_hilo(tanda) and trazando
+        REGISTRO.observar('grafo_etapa_duracion_segundos', segundos, etapa=nombre)
+        detalle = []
+        rss_final = memoria_rss()
+        if rss_final is not None and rss_inicial is not None:
+            detalle.append(f"RSS {rss_final / 2**20:.1f} MB ({(rss_final - rss_inicial) / 2**20:+.1f} MB)")
+        if trazando and tracemalloc.is_tracing():
+            pico = max(pico_hijas, tracemalloc.get_traced_memory()[1])
+            detalle.append(f"pico asignado {(pico - base_traza) / 2**20:.1f} MB")
+            if pila:
+                pila[-1] = max(pila[-1], pico)
+        if logprint is not None:
+            logprint(f"   [etapa] {nombre}: {segundos:.3f} s" + (f", {', '.join(detalle)}" if detalle else ""))
+
+
+def perfilado_habilitado():
+    return DIRECTORIO_PERFILES is not None
+
+
+def iniciar_perfil():
+    """Crea y activa un cProfile.Profile para el hilo actual (o None si no se pudo)."""
+    perfil = cProfile.Profile()
+    try:
+        perfil.enable()
+    except ValueError as e: # Otro perfilador ya está activo en este hilo
+        logging.warning(f"No se pudo iniciar el perfilado de la petición: {e}")
+        return None
+    return perfil
+
+
+def ruta_perfil(nombre):
+    """Ruta del archivo pstats en DIRECTORIO_PERFILES para un perfil de la petición 'nombre' (endpoint)."""
+    limpio = ''.join(c if c.isalnum() or c in '-_' else '_' for c in nombre).strip('_') or 'peticion'
+    return os.path.join(DIRECTORIO_PERFILES, f"{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{threading.get_ident()}_{limpio}.prof")
+
+
+def guardar_perfil(perfil, ruta):
+    """Detiene el perfil y lo guarda como archivo pstats en 'ruta' (ver ruta_perfil). Devuelve la ruta."""
+    perfil.disable()
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    perfil.dump_stats(ruta)
+    return ruta
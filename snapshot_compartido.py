@@ -0,0 +1,394 @@
+import os
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+try:
+    import fcntl # Solo Unix: lock de archivo entre workers para los escenarios
+except ImportError:
+    fcntl = None
+
+import numpy as np
+
+import grafo_logic as erg
+
+# Directorio donde se guardan los snapshots precompilados del grafo. Todos los workers (procesos
+# de gunicorn) los mapean con mmap sin copiarlos: el sistema operativo guarda una sola copia de las
+# páginas para todos los procesos. Está en disco para que sobrevivan a un reinicio y el arranque
+# en frío no tenga que reconstruir el grafo desde PostGIS; GRAFO_SNAPSHOT_DIR=/dev/shm/... los
+# deja en memoria compartida.
+DIRECTORIO_SNAPSHOTS = os.environ.get(
+    'GRAFO_SNAPSHOT_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grafo_precompilado'),
+)
+ARCHIVO_ACTUAL = 'ACTUAL' # Contiene el nombre del último snapshot publicado
+MAX_SNAPSHOTS_PUBLICADOS = 4 # Se conservan algunos anteriores (otros parámetros, workers que aún los leen)
+# Se incrementa cuando cambia el conjunto o el significado de los arreglos guardados;
+# los snapshots de otro formato se ignoran y se reconstruyen.
+FORMATO_SNAPSHOT = 3
+
+# Arreglos por nodo (posición i = nodo i de G.nodes())
+ARREGLOS_NODOS = ('nodos_xy', 'nodos_latlon', 'componentes', 'kmeans', 'co2_level', 'ch4_level', 'nox_level')
+# Arreglos de aristas, CSR y landmarks ALT
+# Centroides del modelo KMeans (k, 2), para asignar clusters sin reajustar tras adjuntar
+ARREGLOS_KMEANS = ('kmeans_centroides',)
+ARREGLOS_ARISTAS = ('aristas_origen', 'aristas_destino', 'aristas_peso', 'csr_indptr', 'csr_indices', 'csr_pesos',
+                    'landmarks', 'distancias_landmarks')
+# Atribución de tramos: filas de tramos de cada nodo en formato CSR (tramos_indptr, tramos_filas),
+# extremos de cada fila y segmentos por fila (para actualizaciones incrementales, ver erg.actualizar_grafo_red)
+ARREGLOS_TRAMOS = ('tramos_indptr', 'tramos_filas', 'tramos_codtramo', 'tramos_longitud', 'tramos_extremos',
+                   'segmentos_origen', 'segmentos_destino', 'segmentos_fila')
+
+_lock_publicacion = threading.Lock()
+DIRECTORIO_ESCENARIOS = 'escenarios' # Dentro del directorio de cada snapshot publicado
+
+
+def extraer_arreglos(snapshot):
+    """
+    Devuelve {nombre: np.ndarray} con todo lo necesario para reconstruir el snapshot en otro proceso:
+    coordenadas, aristas, CSR, landmarks, componentes, atribución de tramos, KMeans y niveles de gases.
+    """
+    G = snapshot.vista
+    csr = erg.obtener_grafo_csr(G)
+    n = G.number_of_nodes()
+
+    arreglos = {
+        'nodos_xy': np.asarray(G.graph['nodos_xy'], dtype=float),
+        'nodos_latlon': erg.coordenadas_geograficas(G),
+        'componentes': erg.etiquetas_componentes(G),
+        'kmeans': np.asarray(erg.clusters_nodos(G), dtype=np.int32),
+        'aristas_origen': np.asarray(G.graph['aristas_origen'], dtype=np.int64),
+        'aristas_destino': np.asarray(G.graph['aristas_destino'], dtype=np.int64),
+        'aristas_peso': np.asarray(G.graph['aristas_peso'], dtype=float),
+        'csr_indptr': csr.indptr,
+        'csr_indices': csr.indices,
+        'csr_pesos': csr.pesos,
+        'landmarks': np.asarray(getattr(csr, 'landmarks', None) or [], dtype=np.int64),
+        'distancias_landmarks': csr.distancias_landmarks if getattr(csr, 'distancias_landmarks', None) is not None else np.zeros((n, 0)),
+    }
+    modelo = snapshot.modelo_kmeans or {}
+    arreglos['kmeans_centroides'] = np.asarray(modelo.get('centroides', np.zeros((0, 2))), dtype=float).reshape(-1, 2)
+    niveles = erg.niveles_gases(G)
+    for gas in erg.GAS_ATTRS:
+        arreglos[gas] = np.asarray(niveles[gas], dtype=float)
+
+    # Las filas de tramos del nodo i son tramos_filas[tramos_indptr[i]:tramos_indptr[i + 1]] (ver erg.tramos_de_nodo)
+    arreglos['tramos_indptr'] = np.asarray(G.graph.get('tramos_indptr', np.zeros(n + 1)), dtype=np.int64)
+    arreglos['tramos_filas'] = np.asarray(G.graph.get('tramos_filas', []), dtype=np.int64)
+    # Texto como unicode de ancho fijo: los arreglos de objetos no se pueden mapear con mmap
+    arreglos['tramos_codtramo'] = np.asarray(G.graph.get('tramos_codtramo', []), dtype=str)
+    arreglos['tramos_longitud'] = np.asarray(G.graph.get('tramos_longitud', []), dtype=float)
+    arreglos['tramos_extremos'] = np.asarray(G.graph['tramos_extremos'], dtype=np.int64).reshape(-1, 2)
+    for clave in ('segmentos_origen', 'segmentos_destino', 'segmentos_fila'):
+        arreglos[clave] = np.asarray(G.graph[clave], dtype=np.int64)
+    return arreglos
+
+
+def _parametros_json(parametros):
+    """Parámetros tal como quedan guardados en meta.json (las tuplas de región pasan a listas)."""
+    return json.loads(json.dumps(parametros))
+
+
+def _parametros_desde_json(parametros):
+    """Inverso de _parametros_json: las listas vuelven a tuplas para que sirvan de clave en CacheSnapshots."""
+    return {clave: tuple(valor) if isinstance(valor, list) else valor for clave, valor in parametros.items()}
+
+
+def nombre_snapshot(version, parametros):
+    """
+    Nombre del subdirectorio de un snapshot: depende del formato, de la versión de 'tramos_gas'
+    y de los parámetros, así un mismo grafo se guarda una sola vez y se encuentra sin reconstruirlo.
+    Con versión desconocida (None) el nombre es único por publicación.
+    """
+    if version is None:
+        return f"f{FORMATO_SNAPSHOT}_sinversion_{int(time.time() * 1000)}_{os.getpid()}"
+    clave = json.dumps([version, sorted(parametros.items())], default=str)
+    return f"f{FORMATO_SNAPSHOT}_{hashlib.sha1(clave.encode('utf-8')).hexdigest()[:16]}"
+
+
+def publicar_snapshot(snapshot, logprint, directorio=None):
+    """
+    Escribe los arreglos del snapshot como .npy en su subdirectorio (ver nombre_snapshot) y lo marca
+    como el actual con un reemplazo atómico del archivo ACTUAL. Devuelve el nombre publicado, o None si falla.
+    """
+    directorio = directorio or DIRECTORIO_SNAPSHOTS
+    nombre = snapshot.nombre_compartido or nombre_snapshot(snapshot.version, snapshot.parametros)
+    temporal = None
+    try:
+        with _lock_publicacion:
+            if leer_meta(nombre, directorio) is not None:
+                # Ya estaba escrito (por este u otro worker): basta con volver a marcarlo como el actual
+                _marcar_actual(directorio, nombre)
+                snapshot.nombre_compartido = nombre
+                return nombre
+            os.makedirs(directorio, exist_ok=True)
+            temporal = tempfile.mkdtemp(prefix='.tmp_', dir=directorio)
+            for clave, arreglo in extraer_arreglos(snapshot).items():
+                np.save(os.path.join(temporal, clave + '.npy'), arreglo)
+            meta = {
+                'formato': FORMATO_SNAPSHOT,
+                'version': snapshot.version,
+                'parametros': snapshot.parametros,
+                'nodo_inicial': _indice_nodo(snapshot.vista, snapshot.resultados.get('nodo_inicial')),
+                'log': snapshot.log,
+                'lote_cambios': snapshot.lote_cambios,
+                'kmeans_configuracion': list((snapshot.modelo_kmeans or {}).get('configuracion') or []) or None,
+                'creado_en': snapshot.creado_en,
+            }
+            with open(os.path.join(temporal, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            try:
+                os.rename(temporal, os.path.join(directorio, nombre))
+                temporal = None
+            except OSError:
+                # Otro worker terminó de escribir el mismo snapshot primero: se usa el suyo
+                if leer_meta(nombre, directorio) is None:
+                    raise
+                shutil.rmtree(temporal, ignore_errors=True)
+                temporal = None
+            _marcar_actual(directorio, nombre)
+            _limpiar_publicados(directorio, nombre, snapshot.version)
+    except (OSError, ValueError, TypeError) as e:
+        if temporal is not None:
+            shutil.rmtree(temporal, ignore_errors=True)
+        logprint(f"   No se pudo publicar el snapshot compartido en '{directorio}': {e}")
+        logging.warning(f"No se pudo publicar el snapshot compartido: {e}", exc_info=True)
+        return None
+    snapshot.nombre_compartido = nombre
+    logprint(f"   Snapshot precompilado guardado: {nombre}.")
+    return nombre
+
+
+def _marcar_actual(directorio, nombre):
+    """Reemplaza atómicamente el archivo ACTUAL: los lectores ven el nombre anterior o el nuevo, nunca uno a medias."""
+    puntero = os.path.join(directorio, f"{ARCHIVO_ACTUAL}.{os.getpid()}.tmp")
+    with open(puntero, 'w') as f:
+        f.write(nombre)
+    os.replace(puntero, os.path.join(directorio, ARCHIVO_ACTUAL))
+
+
+def _indice_nodo(G, nodo):
+    if nodo is None:
+        return None
+    return erg.obtener_grafo_csr(G).indice_de(nodo)
+
+
+def _limpiar_publicados(directorio, actual, version_actual):
+    """
+    Borra los snapshots de versiones anteriores de 'tramos_gas' o de otro formato y, del resto,
+    los más antiguos por encima de MAX_SNAPSHOTS_PUBLICADOS.
+    En Linux los workers que aún los tengan mapeados no se ven afectados.
+    """
+    vigentes = []
+    for nombre in os.listdir(directorio):
+        if nombre.startswith('.') or nombre == actual or not os.path.isdir(os.path.join(directorio, nombre)):
+            continue
+        meta = leer_meta(nombre, directorio)
+        if meta is None or (version_actual is not None and meta['version'] != version_actual):
+            shutil.rmtree(os.path.join(directorio, nombre), ignore_errors=True)
+        else:
+            vigentes.append((meta.get('creado_en', 0), nombre))
+    vigentes.sort()
+    for _, nombre in vigentes[:max(0, len(vigentes) - (MAX_SNAPSHOTS_PUBLICADOS - 1))]:
+        shutil.rmtree(os.path.join(directorio, nombre), ignore_errors=True)
+
+
+def nombre_publicado(directorio=None):
+    """Nombre del último snapshot publicado, o None si todavía no hay ninguno."""
+    try:
+        with open(os.path.join(directorio or DIRECTORIO_SNAPSHOTS, ARCHIVO_ACTUAL)) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def leer_meta(nombre, directorio=None):
+    """
+    Metadatos (versión, parámetros, log, ...) del snapshot publicado 'nombre', o None si no existe
+    o es de otro FORMATO_SNAPSHOT.
+    """
+    try:
+        with open(os.path.join(directorio or DIRECTORIO_SNAPSHOTS, nombre, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('formato') == FORMATO_SNAPSHOT else None
+
+
+def buscar_snapshot(version, parametros, directorio=None):
+    """
+    Devuelve el nombre del snapshot guardado para (version, parametros), o None si hay que construirlo.
+    Con versión desconocida (None) devuelve el más reciente con esos parámetros, si existe.
+    """
+    directorio = directorio or DIRECTORIO_SNAPSHOTS
+    if version is not None:
+        nombre = nombre_snapshot(version, parametros)
+        meta = leer_meta(nombre, directorio)
+        return nombre if meta is not None and meta['parametros'] == _parametros_json(parametros) else None
+    try:
+        nombres = os.listdir(directorio)
+    except OSError:
+        return None
+    candidatos = []
+    for nombre in nombres:
+        meta = leer_meta(nombre, directorio) if not nombre.startswith('.') else None
+        if meta is not None and meta['parametros'] == _parametros_json(parametros):
+            candidatos.append((meta.get('creado_en', 0), nombre))
+    return max(candidatos)[1] if candidatos else None
+
+
+def grafo_desde_arreglos(arreglos):
+    """
+    Devuelve el erg.GrafoArreglos del snapshot: sus G.graph[...] apuntan a los arreglos mapeados
+    (sin copia), incluidos el CSR, los landmarks, las componentes, la atribución de tramos, los
+    clusters y los niveles de gases. No se crea ningún objeto por nodo: el KD-tree se arma en la
+    primera búsqueda espacial y el grafo NetworkX solo si algún algoritmo lo pide
+    (ver erg.SnapshotGrafo.grafo).
+    """
+    nodos_xy = arreglos['nodos_xy']
+    graph = {
+        'nodos_xy': nodos_xy,
+        'nodos_latlon': arreglos['nodos_latlon'],
+        'aristas_origen': arreglos['aristas_origen'],
+        'aristas_destino': arreglos['aristas_destino'],
+        'aristas_peso': arreglos['aristas_peso'],
+        'indice_espacial': erg.IndiceEspacialNodos(nodos_xy),
+    }
+
+    csr = erg.GrafoCSR.desde_csr(nodos_xy, arreglos['csr_indptr'], arreglos['csr_indices'], arreglos['csr_pesos'],
+                                 graph['indice_espacial'])
+    etiquetas = arreglos['componentes']
+    csr._componentes = (int(etiquetas.max()) + 1 if len(etiquetas) else 0, etiquetas)
+    if len(arreglos['landmarks']):
+        csr.landmarks = arreglos['landmarks'].tolist()
+        csr.distancias_landmarks = arreglos['distancias_landmarks']
+    graph['csr'] = csr
+    graph['componentes'] = etiquetas
+
+    for clave in ARREGLOS_TRAMOS:
+        graph[clave] = arreglos[clave]
+    # Solo lectura: las simulaciones copian los niveles en su overlay antes de modificarlos
+    graph['kmeans_nodos'] = arreglos['kmeans']
+    graph['niveles_gases'] = {gas: arreglos[gas] for gas in erg.GAS_ATTRS}
+    return erg.GrafoArreglos(graph)
+
+
+def adjuntar_snapshot(logprint, nombre=None, directorio=None):
+    """
+    Mapea con mmap (solo lectura) el snapshot publicado 'nombre' (por defecto el actual) y devuelve
+    (erg.SnapshotGrafo, arreglos), o (None, None) si no hay snapshot publicado o no se pudo leer.
+    El grafo del snapshot es un erg.GrafoArreglos sobre los arreglos mapeados (ver grafo_desde_arreglos).
+    """
+    directorio = directorio or DIRECTORIO_SNAPSHOTS
+    nombre = nombre or nombre_publicado(directorio)
+    if nombre is None:
+        return None, None
+    meta = leer_meta(nombre, directorio)
+    if meta is None:
+        return None, None
+    try:
+        ruta = os.path.join(directorio, nombre)
+        arreglos = {clave: np.load(os.path.join(ruta, clave + '.npy'), mmap_mode='r')
+                    for clave in ARREGLOS_NODOS + ARREGLOS_ARISTAS + ARREGLOS_TRAMOS + ARREGLOS_KMEANS}
+    except (OSError, ValueError) as e:
+        logprint(f"   No se pudo adjuntar el snapshot compartido '{nombre}': {e}")
+        logging.warning(f"No se pudo adjuntar el snapshot compartido '{nombre}': {e}")
+        return None, None
+
+    G = grafo_desde_arreglos(arreglos)
+    snapshot = erg.SnapshotGrafo(meta['version'], _parametros_desde_json(meta['parametros']), G, log=meta.get('log'))
+    snapshot.creado_en = meta.get('creado_en', snapshot.creado_en)
+    snapshot.nombre_compartido = nombre
+    snapshot.lote_cambios = meta.get('lote_cambios')
+    nodo_inicial = meta.get('nodo_inicial')
+    snapshot.resultados['nodo_inicial'] = G.graph['csr'].nodo(nodo_inicial) if nodo_inicial is not None else None
+    snapshot.resultados['componentes'] = erg.resumen_componentes(G)
+    snapshot.resultados['kmeans'] = arreglos['kmeans']
+    erg.restaurar_modelo_kmeans(snapshot, meta.get('kmeans_configuracion'), arreglos['kmeans_centroides'])
+    logprint(f"   Snapshot precompilado '{nombre}' cargado (versión {meta['version']}): {G.number_of_nodes()} nodos, {G.number_of_edges()} aristas.")
+    return snapshot, arreglos
+
+
+# === Escenarios de simulación compartidos entre workers ===
+# Los niveles simulados de cada escenario se guardan como .npz junto al snapshot publicado, así
+# /api/simulate-impact y /api/analisis?scenario_id=... ven lo mismo aunque lleguen a workers distintos.
+# Se borran con el snapshot (ver _limpiar_publicados): un escenario vale para un snapshot publicado.
+
+def _ruta_escenario(nombre, escenario_id, directorio=None):
+    """Ruta (sin extensión) de los archivos del escenario; el ID se usa por su hash, no como nombre de archivo."""
+    clave = hashlib.sha1(str(escenario_id).encode('utf-8')).hexdigest()[:20]
+    return os.path.join(directorio or DIRECTORIO_SNAPSHOTS, nombre, DIRECTORIO_ESCENARIOS, clave)
+
+
+@contextmanager
+def bloquear_escenario(nombre, escenario_id, directorio=None):
+    """
+    Lock exclusivo (flock) del escenario entre todos los workers, para que leer-simular-guardar
+    no pierda simulaciones concurrentes. Sin fcntl o si el snapshot ya no existe, no bloquea.
+    """
+    ruta = _ruta_escenario(nombre, escenario_id, directorio)
+    if fcntl is None or not os.path.isdir(os.path.dirname(os.path.dirname(ruta))):
+        yield
+        return
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    with open(ruta + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def existe_escenario(nombre, escenario_id, directorio=None):
+    return os.path.exists(_ruta_escenario(nombre, escenario_id, directorio) + '.npz')
+
+
+def sincronizar_escenario(nombre, escenario_id, overlay, directorio=None):
+    """
+    Trae al overlay los niveles del escenario guardados por cualquier worker, si son más nuevos
+    que los suyos (versión mayor). Solo se lee el archivo cuando cambió desde la última vez.
+    """
+    ruta = _ruta_escenario(nombre, escenario_id, directorio) + '.npz'
+    try:
+        estado = os.stat(ruta)
+    except OSError:
+        return
+    firma = (estado.st_mtime_ns, estado.st_size)
+    if firma == overlay.firma_disco:
+        return
+    try:
+        with np.load(ruta) as datos:
+            version = int(datos['version'])
+            niveles = {gas: np.array(datos[gas], dtype=float) for gas in erg.GAS_ATTRS} if version > overlay.version else None
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"No se pudo leer el escenario '{escenario_id}' del snapshot '{nombre}': {e}")
+        return
+    with overlay.lock:
+        if niveles is not None and version > overlay.version:
+            overlay.niveles = niveles
+            overlay.version = version
+        overlay.firma_disco = firma
+
+
+def guardar_escenario(nombre, escenario_id, overlay, directorio=None):
+    """Guarda los niveles del overlay como la siguiente versión del escenario (reemplazo atómico del .npz)."""
+    ruta = _ruta_escenario(nombre, escenario_id, directorio)
+    if overlay.niveles is None or not os.path.isdir(os.path.dirname(os.path.dirname(ruta))):
+        return
+    try:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        with overlay.lock:
+            version = overlay.version + 1
+            temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+            np.savez(temporal, version=np.int64(version), **overlay.niveles)
+            os.replace(temporal, ruta + '.npz')
+            estado = os.stat(ruta + '.npz')
+            overlay.version = version
+            overlay.firma_disco = (estado.st_mtime_ns, estado.st_size)
+    except OSError as e:
+        logging.warning(f"No se pudo guardar el escenario '{escenario_id}' del snapshot '{nombre}': {e}")
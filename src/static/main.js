@@ -3,6 +3,7 @@ let map;
 let markersLayer;
 let linesLayer;
 let optimalRouteLayer;
+let teselasRedLayer; // Red completa servida por teselas simplificadas según el zoom
 let currentHoveredNodeData = null; // Almacena los datos del nodo actualmente "hovered"
 let clickedNodeData = null; // Almacena los datos del nodo clickeado (para persistencia)
 
@@ -265,7 +266,8 @@ function initializeMap() {
         markersLayer = L.markerClusterGroup().addTo(map);
         linesLayer = L.featureGroup().addTo(map);
         optimalRouteLayer = L.featureGroup().addTo(map);
-        console.log("Feature layers (markersLayer, linesLayer, optimalRouteLayer) initialized and added to map.");
+        teselasRedLayer = crearCapaTeselasRed().addTo(map);
+        console.log("Feature layers (markersLayer, linesLayer, optimalRouteLayer, teselasRedLayer) initialized and added to map.");
 
     } catch (e) {
         console.error("ERROR CRÍTICO durante la inicialización del mapa Leaflet:", e);
@@ -273,21 +275,108 @@ function initializeMap() {
     }
 }
 
+// Capa de la red completa por teselas: solo se piden las teselas visibles y el servidor
+// devuelve la geometría simplificada para el zoom actual. Se dibuja en canvas.
+function crearCapaTeselasRed() {
+    const renderer = L.canvas({ padding: 0.5 });
+    const grupo = L.layerGroup();
+    const CapaTeselas = L.GridLayer.extend({
+        createTile: function (coords, done) {
+            const tile = document.createElement('div');
+            const clave = this._tileCoordsToKey(coords);
+            const controlador = new AbortController();
+            tile._abortar = () => controlador.abort();
+            fetch(`/api/teselas/${coords.z}/${coords.x}/${coords.y}.geojson`, { signal: controlador.signal })
+                .then(response => {
+                    if (!response.ok) throw new Error(`Error HTTP: ${response.status}`);
+                    return response.json();
+                })
+                .then(coleccion => {
+                    // La tesela pudo descartarse mientras llegaba la respuesta
+                    if (!this._tiles[clave]) return;
+                    const capa = L.geoJSON(coleccion, {
+                        renderer: renderer,
+                        interactive: false,
+                        style: { color: '#3388ff', weight: coords.z >= 15 ? 2 : 1, opacity: 0.6 }
+                    });
+                    tile._capaRed = capa;
+                    grupo.addLayer(capa);
+                    done(null, tile);
+                })
+                .catch(error => {
+                    if (error.name !== 'AbortError') console.warn(`Tesela ${clave} no disponible:`, error);
+                    done(error, tile);
+                });
+            return tile;
+        }
+    });
+    const capaTeselas = new CapaTeselas({ minZoom: 8, updateWhenZooming: false, keepBuffer: 1 });
+    capaTeselas.on('tileunload', evento => {
+        if (evento.tile._abortar) evento.tile._abortar();
+        if (evento.tile._capaRed) grupo.removeLayer(evento.tile._capaRed);
+    });
+    return L.layerGroup([capaTeselas, grupo]);
+}
+
+// Convierte un bloque columnar ({col: [valores]}) en una lista de objetos (una fila por nodo)
+function columnasAFilas(columnas) {
+    const nombres = Object.keys(columnas);
+    const total = nombres.length > 0 ? columnas[nombres[0]].length : 0;
+    const filas = new Array(total);
+    for (let i = 0; i < total; i++) {
+        const fila = {};
+        nombres.forEach(nombre => { fila[nombre] = columnas[nombre][i]; });
+        filas[i] = fila;
+    }
+    return filas;
+}
+
+// Espera a que termine un trabajo de análisis, mostrando su bitácora a medida que avanza
+async function esperarTrabajoAnalisis(jobId) {
+    let lineas = [];
+    while (true) {
+        const response = await fetch(`/api/analisis/trabajos/${jobId}?desde=${lineas.length}`);
+        if (!response.ok) {
+            const errorText = await response.text();
+            throw new Error(`Error HTTP: ${response.status} - ${errorText}`);
+        }
+        const estado = await response.json();
+        lineas = lineas.concat(estado.log);
+        renderLog(lineas);
+        if (estado.estado === 'completado') return;
+        if (estado.estado === 'error') throw new Error(estado.error || 'El análisis falló.');
+        await new Promise(resolve => setTimeout(resolve, 500));
+    }
+}
+
 async function cargarGrafo() {
     mostrarCargando(true);
     try {
-        console.log("Fetching graph data from /api/analisis...");
-        const response = await fetch('/api/analisis');
+        // El análisis corre como trabajo en segundo plano: se crea (o se reutiliza) y se sigue su progreso
+        // Con "Solo región visible" se cargan solo los tramos que cruzan el área del mapa (filtro en PostGIS)
+        let jobUrl = '/api/analisis/trabajos';
+        const soloRegion = document.getElementById('solo-region-visible');
+        if (soloRegion && soloRegion.checked && map) {
+            const b = map.getBounds();
+            jobUrl += `?region_bbox=${b.getWest()},${b.getSouth()},${b.getEast()},${b.getNorth()}`;
+        }
+        console.log(`Creating analysis job at ${jobUrl}...`);
+        const jobResponse = await fetch(jobUrl, { method: 'POST' });
+        if (!jobResponse.ok) {
+            const errorText = await jobResponse.text();
+            throw new Error(`Error HTTP: ${jobResponse.status} - ${errorText}`);
+        }
+        const trabajo = await jobResponse.json();
+        await esperarTrabajoAnalisis(trabajo.job_id);
+
+        // Formato NDJSON: una línea 'meta' y luego bloques columnares de nodos y aristas.
+        // Cada bloque de nodos se dibuja apenas llega, sin esperar la respuesta completa.
+        console.log("Fetching graph data from the job result (ndjson)...");
+        const response = await fetch(`/api/analisis/trabajos/${trabajo.job_id}/resultado?formato=ndjson`);
         if (!response.ok) {
             const errorText = await response.text();
             throw new Error(`Error HTTP: ${response.status} - ${errorText}`);
         }
-        const data = await response.json();
-        console.log("Graph data received. Nodes count:", data.nodes.length, "Edges count:", data.edges.length);
-
-        window.mst_weight = data.mst_weight;
-        renderLog(data.log);
-        renderMST(data.mst_weight);
 
         if (!markersLayer || !linesLayer || !optimalRouteLayer) {
             console.error("ERROR: Una o más capas no están inicializadas. No se puede renderizar el grafo.");
@@ -296,7 +385,44 @@ async function cargarGrafo() {
             return;
         }
 
-        renderGraphOnMap(data.nodes, data.edges);
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let pendiente = '';
+        let nodesCount = 0;
+        let edgesCount = 0;
+        let primerBloque = true;
+
+        const procesarLinea = (linea) => {
+            if (!linea.trim()) return;
+            const mensaje = JSON.parse(linea);
+            if (mensaje.tipo === 'meta') {
+                window.mst_weight = mensaje.mst_weight;
+                renderLog(mensaje.log);
+                renderMST(mensaje.mst_weight);
+            } else if (mensaje.tipo === 'nodes') {
+                const nodes = columnasAFilas(mensaje.datos);
+                renderGraphOnMap(nodes, [], !primerBloque);
+                primerBloque = false;
+                nodesCount += nodes.length;
+            } else if (mensaje.tipo === 'edges') {
+                edgesCount += mensaje.datos.source.length;
+            }
+        };
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            pendiente += decoder.decode(value, { stream: true });
+            const lineas = pendiente.split('\n');
+            pendiente = lineas.pop();
+            lineas.forEach(procesarLinea);
+        }
+        procesarLinea(pendiente);
+
+        if (markersLayer.getLayers().length > 0) {
+            map.fitBounds(markersLayer.getBounds());
+        }
+        console.log("Graph data received. Nodes count:", nodesCount, "Edges count:", edgesCount);
         console.log("Graph rendering on map completed.");
 
         mostrarCargando(false);
@@ -438,13 +564,14 @@ function renderMST(mst_weight) {
     }
     mstInfo.innerHTML = `
         <div class="mst-block">
-            <b>Peso total del Árbol de Expansión Mínima (MST):</b> ${mst_weight} km
+            <b>Peso total del Árbol de Expansión Mínima (MST):</b> ${mst_weight !== undefined && mst_weight !== null ? mst_weight + ' km' : 'No calculado'}
         </div>
     `;
 }
 
 
-function renderGraphOnMap(nodes, edges) {
+// append = true agrega los nodos a las capas existentes (carga por bloques) en lugar de limpiarlas
+function renderGraphOnMap(nodes, edges, append = false) {
     console.log("Inside renderGraphOnMap function. Nodes to render:", nodes.length, "Edges to render:", edges.length);
 
     if (!markersLayer || !markersLayer.clearLayers) {
@@ -461,10 +588,12 @@ function renderGraphOnMap(nodes, edges) {
     }
 
 
-    markersLayer.clearLayers();
-    linesLayer.clearLayers();
-    optimalRouteLayer.clearLayers();
-    console.log("Layers cleared.");
+    if (!append) {
+        markersLayer.clearLayers();
+        linesLayer.clearLayers();
+        optimalRouteLayer.clearLayers();
+        console.log("Layers cleared.");
+    }
 
     nodes.forEach(node => {
         if (typeof node.lat === 'number' && typeof node.lon === 'number' && !isNaN(node.lat) && !isNaN(node.lon)) {
@@ -580,6 +709,9 @@ function renderGraphOnMap(nodes, edges) {
         }
     });
 
+    if (append) {
+        return;
+    }
     if (markersLayer.getLayers().length > 0) {
         map.fitBounds(markersLayer.getBounds());
         console.log("Map bounds adjusted to fit markers.");
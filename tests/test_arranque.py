@@ -0,0 +1,48 @@
+"""
+Arranque de los workers: 'import app' no debe cargar las dependencias pesadas (se importan en el
+primer uso) ni abrir la conexión a PostGIS. Se importa en un proceso nuevo para partir de un
+sys.modules limpio.
+"""
+import json
+import os
+import subprocess
+import sys
+
+RAIZ_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ_REPO)
+
+from benchmarks.ejecutar import MODULOS_DIFERIDOS
+
+SEGUNDOS_MAXIMOS_IMPORTACION = 30 # Holgado: solo detecta que el arranque vuelva a construir o cargar todo
+
+_CODIGO = (
+    "import sys, time, json\n"
+    "inicio = time.perf_counter()\n"
+    "import app\n"
+    "import grafo_logic\n"
+    "print(json.dumps({'segundos': time.perf_counter() - inicio,\n"
+    "                  'cargados': [m for m in %r if m in sys.modules],\n"
+    "                  'engine_creado': grafo_logic._ENGINE is not None}))\n"
+)
+
+
+def importar_app():
+    salida = subprocess.run([sys.executable, '-c', _CODIGO % (MODULOS_DIFERIDOS,)], cwd=RAIZ_REPO,
+                            capture_output=True, text=True, timeout=120)
+    assert salida.returncode == 0, salida.stderr
+    return json.loads(salida.stdout.strip().splitlines()[-1])
+
+
+def test_importar_app_no_carga_dependencias_pesadas():
+    medicion = importar_app()
+    for modulo in ('sklearn', 'geopandas', 'sqlalchemy', 'networkx', 'shapely'):
+        assert modulo in MODULOS_DIFERIDOS
+    assert medicion['cargados'] == []
+
+
+def test_importar_app_no_crea_el_engine():
+    assert importar_app()['engine_creado'] is False
+
+
+def test_importar_app_es_rapido():
+    assert importar_app()['segundos'] < SEGUNDOS_MAXIMOS_IMPORTACION
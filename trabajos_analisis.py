@@ -0,0 +1,126 @@
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Estados de un trabajo de análisis
+PENDIENTE = 'pendiente'
+EN_PROGRESO = 'en_progreso'
+COMPLETADO = 'completado'
+ERROR = 'error'
+
+
+class TrabajoAnalisis:
+    """
+    Un análisis ejecutado en segundo plano. Guarda los mensajes de logprint a medida que
+    se producen, para que el cliente pueda seguir el progreso mientras el trabajo corre.
+    """
+    def __init__(self, clave):
+        self.id = uuid.uuid4().hex
+        self.clave = clave
+        self.estado = PENDIENTE
+        self.log = []
+        self.resultado = None
+        self.error = None
+        self.creado_en = time.time()
+        self.terminado_en = None
+        self._cambio = threading.Condition()
+
+    @property
+    def terminado(self):
+        return self.estado in (COMPLETADO, ERROR)
+
+    def logprint(self, msg):
+        with self._cambio:
+            self.log.append(msg)
+            self._cambio.notify_all()
+        print(msg)
+
+    def _finalizar(self, estado, resultado=None, error=None):
+        with self._cambio:
+            self.estado = estado
+            self.resultado = resultado
+            self.error = error
+            self.terminado_en = time.time()
+            self._cambio.notify_all()
+
+    def esperar_cambios(self, desde, timeout):
+        """
+        Espera hasta timeout segundos a que haya mensajes nuevos a partir de 'desde' o a que el
+        trabajo termine. Devuelve (mensajes nuevos, terminado).
+        """
+        with self._cambio:
+            self._cambio.wait_for(lambda: len(self.log) > desde or self.terminado, timeout=timeout)
+            return self.log[desde:], self.terminado
+
+    def a_dict(self, desde=0):
+        with self._cambio:
+            return {
+                "job_id": self.id,
+                "estado": self.estado,
+                "log": self.log[desde:],
+                "total_log": len(self.log),
+                "error": self.error,
+                "creado_en": self.creado_en,
+                "terminado_en": self.terminado_en,
+            }
+
+
+class GestorTrabajos:
+    """
+    Ejecuta trabajos de análisis en un pool de hilos.
+    Los envíos con la misma clave mientras un trabajo está pendiente o en progreso
+    se deduplican: todos reciben el mismo trabajo.
+    """
+    def __init__(self, max_workers=2, ttl_segundos=3600, max_trabajos=200):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='analisis')
+        self._trabajos = {}
+        self._activos = {} # clave -> trabajo pendiente o en progreso
+        self._lock = threading.Lock()
+        self.ttl_segundos = ttl_segundos
+        self.max_trabajos = max_trabajos
+
+    def enviar(self, clave, funcion):
+        """
+        Encola funcion(logprint) -> resultado. Devuelve (trabajo, nuevo), donde nuevo es False
+        si se reutilizó un trabajo idéntico que todavía no terminó.
+        El resultado se guarda hasta ttl_segundos: debe ser liviano (no el grafo ni el snapshot).
+        """
+        with self._lock:
+            trabajo = self._activos.get(clave)
+            if trabajo is not None:
+                return trabajo, False
+            self._limpiar()
+            trabajo = TrabajoAnalisis(clave)
+            self._trabajos[trabajo.id] = trabajo
+            self._activos[clave] = trabajo
+        self._pool.submit(self._ejecutar, trabajo, funcion)
+        return trabajo, True
+
+    def obtener(self, job_id):
+        with self._lock:
+            return self._trabajos.get(job_id)
+
+    def _ejecutar(self, trabajo, funcion):
+        trabajo.estado = EN_PROGRESO
+        try:
+            resultado = funcion(trabajo.logprint)
+            trabajo._finalizar(COMPLETADO, resultado=resultado)
+        except Exception as e:
+            logging.error(f"Error en el trabajo de análisis {trabajo.id}: {e}", exc_info=True)
+            trabajo.logprint("ERROR: " + str(e))
+            trabajo._finalizar(ERROR, error=str(e))
+        finally:
+            with self._lock:
+                if self._activos.get(trabajo.clave) is trabajo:
+                    del self._activos[trabajo.clave]
+
+    def _limpiar(self):
+        # Descartar trabajos terminados hace más de ttl_segundos, y los más antiguos si hay demasiados
+        ahora = time.time()
+        for job_id in [j for j, t in self._trabajos.items() if t.terminado and ahora - t.terminado_en > self.ttl_segundos]:
+            del self._trabajos[job_id]
+        terminados = sorted((t for t in self._trabajos.values() if t.terminado), key=lambda t: t.terminado_en)
+        while len(self._trabajos) >= self.max_trabajos and terminados:
+            del self._trabajos[terminados.pop(0).id]